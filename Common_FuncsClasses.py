@@ -1,23 +1,133 @@
+import os
 import numpy as np
 import pandas as pd
 
 """Lineshape fitting"""
 #amp, linewidth, centerfield
+#Each Lorentzian derivative (Sym - AntiSym*(H-Hr)) / ((H-Hr)^2 + (dH/2)^2)^2 is computed once by _lorentzian,
+#which shares H-Hr and the denominator between the value and the derivatives. Every model has an analytic
+#Jacobian in Jacobians (for curve_fit(..., jac=Jacobians[model])), and all of them broadcast, so many spectra
+#can be evaluated at once from a 2-D array of fields, see evaluateBatch and fitBatch.
+def _lorentzian(H, Hr, Sym, AntiSym, dH, derivatives=False):
+    x = np.asarray(H, dtype=float) - Hr #Integer fields would make the in-place divisions fail
+    D = x * x
+    D += 0.25 * dH * dH
+    value = Sym - AntiSym * x
+    value /= D
+    value /= D
+    if not derivatives: return value
+    #d/dSym, d/dAntiSym, d/dHr and d/ddH, with value / D = (Sym - AntiSym*x) / D^3
+    dSym = 1 / (D * D)
+    overD = value / D
+    return value, 4 * x * overD + AntiSym * dSym, dSym, -x * dSym, -dH * overD
+
+def _stack(H, columns):
+    """Jacobian of shape H.shape + (parameters,) from the derivative of each parameter"""
+    return np.stack(np.broadcast_arrays(*columns), axis=-1)
+
 #Has two Lorentzians. Each has a symmetric and antisymmetric component.
 def doubleLorentzians(H, Hr1, Hr2, Sym1, AntiSym1, Sym2, AntiSym2, dH1, dH2, C):
-    return (Sym1-AntiSym1*(H-Hr1))/((H-Hr1)**2+(dH1/2)**2)**2 + (Sym2-AntiSym2*(H-Hr2))/((H-Hr2)**2+(dH2/2)**2)**2 + C
+    return _lorentzian(H, Hr1, Sym1, AntiSym1, dH1) + _lorentzian(H, Hr2, Sym2, AntiSym2, dH2) + C
+
+def doubleLorentzians_jac(H, Hr1, Hr2, Sym1, AntiSym1, Sym2, AntiSym2, dH1, dH2, C):
+    v1, dHr1, dSym1, dAntiSym1, ddH1 = _lorentzian(H, Hr1, Sym1, AntiSym1, dH1, True)
+    v2, dHr2, dSym2, dAntiSym2, ddH2 = _lorentzian(H, Hr2, Sym2, AntiSym2, dH2, True)
+    return _stack(H, [dHr1, dHr2, dSym1, dAntiSym1, dSym2, dAntiSym2, ddH1, ddH2, np.ones_like(v1)])
 
 def doubleLorentzian_NoSym(H, Hr1, Hr2, AntiSym1, AntiSym2, dH1, dH2, C):
-    return -AntiSym1*(H-Hr1) / ((H-Hr1)**2+(dH1/2)**2)**2 - AntiSym2*(H-Hr2)/((H-Hr2)**2+(dH2/2)**2)**2 + C
+    return _lorentzian(H, Hr1, 0, AntiSym1, dH1) + _lorentzian(H, Hr2, 0, AntiSym2, dH2) + C
+
+def doubleLorentzian_NoSym_jac(H, Hr1, Hr2, AntiSym1, AntiSym2, dH1, dH2, C):
+    v1, dHr1, dSym1, dAntiSym1, ddH1 = _lorentzian(H, Hr1, 0, AntiSym1, dH1, True)
+    v2, dHr2, dSym2, dAntiSym2, ddH2 = _lorentzian(H, Hr2, 0, AntiSym2, dH2, True)
+    return _stack(H, [dHr1, dHr2, dAntiSym1, dAntiSym2, ddH1, ddH2, np.ones_like(v1)])
 
 def singleLorentzian(H, Hr1, Sym1, AntiSym1, dH1, C):
-    return (Sym1-AntiSym1*(H-Hr1))/((H-Hr1)**2+(dH1/2)**2)**2 + C
+    return _lorentzian(H, Hr1, Sym1, AntiSym1, dH1) + C
+
+def singleLorentzian_jac(H, Hr1, Sym1, AntiSym1, dH1, C):
+    v1, dHr1, dSym1, dAntiSym1, ddH1 = _lorentzian(H, Hr1, Sym1, AntiSym1, dH1, True)
+    return _stack(H, [dHr1, dSym1, dAntiSym1, ddH1, np.ones_like(v1)])
 
 def singleLorentz_LinBg(H, Hr1, Sym1, AntiSym1, dH1, C, slope):
-    return (Sym1-AntiSym1*(H-Hr1))/((H-Hr1)**2+(dH1/2)**2)**2 + C + slope * H
+    return _lorentzian(H, Hr1, Sym1, AntiSym1, dH1) + C + slope * H
+
+def singleLorentz_LinBg_jac(H, Hr1, Sym1, AntiSym1, dH1, C, slope):
+    v1, dHr1, dSym1, dAntiSym1, ddH1 = _lorentzian(H, Hr1, Sym1, AntiSym1, dH1, True)
+    return _stack(H, [dHr1, dSym1, dAntiSym1, ddH1, np.ones_like(v1), H + 0 * v1])
 
 def singleLorentz_AsymBg(H, Hr1, Sym1, AntiSym1, dH1, Hr2, AntiSym2, dH2, C):
-    return (Sym1-AntiSym1*(H-Hr1))/((H-Hr1)**2+(dH1/2)**2)**2 - AntiSym2*(H-Hr2)/((H-Hr2)**2+(dH2/2)**2)**2 + C
+    return _lorentzian(H, Hr1, Sym1, AntiSym1, dH1) + _lorentzian(H, Hr2, 0, AntiSym2, dH2) + C
+
+def singleLorentz_AsymBg_jac(H, Hr1, Sym1, AntiSym1, dH1, Hr2, AntiSym2, dH2, C):
+    v1, dHr1, dSym1, dAntiSym1, ddH1 = _lorentzian(H, Hr1, Sym1, AntiSym1, dH1, True)
+    v2, dHr2, dSym2, dAntiSym2, ddH2 = _lorentzian(H, Hr2, 0, AntiSym2, dH2, True)
+    return _stack(H, [dHr1, dSym1, dAntiSym1, ddH1, dHr2, dAntiSym2, ddH2, np.ones_like(v1)])
+
+Jacobians = {doubleLorentzians: doubleLorentzians_jac, doubleLorentzian_NoSym: doubleLorentzian_NoSym_jac,
+             singleLorentzian: singleLorentzian_jac, singleLorentz_LinBg: singleLorentz_LinBg_jac,
+             singleLorentz_AsymBg: singleLorentz_AsymBg_jac}
+
+def _batchArgs(H, params):
+    params = np.asarray(params, dtype=float)
+    H = np.asarray(H, dtype=float)
+    return (H if H.ndim == 2 else H[np.newaxis, :]), [params[:, j, np.newaxis] for j in range(params.shape[1])]
+
+def evaluateBatch(model, H, params):
+    """model at every row: H of shape (spectra, points) or (points,) shared by all, params of shape
+    (spectra, parameters). Returns (spectra, points)"""
+    H, columns = _batchArgs(H, params)
+    return model(H, *columns) + np.zeros((len(columns[0]), 1))
+
+def jacobianBatch(model, H, params):
+    """Jacobians of all spectra at once, shape (spectra, points, parameters). Models without an entry in
+    Jacobians (e.g. the dependence models) get central differences, one parameter at a time for all spectra"""
+    H, columns = _batchArgs(H, params)
+    if model in Jacobians: return Jacobians[model](H, *columns) + np.zeros((len(columns[0]), 1, 1))
+    derivatives = []
+    for j, column in enumerate(columns):
+        h = 1e-6 * np.maximum(np.abs(column), 1e-8)
+        up, down = list(columns), list(columns)
+        up[j], down[j] = column + h, column - h
+        derivatives.append((model(H, *up) - model(H, *down)) / (2 * h))
+    return _stack(H, derivatives)
+
+def fitBatch(model, H, Y, p0, maxIterations=200, tolerance=1e-10):
+    """Levenberg-Marquardt fit of many spectra at once with the analytic Jacobians (see jacobianBatch).
+    H, Y: (spectra, points), shorter spectra padded with nan. p0: (spectra, parameters).
+    Returns (params, covariance (spectra, parameters, parameters), rss, converged)"""
+    H, Y = np.array(H, dtype=float, ndmin=2), np.array(Y, dtype=float, ndmin=2)
+    weight = (np.isfinite(H) & np.isfinite(Y)).astype(float)
+    H, Y = np.where(weight > 0, H, np.nanmean(H, axis=1, keepdims=True)), np.where(weight > 0, Y, 0.0)
+    params = np.array(p0, dtype=float, ndmin=2)
+    k = params.shape[1]
+    damping = np.full(len(params), 1e-3)
+    residuals = (Y - evaluateBatch(model, H, params)) * weight
+    rss = np.einsum("ij,ij->i", residuals, residuals)
+    converged = np.zeros(len(params), dtype=bool)
+    for iteration in range(maxIterations):
+        active = ~converged
+        if not active.any(): break
+        J = jacobianBatch(model, H[active], params[active]) * weight[active, :, np.newaxis]
+        JTJ = np.einsum("mnk,mnl->mkl", J, J)
+        gradient = np.einsum("mnk,mn->mk", J, residuals[active])
+        diagonal = np.einsum("mkk->mk", JTJ)
+        A = JTJ + (damping[active, np.newaxis] * (diagonal + 1e-30))[..., np.newaxis] * np.eye(k)
+        try: step = np.linalg.solve(A, gradient[..., np.newaxis])[..., 0]
+        except np.linalg.LinAlgError: step = np.einsum("mkl,ml->mk", np.linalg.pinv(A), gradient)
+        trial = params[active] + step
+        trialResiduals = (Y[active] - evaluateBatch(model, H[active], trial)) * weight[active]
+        trialRss = np.einsum("ij,ij->i", trialResiduals, trialResiduals)
+        better = np.isfinite(trialRss) & (trialRss <= rss[active])
+        index = np.nonzero(active)[0]
+        done = better & (rss[active] - trialRss <= tolerance * rss[active]) | (damping[active] > 1e12)
+        params[index[better]], residuals[index[better]], rss[index[better]] = trial[better], trialResiduals[better], trialRss[better]
+        damping[index] = np.where(better, damping[index] / 10, damping[index] * 10)
+        converged[index[done]] = True
+    J = jacobianBatch(model, H, params) * weight[:, :, np.newaxis]
+    dof = np.maximum(weight.sum(axis=1) - k, 1)
+    covariance = np.linalg.pinv(np.einsum("mnk,mnl->mkl", J, J)) * (rss / dof)[:, np.newaxis, np.newaxis]
+    return params, covariance, rss, converged
 
 """Dependence fitting"""
 gamma_0 = 0.0176
@@ -54,23 +164,29 @@ def loadCSVandPreprocess(path, file):
     freq = next(s for s in fileNameWords if "GHz" in s).replace("GHz", "").replace('p', '.')
     temp = next(s for s in fileNameWords if "K" in s and s.replace("K", '').isnumeric()).replace('K', '')
     print("Freq&Temp:", freq, temp)
-    filename = path + '\\' + file
+    filename = os.path.join(path, file)
     df = pd.read_csv(filename)
     fields = df["Field(G)"].values
     lockin = df["Lockin_X_Ave"].values
     if not len(fields): print("Empty field data:", fields)
     if not len(lockin): print("Empty lockin data:", lockin)
 
+    """CSV files could have lines that only have ,,,, which is not visible in spreadsheet"""
+    Hres, sym, antiSym, dH, H1, H2, signal_max, signal_min = peakToPeakGuess(fields, lockin)
+
+    return freq, temp, fields, lockin, Hres, sym, antiSym, dH, H1, H2, signal_max, signal_min
+
+
+def peakToPeakGuess(fields, lockin):
+    """Initial guesses of singleLorentzian from the positions of the max and min of the derivative signal"""
     Hres = 0.5 * (fields[lockin.argmax()] + fields[lockin.argmin()])
     H1, H2 = fields[lockin.argmax()], fields[lockin.argmin()]
     dH = np.sqrt(3) * abs(H2 - H1)
-    """CSV files could have lines that only have ,,,, which is not visible in spreadsheet"""
     signal_max, signal_min = lockin.max(), lockin.min()
     peakCenter = 0.5 * (signal_max + signal_min)
     antiSym = (signal_max - peakCenter) * dH ** 3 * 2 / (3 * np.sqrt(3))
     sym = (signal_max - peakCenter) * dH ** 4 / 16
-
-    return freq, temp, fields, lockin, Hres, sym, antiSym, dH, H1, H2, signal_max, signal_min
+    return Hres, sym, antiSym, dH, H1, H2, signal_max, signal_min
 
 
 class Line2D:
@@ -3,33 +3,38 @@
 """Module containing a class to interface with a Quantum Dynamics PPMS DynaCool"""
 
 # requires Python for .NET, can be installed with 'pip install pythonnet'
-import platform, clr, subprocess
+import platform, subprocess
 
 """Connect to the ppms in order to control the field and temperature"""
-try: clr.AddReference('QDInstrument')
-except Exception as e:
-	print("Exception found:", e)
-	if clr.FindAssembly('QDInstrument') is None: print('Could not find QDInstrument.dll')
-	else:
-		print('Found QDInstrument.dll at {}'.format(clr.FindAssembly('QDInstrument')))
-		print('Try right-clicking the .dll, selecting "Properties", and then clicking "Unblock"')
-		# import the C# classes for interfacing with the PPMS
-		#The dll file must be unblocked in the dll file's properties
-		
-# import the C# classes for interfacing with the PPMS
-#The dll file must be unblocked in the dll file's properties
-"""	The control of PPMS field/temperature is given by the manufacturer Quantum Design. 
-	They provide Labview packages to interface with the PPMS, and such packages are also 
-	included in QDInstrument.dll in the folder with python codes. Each python code loads the dll
-	and REGISTERS it as QuantumDesign library and import it
-"""
-from QuantumDesign.QDInstrument import *
+try:
+	import clr
+	try: clr.AddReference('QDInstrument')
+	except Exception as e:
+		print("Exception found:", e)
+		if clr.FindAssembly('QDInstrument') is None: print('Could not find QDInstrument.dll')
+		else:
+			print('Found QDInstrument.dll at {}'.format(clr.FindAssembly('QDInstrument')))
+			print('Try right-clicking the .dll, selecting "Properties", and then clicking "Unblock"')
+			# import the C# classes for interfacing with the PPMS
+			#The dll file must be unblocked in the dll file's properties
+			
+	# import the C# classes for interfacing with the PPMS
+	#The dll file must be unblocked in the dll file's properties
+	"""	The control of PPMS field/temperature is given by the manufacturer Quantum Design. 
+		They provide Labview packages to interface with the PPMS, and such packages are also 
+		included in QDInstrument.dll in the folder with python codes. Each python code loads the dll
+		and REGISTERS it as QuantumDesign library and import it
+	"""
+	from QuantumDesign.QDInstrument import *
 
-QDI_PPMS_TYPE = QDInstrumentBase.QDInstrumentType.DynaCool
-#QDI_FIELD_APPROACH = QDInstrumentBase.FieldApproach.NoOvershoot
-QDI_FIELD_APPROACH = QDInstrumentBase.FieldApproach.Linear
-QDI_FIELD_MODE = QDInstrumentBase.FieldMode.Persistent
-QDI_FIELD_MODE_driven = QDInstrumentBase.FieldMode.Driven
+	QDI_PPMS_TYPE = QDInstrumentBase.QDInstrumentType.DynaCool
+	#QDI_FIELD_APPROACH = QDInstrumentBase.FieldApproach.NoOvershoot
+	QDI_FIELD_APPROACH = QDInstrumentBase.FieldApproach.Linear
+	QDI_FIELD_MODE = QDInstrumentBase.FieldMode.Persistent
+	QDI_FIELD_MODE_driven = QDInstrumentBase.FieldMode.Driven
+except ImportError as e:
+	#Without pythonnet/QDInstrument.dll (e.g. on Linux) the GUI and fmr_simulator.py still work
+	print("PPMS control is unavailable:", e)
 
 DEFAULT_PORT = 11000
 QDI_FIELD_STATUS = ['MagnetUnknown', 'StablePersistent', 'StableDriven',
@@ -95,19 +100,22 @@ def connect2PPMS(ipAddress=PPMS_ComputerIPAddress):
 		raise
 	
 	
-TimeConst_WaitTime_Conversion = 5
-
 import wx, pyvisa
 import pymeasure
-import threading
-import numpy, scipy #Generate arrays and fit arrays
+import scipy
 from datetime import datetime
 import time, os
 
-import pandas as pd
-import matplotlib
-matplotlib.use('agg')
-import matplotlib.pyplot as plt
+from live_plot import LivePlot
+from lockin_control import LockinReadModes
+from status_poller import StatusPoller, lockPPMS
+from async_instruments import AsyncIO
+from io_trace import TracedInstrument
+from settle_scheduler import SettleModes
+from sweep_planner import SweepOrders
+from run_estimator import calibrate, estimate, formatEstimate
+from run_journal import RunJournal
+from measurement_engine import MeasurementEngine, ScanPlan, EventQueue, ScanModes, TimeConst_WaitTime_Conversion, guarded
 
 wx.Log.EnableLogging(False)
 wx.InitAllImageHandlers()
@@ -121,31 +129,6 @@ def scale_bitmap(bitmap, width, height):
 	result = wx.Bitmap(image)
 	return result
 
-def plotandSave(fileName, plotTotal):
-	df = pd.read_csv(fileName, sep=',')
-	fig, ax = plt.subplots()
-	fields, lockinReading1, lockinReading2 = df["Field(G)"], df["Lockin_X_Ave"], df["Lockin_Y_Ave"]
-	if plotTotal:
-		lockinReadingSqrt = []
-		for x, y in zip(lockinReading1.values, lockinReading2.values):
-			sqrt = numpy.sqrt(x ** 2 + y ** 2)
-			lockinReadingSqrt.append(sqrt if x >= 0 else -sqrt)
-	ax.set_xlabel("Field (G)")
-	ax.set_ylabel("Lockin_Ave")
-	ax.plot(fields, lockinReading1, '-bo')
-	ax.plot(fields, lockinReading2, '-ro')
-	if plotTotal:
-		ax.plot(fields, lockinReadingSqrt, '--y')
-		ax.legend(['X', 'Y', "Total"])
-	else:
-		ax.legend(['X', 'Y'])
-	figName = fileName.replace("csv", "png")
-	plt.grid(True)
-	plt.savefig(figName)
-	plt.close()
-	return figName
-	
-	
 def connect(address, logs=None):
 	device = None
 	if address:
@@ -159,78 +142,7 @@ def connect(address, logs=None):
 			print(e)
 	else: logs.add("Address NOT given. Connection failed.")
 	return device
-	
-def lockinRead(lockin, waitTime):
-	signals_1, signals_2 = [], []
-	time.sleep(waitTime) #unit in seconds
-	for i in range(5):
-		#The mod freq is typically 573.1Hz, so 0.1sec sampling separation should be long enough
-		time.sleep(0.1)
-		signals_1.append(float(lockin.query("OUTP? 1")))
-		signals_2.append(float(lockin.query("OUTP? 2")))
-	#Discard the highest and lowest values measured
-	return numpy.average(signals_1), numpy.average(signals_2)
-	
-def generateFieldswithCentersandLinewidths_DenseatCenter(Hres_atFreqs, linewidth_0, linewidth_1, reverse, fieldStepSize=0):
-	#We want there to be 10 data points between the peak-peak
-	#For each frequency, there is a set of fields the measurement will scan
-	fields2Scan_atFreqs = {}
-	for freq in Hres_atFreqs:
-		freqs = sorted(list(Hres_atFreqs.keys()))
-		if len(Hres_atFreqs) == 1:
-			DeltaH_pk2pk = linewidth_0
-		else:
-			a, b = freqs[0], freqs[-1]
-			DeltaH_pk2pk = linewidth_0 + (linewidth_1 - linewidth_0) * (freq - a) / (b - a)
-		centerField = Hres_atFreqs[freq]
-		fieldRange = 7 * DeltaH_pk2pk
-		stepSize = fieldStepSize if fieldStepSize else round(DeltaH_pk2pk / 16, 1)
-		field_init, field_1 = centerField - 0.5 * fieldRange, centerField - 0.25 * fieldRange
-		field_2, field_3 = centerField - 0.12 * fieldRange, centerField + 0.12 * fieldRange
-		field_4, field_end = centerField + 0.25 * fieldRange, centerField + 0.5 * fieldRange
-		#Start making the fields at this frequency
-		numDataPoints = int((field_1-field_init) / (4 * stepSize))
-		fields2Scan_atFreqs[freq] = [round(num, 1) for num in numpy.linspace(field_init, field_1, numDataPoints)]
-		numDataPoints = int((field_2-field_1) / (3 * stepSize))
-		fields2Scan_atFreqs[freq] += [round(num, 1) for num in numpy.linspace(field_1, field_2, numDataPoints)][1:]
-		numDataPoints = int((field_3-field_2) / stepSize)
-		fields2Scan_atFreqs[freq] += [round(num, 1) for num in numpy.linspace(field_2, field_3, numDataPoints)][1:]
-		numDataPoints = int((field_4-field_3) / (3 * stepSize))
-		fields2Scan_atFreqs[freq] += [round(num, 1) for num in numpy.linspace(field_3, field_4, numDataPoints)][1:]
-		numDataPoints = int((field_end-field_4) / (4 * stepSize))
-		fields2Scan_atFreqs[freq] += [round(num, 1) for num in numpy.linspace(field_4, field_end, numDataPoints)][1:]
-		print("Reverse the fields?", reverse)
-		if reverse:
-			fields2Scan_atFreqs[freq] = list(reversed(fields2Scan_atFreqs[freq]))
-		print("At frequency {}GHz: Step Size: {}. Num of steps: {}".format(freq, stepSize, numDataPoints))
-		print("\t", fields2Scan_atFreqs[freq][0:5], ".....", fields2Scan_atFreqs[freq][-5:-1])
-	return fields2Scan_atFreqs
-	
-def generateFieldswithCentersandLinewidths_equalSpace(Hres_atFreqs, linewidth_0, linewidth_1, reverse, fieldStepSize):
-	#We want there to be 10 data points between the peak-peak
-	#For each frequency, there is a set of fields the measurement will scan
-	fields2Scan_atFreqs = {}
-	for freq in Hres_atFreqs:
-		freqs = sorted(list(Hres_atFreqs.keys()))
-		if len(Hres_atFreqs) == 1:
-			DeltaH_pk2pk = linewidth_0
-		else:
-			a, b = freqs[0], freqs[-1]
-			DeltaH_pk2pk = linewidth_0 + (linewidth_1 - linewidth_0) * (freq - a) / (b - a)
-		centerField = Hres_atFreqs[freq]
-		fieldRange = 7 * DeltaH_pk2pk
-		stepSize = fieldStepSize if fieldStepSize else round(DeltaH_pk2pk / 16, 1)
-		field_init, field_end = centerField - 0.5 * fieldRange, centerField + 0.5 * fieldRange
-		numDataPoints = int( (field_end-field_init) / stepSize )
-		#Start making the fields at this frequency
-		fields2Scan_atFreqs[freq] = [round(num, 1) for num in numpy.linspace(field_init, field_end, numDataPoints)]
-		print("Reverse the fields?", reverse)
-		if reverse:
-			fields2Scan_atFreqs[freq] = list(reversed(fields2Scan_atFreqs[freq]))
-		print("At frequency {}GHz: Step Size: {}. Num of steps: {}".format(freq, stepSize, numDataPoints))
-		print("\t", fields2Scan_atFreqs[freq][0:5], ".....", fields2Scan_atFreqs[freq][-5:-1])
-	return fields2Scan_atFreqs
-	
+
 #创建一个固定长度的可以容纳n个字符串的列表。这个列表里面每两个元素为一对，首个元素为时间记录，次个元素为字符串
 class ListLimited:
 	def __init__(self, n):
@@ -276,18 +188,24 @@ class PPMS_FMR_App(wx.Frame):
 					"btn_StartAbort", "btn_ToggleRF", "btn_ToggleACMod",
 					"btn_LockinSensUp", "btn_LockinSensDown", "btn_AutoPhase",
 					"btn_LockinTimeConstUp", "btn_LockinTimeConstDown", 
-					"btn_ReverseField",
-					"btn_SkipRestofFields", ]
+					"btn_ReverseField", "btn_TrackResonance", "btn_AutoRange",
+					"btn_SkipRestofFields", "btn_DryRun", "btn_Resume", ]
 					}
 		#Only have 4 devices, so simply list them below
 		self.ppms = None
 		self.acMod, self.rfPower, self.lockin = None, None, None
 		self.equallySpaceFields = True
 		self.waitTime, self.plotTotal, self.reverseFields = 0.02, False, False
+		self.trackResonance = False #Windows from the spectra measured so far, see resonance_tracker.py
+		self.autoRange = False #Lock-in sensitivity set by the scan, see lockin_control.AutoRange
 		self.rfPower_indBm, self.acCurrent_inmA = 0, 0, 
 		self.skipRestofFields = False
-		self.flag = False #Indicator of whether is a measurement ongoing
-		self.current_job = None
+		self.engine = None #MeasurementEngine of the last measurement started
+		self.events = EventQueue() #Filled by the engine, drained by OnTimer
+		self.livePlot = LivePlot(360, 240)
+		self.io = AsyncIO() #Command queues of the LAN and GPIB buses, shared by the poller and the measurement
+		self.poller = StatusPoller(self, io=self.io) #The GUI only reads self.poller.state
+		self.poller.start()
 		self.logs = ListLimited(8)
 		self.logs.add("ping")
 		self.last_log = ''
@@ -301,7 +219,7 @@ class PPMS_FMR_App(wx.Frame):
 		panel = wx.Panel(self)
 		
 		self.sample_id = wx.TextCtrl(panel, value="Test")
-		self.folder = wx.TextCtrl(panel, value=os.getcwd()+r"\FMR_Data",
+		self.folder = wx.TextCtrl(panel, value=os.path.join(os.getcwd(), "FMR_Data"),
 									size=(350, 50), style=wx.TE_MULTILINE)
 		self.log_text = wx.TextCtrl(panel, value="", size=(350, 200), style=wx.TE_READONLY| wx.TE_MULTILINE)
 		png = wx.Image('ConnectionInstruction.png', wx.BITMAP_TYPE_ANY).ConvertToBitmap()
@@ -315,6 +233,17 @@ class PPMS_FMR_App(wx.Frame):
 		self.linewidth_1_Input = wx.TextCtrl(panel, value="5", size=(40, -1))
 		self.fieldsShift_Input = wx.TextCtrl(panel, value="0", size=(40, -1))
 		self.fieldStepSize_Input = wx.TextCtrl(panel, value="1", size=(40, -1))
+		#How the lock-in is read at every point. See lockin_control.py
+		self.cb_lockinReadMode = wx.ComboBox(panel, value="snap", choices=LockinReadModes, style=wx.CB_READONLY)
+		self.cb_scanMode = wx.ComboBox(panel, value="step", choices=ScanModes, style=wx.CB_READONLY)
+		self.sweepRate_Input = wx.TextCtrl(panel, value="1", size=(40, -1))
+		self.cb_settleMode = wx.ComboBox(panel, value="model", choices=SettleModes, style=wx.CB_READONLY)
+		#Extra sweep axes of the field scans and their order, see sweep_planner.py. Empty keeps the present setting
+		self.cb_sweepOrder = wx.ComboBox(panel, value="given", choices=SweepOrders, style=wx.CB_READONLY)
+		self.rfPowers_Input = wx.TextCtrl(panel, value="", size=(80, -1))
+		self.acCurrents_Input = wx.TextCtrl(panel, value="", size=(80, -1))
+		#From, to and step(G) of a coarse scan that finds the resonances first, see resonance_search.py. Empty: no search
+		self.search_Input = wx.TextCtrl(panel, value="", size=(120, -1))
 		#Text boxes and buttons that change the set points, BUT DON'T IMPLEMENT YET
 		self.fieldSetPoint_Input = wx.TextCtrl(panel, value="0", size=(40, -1))
 		self.tempSetPoint_Input = wx.TextCtrl(panel, value="300", size=(40, -1))
@@ -336,6 +265,8 @@ class PPMS_FMR_App(wx.Frame):
 		self.lbl_waitTime = wx.StaticText(panel, label="Wait Time: ?s")
 		#Buttons that TOGGLES/CHANGES the status of instrument/PPMS
 		self.btn_StartAbort = wx.Button(panel, label="Start", id=self.ids['btn_StartAbort'], size=(50, 30))
+		btn_DryRun = wx.Button(panel, label="Dry run", id=self.ids['btn_DryRun'], size=(60, 30))
+		btn_Resume = wx.Button(panel, label="Resume", id=self.ids['btn_Resume'], size=(60, 30))
 		self.btn_ToggleRF = wx.Button(panel, label="RF Power is OFF", id=self.ids['btn_ToggleRF'])
 		#self.btn_ToggleFieldGenMode = wx.Button(panel, label="Fields are equally spaced", id=self.ids['btn_ToggleFieldGenMode'])
 		self.btn_ToggleACMod = wx.Button(panel, label="AC Mod is OFF", id=self.ids['btn_ToggleACMod'])
@@ -344,6 +275,10 @@ class PPMS_FMR_App(wx.Frame):
 		self.btn_ReverseField = wx.Button(panel, label="Field ascends", id=self.ids['btn_ReverseField'])
 		#self.btn_ToggleFieldGenMode.SetBackgroundColour((0, 255, 0, 255))
 		self.btn_ReverseField.SetBackgroundColour((0, 255, 0, 255))
+		self.btn_TrackResonance = wx.Button(panel, label="Windows as entered", id=self.ids['btn_TrackResonance'])
+		self.btn_TrackResonance.SetBackgroundColour((128, 128, 128, 255))
+		self.btn_AutoRange = wx.Button(panel, label="Lock-in range fixed", id=self.ids['btn_AutoRange'])
+		self.btn_AutoRange.SetBackgroundColour((128, 128, 128, 255))
 		self.btn_SkipRestofFields = wx.Button(panel, label="Skip remaining Fields", id=self.ids['btn_SkipRestofFields'])
 		self.btn_SkipRestofFields.SetBackgroundColour((128, 128, 128, 255))
 		
@@ -366,6 +301,8 @@ class PPMS_FMR_App(wx.Frame):
 		self.Bind(wx.EVT_BUTTON, self.set_Field, id=self.ids['btn_RampField'])
 		self.Bind(wx.EVT_BUTTON, self.set_Temp, id=self.ids['btn_RampTemp'])
 		self.Bind(wx.EVT_BUTTON, self.start_abort, id=self.ids['btn_StartAbort'])
+		self.Bind(wx.EVT_BUTTON, self.dry_run, id=self.ids['btn_DryRun'])
+		self.Bind(wx.EVT_BUTTON, self.resume, id=self.ids['btn_Resume'])
 		self.Bind(wx.EVT_BUTTON, self.toggle_RF, id=self.ids['btn_ToggleRF'])
 		self.Bind(wx.EVT_BUTTON, self.toggle_ACMod, id=self.ids['btn_ToggleACMod'])
 		self.Bind(wx.EVT_BUTTON, lambda e: self.lockin.write("APHS"), id=self.ids['btn_AutoPhase'])
@@ -375,6 +312,8 @@ class PPMS_FMR_App(wx.Frame):
 		self.Bind(wx.EVT_BUTTON, lambda e: self.timeConst_Change(up=False), id=self.ids['btn_LockinTimeConstDown'])
 		#self.Bind(wx.EVT_BUTTON, lambda e: self.toggle_FieldGenMode(), id=self.ids['btn_ToggleFieldGenMode'])
 		self.Bind(wx.EVT_BUTTON, lambda e: self.toggle_ReverseFields(), id=self.ids['btn_ReverseField'])
+		self.Bind(wx.EVT_BUTTON, lambda e: self.toggle_TrackResonance(), id=self.ids['btn_TrackResonance'])
+		self.Bind(wx.EVT_BUTTON, lambda e: self.toggle_AutoRange(), id=self.ids['btn_AutoRange'])
 		self.Bind(wx.EVT_BUTTON, lambda e: self.toggle_SkipRestofFields(), id=self.ids['btn_SkipRestofFields'])
 		
 		"""Arrange the above text input and buttons"""
@@ -420,7 +359,9 @@ class PPMS_FMR_App(wx.Frame):
 		sizer_conn.Add(status_lockin, pos=(3, 2), span=(1, 1), flag=wx.BOTTOM | wx.Left, border=5)
 		sizer_conn.Add(status_PPMS, pos=(4, 0), span=(1, 3), flag=wx.BOTTOM | wx.Left, border=5)
 		
+		sizer_conn.Add(btn_DryRun, pos=(5, 1), span=(1, 1), flag=wx.RIGHT | wx.BOTTOM, border=5)
 		sizer_conn.Add(self.btn_StartAbort, pos=(5, 2), span=(1, 1), flag=wx.RIGHT | wx.BOTTOM, border=5)
+		sizer_conn.Add(btn_Resume, pos=(6, 1), span=(1, 1), flag=wx.RIGHT | wx.BOTTOM, border=5)
 		sizer_conn.Add(self.btn_SkipRestofFields, pos=(6, 2), span=(1, 1), flag=wx.RIGHT | wx.BOTTOM, border=5)
 		sizer_conn.Add(self.log_text, pos=(7, 0), span=(3, 3), flag=wx.LEFT | wx.BOTTOM, border=5)
 		
@@ -453,6 +394,42 @@ class PPMS_FMR_App(wx.Frame):
 						pos=(i+2, 6), span=(1, 1), flag=wx.BOTTOM | wx.Left, border=5)
 		sizer_params.Add(self.fieldStepSize_Input, 
 						pos=(i+2, 7), span=(1, 1), flag=wx.BOTTOM | wx.Left, border=5)
+		sizer_params.Add(wx.StaticText(panel, label="Lock-in read"),
+						pos=(i+3, 1), span=(1, 1), flag=wx.BOTTOM | wx.Left, border=5)
+		sizer_params.Add(self.cb_lockinReadMode,
+						pos=(i+3, 2), span=(1, 2), flag=wx.BOTTOM | wx.Left, border=5)
+		sizer_params.Add(wx.StaticText(panel, label="Scan mode"),
+						pos=(i+3, 4), span=(1, 1), flag=wx.BOTTOM | wx.Left, border=5)
+		sizer_params.Add(self.cb_scanMode,
+						pos=(i+3, 5), span=(1, 1), flag=wx.BOTTOM | wx.Left, border=5)
+		sizer_params.Add(wx.StaticText(panel, label="Sweep rate(G/s)"),
+						pos=(i+3, 6), span=(1, 1), flag=wx.BOTTOM | wx.Left, border=5)
+		sizer_params.Add(self.sweepRate_Input,
+						pos=(i+3, 7), span=(1, 1), flag=wx.BOTTOM | wx.Left, border=5)
+		sizer_params.Add(wx.StaticText(panel, label="Settle"),
+						pos=(i+4, 1), span=(1, 1), flag=wx.BOTTOM | wx.Left, border=5)
+		sizer_params.Add(self.cb_settleMode,
+						pos=(i+4, 2), span=(1, 2), flag=wx.BOTTOM | wx.Left, border=5)
+		sizer_params.Add(wx.StaticText(panel, label="Order"),
+						pos=(i+4, 4), span=(1, 1), flag=wx.BOTTOM | wx.Left, border=5)
+		sizer_params.Add(self.cb_sweepOrder,
+						pos=(i+4, 5), span=(1, 1), flag=wx.BOTTOM | wx.Left, border=5)
+		sizer_params.Add(self.btn_TrackResonance,
+						pos=(i+4, 6), span=(1, 2), flag=wx.BOTTOM | wx.Left, border=5)
+		sizer_params.Add(wx.StaticText(panel, label="RF powers(dBm)"),
+						pos=(i+5, 1), span=(1, 1), flag=wx.BOTTOM | wx.Left, border=5)
+		sizer_params.Add(self.rfPowers_Input,
+						pos=(i+5, 2), span=(1, 2), flag=wx.BOTTOM | wx.Left, border=5)
+		sizer_params.Add(wx.StaticText(panel, label="Mod amplitudes(mA)"),
+						pos=(i+5, 4), span=(1, 1), flag=wx.BOTTOM | wx.Left, border=5)
+		sizer_params.Add(self.acCurrents_Input,
+						pos=(i+5, 5), span=(1, 2), flag=wx.BOTTOM | wx.Left, border=5)
+		sizer_params.Add(wx.StaticText(panel, label="Search from, to, step(G)"),
+						pos=(i+6, 1), span=(1, 1), flag=wx.BOTTOM | wx.Left, border=5)
+		sizer_params.Add(self.search_Input,
+						pos=(i+6, 2), span=(1, 2), flag=wx.BOTTOM | wx.Left, border=5)
+		sizer_params.Add(self.btn_AutoRange,
+						pos=(i+6, 4), span=(1, 2), flag=wx.BOTTOM | wx.Left, border=5)
 		
 		sizer_manual.Add(self.acModFreq_Input, pos=(0, 0), span=(1, 1), flag=wx.BOTTOM | wx.Left, border=5)
 		sizer_manual.Add(wx.StaticText(panel, label="Hz"),
@@ -518,19 +495,19 @@ class PPMS_FMR_App(wx.Frame):
 		self.rfPower, self.acMod, self.lockin = None, None, None
 		
 	def connect(self, e):
-		try: self.acMod = connect(self.cb_acMod.GetValue(), logs=self.logs)
+		try: self.acMod = guarded(connect(self.cb_acMod.GetValue(), logs=self.logs), "6221")
 		except Exception as e:
 			self.acMod = None
 			print(e)
-		try: self.rfPower = connect(self.cb_rfPower.GetValue(), logs=self.logs)
+		try: self.rfPower = guarded(connect(self.cb_rfPower.GetValue(), logs=self.logs), "N5183")
 		except Exception as e:
 			self.rfPower = None
 			print(e)
-		try: self.lockin = connect(self.cb_lockin.GetValue(), logs=self.logs)
+		try: self.lockin = guarded(connect(self.cb_lockin.GetValue(), logs=self.logs), "SR830")
 		except Exception as e:
 			self.lockin = None
 			print(e)
-		try: self.ppms = connect2PPMS()
+		try: self.ppms = lockPPMS(TracedInstrument(connect2PPMS(), "PPMS"))
 		except: self.logs.add("Attempt to ping the PPMS computer failed.")
 		
 		self.update_indicator()
@@ -578,25 +555,41 @@ class PPMS_FMR_App(wx.Frame):
 			self.btn_ReverseField.SetLabel("Fields ascends")
 			self.btn_ReverseField.SetBackgroundColour((0, 255, 0, 255))
 			
+	def toggle_TrackResonance(self):
+		self.trackResonance = not self.trackResonance
+		if self.trackResonance:
+			self.btn_TrackResonance.SetLabel("Windows track resonance")
+			self.btn_TrackResonance.SetBackgroundColour((0, 255, 0, 255))
+		else:
+			self.btn_TrackResonance.SetLabel("Windows as entered")
+			self.btn_TrackResonance.SetBackgroundColour((128, 128, 128, 255))
+			
+	def toggle_AutoRange(self):
+		self.autoRange = not self.autoRange
+		if self.autoRange:
+			self.btn_AutoRange.SetLabel("Lock-in auto range")
+			self.btn_AutoRange.SetBackgroundColour((0, 255, 0, 255))
+		else:
+			self.btn_AutoRange.SetLabel("Lock-in range fixed")
+			self.btn_AutoRange.SetBackgroundColour((128, 128, 128, 255))
+			
 	def toggle_SkipRestofFields(self):
 		self.skipRestofFields = not self.skipRestofFields
+		if self.engine: self.engine.skipRest(self.skipRestofFields)
 		if self.skipRestofFields:
 			self.btn_SkipRestofFields.SetBackgroundColour((255, 0, 0, 255))
 		else:
 			self.btn_SkipRestofFields.SetBackgroundColour((128, 128, 128, 255))
 			
 	"""For manual control of the system"""
-	def updateDisp_Lockin(self):
-		self.lbl_LockinFreq.SetLabel("Lock-in Freq:\n {} Hz".format(self.lockin.query("FREQ?").replace('\n', '')))
-		channX = float(self.lockin.query("OUTP? 1"))
-		channY = float(self.lockin.query("OUTP? 2"))
-		self.lbl_LockinReading.SetLabel("Lock-in:\nX {}\nY {}".format(channX, channY))
-		sens = int(self.lockin.query("SENS?").replace('\n', ''))
-		timeConst_i = int(self.lockin.query("OFLT?").replace('\n', ''))
-		self.lbl_LockinSens.SetLabel("Lockin Sens: {}".format(Sensitivity_Index[sens]))
-		self.lbl_lockinTConst.SetLabel("Time Const: {}".format(TimeConst_Index[timeConst_i]))
-		self.waitTime = round(float(TConstNum_Index[timeConst_i]) * TimeConst_WaitTime_Conversion, 2)
-		self.lbl_waitTime.SetLabel("Wait Time: {}s".format(self.waitTime))
+	def updateDisp_Lockin(self, state): #state is the snapshot of the status poller
+		if state.lockinFreq is not None: self.lbl_LockinFreq.SetLabel("Lock-in Freq:\n {} Hz".format(state.lockinFreq))
+		if state.X is not None: self.lbl_LockinReading.SetLabel("Lock-in:\nX {}\nY {}".format(state.X, state.Y))
+		if state.sensitivity is not None: self.lbl_LockinSens.SetLabel("Lockin Sens: {}".format(Sensitivity_Index[state.sensitivity]))
+		if state.timeConst is not None:
+			self.lbl_lockinTConst.SetLabel("Time Const: {}".format(TimeConst_Index[state.timeConst]))
+			self.waitTime = round(float(TConstNum_Index[state.timeConst]) * TimeConst_WaitTime_Conversion, 2)
+			self.lbl_waitTime.SetLabel("Wait Time: {}s".format(self.waitTime))
 		
 	def sens_Change(self, up=True):
 		sensitivity = int(self.lockin.query("SENS?").replace('\n', ''))
@@ -614,13 +607,11 @@ class PPMS_FMR_App(wx.Frame):
 		self.waitTime = round(float(TConstNum_Index[timeConst_i]) * TimeConst_WaitTime_Conversion, 2)
 		self.lbl_waitTime.SetLabel("Wait Time: {}s".format(self.waitTime))
 		
-	def updateDisp_Field(self): #self.ppms.getField() returns a tuple, with the 2nd element the field
-		field = round(self.ppms.getField()[1], 1)
-		self.lbl_Field.SetLabel("PPMS Field: {} G".format(field))
+	def updateDisp_Field(self, state):
+		if state.field is not None: self.lbl_Field.SetLabel("PPMS Field: {} G".format(round(state.field, 1)))
 		
-	def updateDisp_Temp(self):
-		temp = round(self.ppms.getTemperature()[1], 2)
-		self.lbl_Temp.SetLabel("PPMS Temp: {} K".format(temp))
+	def updateDisp_Temp(self, state):
+		if state.temperature is not None: self.lbl_Temp.SetLabel("PPMS Temp: {} K".format(round(state.temperature, 2)))
 		
 	def updateDisp_rfFreqandPower(self):
 		realSetFreq = round(float(self.rfPower.query("FREQ?").strip()) / 1e9, 1)
@@ -714,175 +705,102 @@ class PPMS_FMR_App(wx.Frame):
 			self.logs.add("Ramping temperature failed.")
 			
 	"""Prepare and perform measurement"""
-	def prepareFieldstoScan(self):
-		#Generate dictionary from the Hres vs freqs text box
-		Hres_vs_freqs = self.FreqsandFields_Input.GetValue().split(',')
-		shift = round(float(self.fieldsShift_Input.GetValue()))
-		dict = {}
-		try:
-			for pair in Hres_vs_freqs: #pair is string '3: 480'
-				try: freq, Hres = pair.split(':')
-				except:
-					print("':' is missing")
-					raise
-				freq, Hres = float(freq.strip()), float(Hres.strip())
-				dict[freq] = Hres + shift
-				try:
-					linewidth_0 = round(float(self.linewidth_0_Input.GetValue())) #Only read in interger linewidth
-					linewidth_1 = round(float(self.linewidth_1_Input.GetValue()))
-				except:
-					print("Initial or final linewidth is wrong")
-					return False
-			#With the dict = {Freq: Hres}, combined with initial linewidth and final linewidth, 
-				#create the {Freq: [field1, field2...]} for each freq to scan
-			print(dict, linewidth_0, linewidth_1)
-			#If all field values are negative, then reverse the order of field generated.
-			try:
-				fieldStepSize = round(float(self.fieldStepSize_Input.GetValue()), 1)
-				if self.equallySpaceFields:
-					fields2Scan_atFreqs = generateFieldswithCentersandLinewidths_equalSpace(dict, linewidth_0, linewidth_1, self.reverseFields, fieldStepSize)
-				else:
-					fields2Scan_atFreqs = generateFieldswithCentersandLinewidths_DenseatCenter(dict, linewidth_0, linewidth_1, self.reverseFields, fieldStepSize)
-			except:
-				print("Failed to generate the final fields to scan dictionary")
-				return False
-			return fields2Scan_atFreqs
-		except Exception as e:
-			print("Can't Create dictionary of {Freq: Hres}")
-			print(e)
-			return False
+	def scanPlan(self):
+		"""The ScanPlan from the inputs. Read here on the GUI thread, the engine never touches a widget"""
+		return ScanPlan.fromText(self.sample_id.GetValue(), self.folder.GetValue(), self.TempsandShifts_Input.GetValue(),
+								self.FreqsandFields_Input.GetValue(), (self.linewidth_0_Input.GetValue(), self.linewidth_1_Input.GetValue()),
+								self.fieldStepSize_Input.GetValue(), self.fieldsShift_Input.GetValue(),
+								reverse=self.reverseFields, equallySpace=self.equallySpaceFields, scanMode=self.cb_scanMode.GetValue(),
+								readMode=self.cb_lockinReadMode.GetValue(), settleMode=self.cb_settleMode.GetValue(),
+								sweepRate=float(self.sweepRate_Input.GetValue()), plotTotal=self.plotTotal, waitTime=self.waitTime,
+								powers=self.rfPowers_Input.GetValue(), currents=self.acCurrents_Input.GetValue(), order=self.cb_sweepOrder.GetValue(),
+								track=self.trackResonance, search=self.search_Input.GetValue(),
+								autoRange=self.autoRange)
 			
 	def start_abort(self, e):
-		if self.current_job is None or not self.current_job.is_alive():
+		if self.engine is None or not self.engine.isAlive():
+			try: plan = self.scanPlan()
+			except ValueError as error:
+				print("Parameter input incorrect. Please inspect, then try again.\n", error)
+				self.logs.add("Parameter input incorrect: {}".format(error))
+				return
 			self.logs.add("start measurement")
-			self.flag = True
 			self.btn_StartAbort.SetLabel("Abort")
-			self.current_job = MyThread(self.do_measurement)
-			self.current_job.start()
+			if self.skipRestofFields: self.toggle_SkipRestofFields()
+			self.engine = MeasurementEngine(self.ppms, self.lockin, self.rfPower, self.acMod, self.livePlot, self.poller, self.events, self.io)
+			self.engine.start(plan)
 		else:
-			self.flag = False #Set the flag to False to notify other parts of the stop
+			self.engine.abort() #The engine stops at the next point, OnTimer sets the label back
 			self.btn_StartAbort.SetLabel("Stopping")
 			self.logs.add("Manually stopped measurement")
-			wx.CallAfter(lambda: wx.GetApp().Yield())
-			print("Stop 1 reached")
-			wx.CallAfter(lambda: self.current_job.join())
-			print("Stop 2 reached")
-			wx.CallAfter(lambda: self.logs.add("measurement stopped"))
 			
-	#只是把self.current_job设置为一个新的Thread
-	def do_measurement(self):
-		"""Read the Hres at various frequencies and the initial linewidth(peak 2 peak) and final linewidth"""
-		temps_to_shifts, s = {}, self.TempsandShifts_Input.GetValue()
-		print("Reading temperatures you want to scan at", s)
-		if s:
-			try:
-				for temp_shift in s.split(","):
-					s_temp, s_shift = temp_shift.split(":")
-					temps_to_shifts[round(float(s_temp), 1)] = round(float(s_shift), 1)
-			except SyntaxError as e:
-				print("Temperature input is incorrect. Please inspect, then try again.\n", e)
-				return
-
-		if not temps_to_shifts:
-			print("Failed to read any temperatures. Using the current temp")
-			temps_to_shifts = {round(float(self.ppms.getTemperature()[1]), 1): round(
-								float(self.fieldsShift_Input.GetValue()), 1)}
-
-		print("\n--------------Measurements at temperatures with shifts:", temps_to_shifts, "\n--------------")
-		for i, (temp, shift) in enumerate(temps_to_shifts.items()):
-			if i % 2: self.toggle_ReverseFields()
-			self.fieldsShift_Input.SetValue("{}".format(shift))
-			if temp != round(self.ppms.getTemperature()[1], 1):
-				self.ppms.setTemperature(temp)
-				print("Going to set temperature {}K. Waiting to stabilize".format(temp))
-				self.ppms.waitForTemperature()
-				print("Stabilized at {}K. Starting measurement".format(temp))
-
-			fields2Scan_atFreqs = self.prepareFieldstoScan()
-			sampleID = self.sample_id.GetValue()
-			folderName = self.folder.GetValue()+"\\%s"%sampleID
-			temp = round(float(self.ppms.getTemperature()[1]), 1)
-			if not temps_to_shifts or not fields2Scan_atFreqs:
-				print("Parameter input incorrect. Please inspect, then try again.")
-				return
-			else:
-				self.logs.add("Start scanning fields at various freqs")
-				self.logs.add("Freqs: {}".format(fields2Scan_atFreqs.keys()))
-				freqs = sorted(list(fields2Scan_atFreqs.keys()))
-				if self.reverseFields: freqs = freqs[::-1]
-				for freq in freqs:
-					if not self.flag: return
-					fields = fields2Scan_atFreqs[freq]
-					self.logs.add("Scanning at Freq {} GHz".format(freq))
-					self.rfPower.write(":SOUR:FREQ:CW {}GHz".format(freq))
-					self.updateDisp_rfFreqandPower()
-					ctrIndex = int(len(fields) / 2)
-					self.logs.add("Initial field {}, final field {} and stepSize {}".format(fields[0], fields[-1], fields[ctrIndex]-fields[ctrIndex-1]))
-					filename = "{}_{}K_{}GHz_{}dBm_{}mA.csv".format(sampleID, int(temp), str(freq).replace('.', 'p'),
-																	self.rfPower_indBm, str(self.acCurrent_inmA).replace('.', 'p')
-																	)
-					filename = os.path.join(folderName, filename)
-					paramSumFilename = os.path.join(folderName, "{}_{}K.txt".format(sampleID, temp))
-					with open(filename, "w") as file:
-						file.write("Temp(K),RF Freq(GHz),Field(G),Lockin_X_Ave,Lockin_Y_Ave,TimeConst\n")
-					#Need to go to the first field and make it settle for a few seconds
-					self.ppms.setField(fields[0], 100)
-					self.ppms.waitForField(timeout=240)
-					print("Start the field scan at {}".format(self.ppms.getField()[1]))
-					fieldsActual, channXs_Ave = [], []
-					i = 1
-					for field in fields:
-						if not self.flag: return #Abort the measurement
-						if self.skipRestofFields: #If enabled, the rest of the field points at this freq will skipped.
-							print("Will skip the rest of the fields")
-							self.logs.add("Finish the field scan early as user needs")
-							self.skipRestofFields = False
-							self.btn_SkipRestofFields.SetBackgroundColour((128, 128, 128, 255))
-							break
-						self.ppms.setField(field, 100)
-						ave_1, ave_2 = lockinRead(self.lockin, waitTime=self.waitTime)
-						fieldsActual.append(self.ppms.getField()[1])
-						channXs_Ave.append(ave_1)
-						with open(filename, 'a') as file:
-							file.write("{},{},{},{},{},{}\n".format(temp, freq, field, ave_1, ave_2, self.waitTime / TimeConst_WaitTime_Conversion))
-						i += 1
-						if i % 2 == 1:
-							self.pic_string = [plotandSave(filename, self.plotTotal)]
+	def resume(self, e):
+		"""Continue the interrupted run of Sample ID in Folder with the plan of its journal, skipping what is on disk"""
+		if self.engine is not None and self.engine.isAlive(): return
+		journal = RunJournal(os.path.join(self.folder.GetValue(), self.sample_id.GetValue()))
+		if not journal.exists():
+			self.logs.add("No run to resume in {}".format(os.path.dirname(journal.path)))
+			return
+		plan = ScanPlan.fromDict(journal.load().state["plan"])
+		self.logs.add("Resume measurement started {}".format(datetime.fromtimestamp(journal.state["started"]).strftime("%Y-%m-%d %H:%M")))
+		self.btn_StartAbort.SetLabel("Abort")
+		if self.skipRestofFields: self.toggle_SkipRestofFields()
+		self.engine = MeasurementEngine(self.ppms, self.lockin, self.rfPower, self.acMod, self.livePlot, self.poller, self.events, self.io)
+		self.engine.start(plan, resume=True)
+			
+	def dry_run(self, e):
+		"""Log how long the plan will take, calibrated on the traces of the past runs in the data folder"""
+		try: plan = self.scanPlan()
+		except ValueError as error:
+			self.logs.add("Parameter input incorrect: {}".format(error))
+			return
+		model = calibrate(plan.folder) if os.path.isdir(plan.folder) else None
+		state = self.poller.state #Start from where the PPMS and the sources are now
+		temp = round(state.temperature, 1) if state.temperature is not None else None
+		result = estimate(plan, model, startTemp=temp, startField=state.field,
+						startPower=state.rfPower, startCurrent=state.acAmplitude)
+		print(formatEstimate(result))
+		self.logs.add("Dry run: {} scans, {} points, about {:.1f} h".format(result["scans"], result["points"], result["total"] / 3600))
+			
+	def applyEvents(self):
+		"""Show what the engine published since the last timer tick"""
+		for kind, data in self.events.drain():
+			if kind == "log": self.logs.add(data["text"])
+			elif kind == "shift": self.fieldsShift_Input.SetValue("{}".format(data["shift"]))
+			elif kind == "reverse":
+				if data["reverse"] != self.reverseFields: self.toggle_ReverseFields()
+			elif kind == "skipped":
+				self.skipRestofFields = False
+				self.btn_SkipRestofFields.SetBackgroundColour((128, 128, 128, 255))
+			elif kind == "rf": self.lbl_RFPower.SetLabel("RF Power: {} GHz {} dBm".format(data["freq"], data["power"]))
+			elif kind == "progress":
+				self.SetTitle("PPMS FMR Measurement - {}K {}GHz {}/{}".format(data["temp"], data["freq"], data["done"], data["total"]))
+			elif kind == "finished":
+				self.logs.add("measurement stopped" if data["aborted"] else "measurement finished")
+				self.SetTitle("PPMS FMR Measurement")
 
-					self.logs.add("Move on to next freq in 2s")
-					time.sleep(2)
-				
 	def OnTimer(self, e):
-		try: #把self.pic设置为一个新的图片
-			png = wx.Image(self.pic_string[0], wx.BITMAP_TYPE_ANY).ConvertToBitmap()
-			png = scale_bitmap(png, 360, 240)
-			self.pic.SetBitmap(png)
+		try: #Only redraws the live plot when new points came in, straight from memory to the bitmap
+			frame = self.livePlot.render()
+			if frame:
+				width, height, rgba = frame
+				self.pic.SetBitmap(wx.Bitmap.FromBufferRGBA(width, height, rgba))
 		except Exception as e:
-			pass
+			print("Live plot failed:", e)
+		self.applyEvents()
 		#如果程序线程还没有设置，或者说这个线程已经运行结束，则允许重新开始
-		if not self.current_job or not self.current_job.is_alive():
+		if not self.engine or not self.engine.isAlive():
 			self.btn_StartAbort.SetLabel("Start")
-		if self.ppms:
-			self.updateDisp_Field()
-			self.updateDisp_Temp()
-			self.updateDisp_Lockin()
+		state = self.poller.state #No instrument I/O on the GUI thread
+		self.updateDisp_Field(state)
+		self.updateDisp_Temp(state)
+		self.updateDisp_Lockin(state)
 			
 		if not self.last_log == self.logs.last():
 			self.log_text.SetValue("\n".join(self.logs.list))
 			self.last_log = self.logs.last()
 			
 			
-class MyThread(threading.Thread):
-	def __init__(self, job):
-		threading.Thread.__init__(self)
-		self.job = job
-		
-	def run(self):
-		print("Starting measurement")
-		self.job()
-		print("Measurement stopped ")
-		
-		
 if __name__ == '__main__':
 	app = wx.App()
 	ex = PPMS_FMR_App(None, title="PPMS FMR Measurement")
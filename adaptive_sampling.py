@@ -0,0 +1,94 @@
+"""Fit-guided choice of the field points within a scan.
+
+AdaptiveSampler measures a coarse subset of the field grid first, then refits singleLorentzian after
+every point and picks the next field among the remaining grid fields where one more point reduces the
+uncertainty of Hres and dH the most. It stops when both are known to `precision` x linewidth.
+    sampler = AdaptiveSampler(fields)
+    for field in sampler:
+        ...measure...
+        sampler.add(field, X)
+"""
+import numpy as np
+from scipy.optimize import curve_fit
+from Common_FuncsClasses import singleLorentzian, singleLorentzian_jac, peakToPeakGuess
+
+HRES, DH = 0, 3 #Indices of Hr1 and dH1 in the parameters of singleLorentzian
+
+
+def fitSingleLorentzian(fields, signal, p0=None):
+    """Returns (params, covariance, noise variance) or None if the fit fails"""
+    fields, signal = np.asarray(fields, dtype=float), np.asarray(signal, dtype=float)
+    if p0 is None:
+        Hres, sym, antiSym, dH, H1, H2, signal_max, signal_min = peakToPeakGuess(fields, signal)
+        if H1 > H2: antiSym = -antiSym #The max of the derivative is above the resonance
+        p0 = [Hres, sym, antiSym, max(dH, 1e-3), 0.5 * (signal_max + signal_min)]
+    try:
+        params, cov = curve_fit(singleLorentzian, fields, signal, p0=p0, jac=singleLorentzian_jac, maxfev=2000)
+    except (RuntimeError, ValueError):
+        return None
+    if not np.all(np.isfinite(cov)): return None
+    dof = max(1, len(fields) - len(params))
+    noise = np.sum((singleLorentzian(fields, *params) - signal) ** 2) / dof
+    return params, cov, noise
+
+
+def modelJacobian(fields, params):
+    """d singleLorentzian / d params at every field, shape (len(fields), len(params))"""
+    return singleLorentzian_jac(np.asarray(fields, dtype=float), *params)
+
+
+class AdaptiveSampler:
+    def __init__(self, fields, coarsePoints=12, precision=0.03, minPoints=8, maxPoints=None):
+        self.grid = list(fields)
+        self.precision, self.minPoints = precision, minPoints
+        self.maxPoints = maxPoints or len(self.grid)
+        indices = np.unique(np.linspace(0, len(self.grid) - 1, min(coarsePoints, len(self.grid))).round().astype(int))
+        self.pending = [self.grid[i] for i in indices] #Coarse points, in the order of the grid
+        self.measuredFields, self.signal = [], []
+        self.fit, self.converged = None, False
+
+    def __iter__(self):
+        while True:
+            field = self.next()
+            if field is None: return
+            yield field
+
+    def add(self, field, signal):
+        self.measuredFields.append(field)
+        self.signal.append(signal)
+        if len(self.measuredFields) >= self.minPoints and not self.pending:
+            p0 = self.fit[0] if self.fit else None
+            self.fit = fitSingleLorentzian(self.measuredFields, self.signal, p0) or \
+                       fitSingleLorentzian(self.measuredFields, self.signal)
+            self.converged = self._converged()
+
+    def errors(self):
+        """Standard errors of Hres and dH from the last fit"""
+        if not self.fit: return np.inf, np.inf
+        cov = self.fit[1]
+        return np.sqrt(cov[HRES, HRES]), np.sqrt(cov[DH, DH])
+
+    def _converged(self):
+        if not self.fit: return False
+        params = self.fit[0]
+        HresErr, dHErr = self.errors()
+        target = self.precision * abs(params[DH])
+        return HresErr < target and dHErr < target and min(self.grid) < params[HRES] < max(self.grid)
+
+    def next(self):
+        if self.pending: return self.pending.pop(0)
+        if self.converged or len(self.measuredFields) >= self.maxPoints: return None
+        measured = set(self.measuredFields)
+        candidates = np.array([f for f in self.grid if f not in measured], dtype=float)
+        if not len(candidates): return None
+        if not self.fit: #No usable fit yet: fill the largest gap between measured fields
+            measured = np.sort(np.array(self.measuredFields, dtype=float))
+            gaps = np.array([np.min(np.abs(measured - c)) for c in candidates])
+            return float(candidates[gaps.argmax()])
+        params, cov, noise = self.fit
+        #Adding a point with gradient j reduces the variance of parameter k by (cov j)_k^2 / (noise + j.cov.j)
+        J = modelJacobian(candidates, params)
+        covJ = J @ cov
+        denominator = noise + np.einsum("ij,ij->i", covJ, J)
+        gain = covJ[:, HRES] ** 2 / cov[HRES, HRES] + covJ[:, DH] ** 2 / cov[DH, DH]
+        return float(candidates[np.argmax(gain / denominator)])
@@ -0,0 +1,120 @@
+"""asyncio layer over the instruments, with one command queue per bus.
+
+The PPMS is on the LAN and the SR830, N5183 and 6221 share the GPIB board, so a getField() can be on
+its way while the lock-in answers a query. Every bus runs its commands one at a time in the order they
+were queued; different buses run at the same time. The waits (asyncio sleeps, waitForField,
+waitForTemperature) are awaitables and hold up neither bus.
+    io = AsyncIO()
+    ppms, lockin = io.instrument(app.ppms, "LAN"), io.instrument(app.lockin)   #the bus of a pyvisa resource is found from its name
+    (err, field, status), snap = io.run(asyncio.gather(ppms.getField(), lockin.query("SNAP? 1,2")))
+run() blocks the calling thread (GUI poller, measurement) until the coroutine is done, submit() does not.
+The status poller polls every instrument in one gather, and the fixed settle of a stepped scan reads the
+field back during the lock-in read (AsyncSettle).
+"""
+import asyncio, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from settle_scheduler import FixedSettle
+
+WaitMethods = ("waitForField", "waitForTemperature") #Dynacool calls that only block the caller, see lockPPMS
+
+
+def busOf(instrument, default="GPIB0"):
+    """Bus of a pyvisa resource from its name, e.g. GPIB0 of GPIB0::8::INSTR"""
+    try: name = instrument.resource_name
+    except AttributeError: return default
+    return str(name).split("::")[0] if name else default
+
+
+class Bus:
+    """Command queue of one bus: a single worker thread runs the calls in order"""
+    def __init__(self, name):
+        self.name, self.calls = name, 0
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="bus " + name)
+
+    async def call(self, func, *args, **kwargs):
+        self.calls += 1
+        return await asyncio.get_running_loop().run_in_executor(self.executor, lambda: func(*args, **kwargs))
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+class AsyncInstrument:
+    """Coroutine versions of all methods of instrument (a pyvisa resource, the Dynacool, or their
+    LockedInstrument/TracedInstrument wrappers), queued on bus"""
+    def __init__(self, io, instrument, bus):
+        self.io, self.instrument, self.bus = io, instrument, bus
+
+    def __getattr__(self, name):
+        attribute = getattr(self.instrument, name)
+        if not callable(attribute): return attribute
+        if name in WaitMethods:
+            async def wait(*args, **kwargs):
+                return await asyncio.get_running_loop().run_in_executor(None, lambda: attribute(*args, **kwargs))
+            return wait
+        async def queued(*args, **kwargs):
+            return await self.bus.call(attribute, *args, **kwargs)
+        return queued
+
+
+class AsyncIO:
+    """The event loop, on its own thread, and the buses. clock: time, or the SimClock of fmr_simulator"""
+    def __init__(self, clock=time):
+        self.clock = clock
+        self.buses = {}
+        self._lock = threading.Lock()
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="async io", daemon=True)
+        self.thread.start()
+
+    def bus(self, name):
+        with self._lock:
+            if name not in self.buses: self.buses[name] = Bus(name)
+            return self.buses[name]
+
+    def instrument(self, instrument, bus=None):
+        """AsyncInstrument of instrument on bus (default: from its resource name), None if not connected"""
+        if instrument is None: return None
+        return AsyncInstrument(self, instrument, self.bus(bus or busOf(instrument)))
+
+    def submit(self, coroutine):
+        """concurrent.futures.Future of the coroutine, run on the loop"""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def run(self, coroutine, timeout=None):
+        return self.submit(coroutine).result(timeout)
+
+    async def sleep(self, seconds, category="settling"):
+        """category: what a SimClock books the wait under"""
+        if seconds <= 0: return
+        if self.clock is time: await asyncio.sleep(seconds)
+        else: await asyncio.get_running_loop().run_in_executor(None, self.clock.sleep, seconds, category)
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        for bus in self.buses.values(): bus.close()
+
+
+class AsyncSettle:
+    """FixedSettle.step with the field read back on the LAN while the lock-in is read on its bus,
+    instead of after the read. The read itself is one job on the lock-in's bus. Other settle kinds
+    are passed through: SettleScheduler already commands and reads the magnet during the read"""
+    def __init__(self, io, settle, ppms, lockin):
+        self.io, self.settle = io, settle
+        self.ppms, self.lockin = io.instrument(ppms, "LAN"), io.instrument(lockin)
+
+    def reset(self):
+        self.settle.reset()
+
+    def step(self, ppms, reader, field, nextField=None):
+        if not isinstance(self.settle, FixedSettle): return self.settle.step(ppms, reader, field, nextField)
+        return self.io.run(self._step(reader, field))
+
+    async def _step(self, reader, field):
+        await self.ppms.setField(field, self.settle.rate)
+        async def fieldDuringRead(): #At the end of the settle, when the first sample is taken
+            await self.io.sleep(self.settle.waitTime, "overlapped")
+            return (await self.ppms.getField())[1]
+        (x, y, xErr, yErr), fieldActual = await asyncio.gather(self.lockin.bus.call(reader.read, waitTime=self.settle.waitTime),
+                                                               fieldDuringRead())
+        return fieldActual, x, y, xErr, yErr
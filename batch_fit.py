@@ -0,0 +1,145 @@
+"""Lineshape fits of every field scan in a folder tree, on all CPU cores.
+
+Each csv is read with loadCSVandPreprocess, and its peak-to-peak guesses seed the fits of all models in
+FitModels. The model with the lowest information criterion (BIC by default, or AICc) wins, and one row
+per spectrum goes into a single results table (fit_results.csv in the folder). Running it again only
+fits the spectra whose csv is new or changed (size or modification time), the other rows are kept.
+    python batch_fit.py "D:\\Data\\LSC441" --workers 8
+BIC is the default because AICc often lets doubleLorentzians fit a noise bump of a single resonance.
+"""
+import argparse, os, time, warnings
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from scipy.optimize import curve_fit, OptimizeWarning
+from Common_FuncsClasses import loadCSVandPreprocess, peakToPeakGuess, Jacobians, \
+    singleLorentzian, singleLorentz_LinBg, singleLorentz_AsymBg, doubleLorentzians
+
+#Name: (function, parameter names). Fitted in this order, later models start from the earlier fits
+FitModels = {"singleLorentzian": (singleLorentzian, ["Hr1", "Sym1", "AntiSym1", "dH1", "C"]),
+             "singleLorentz_LinBg": (singleLorentz_LinBg, ["Hr1", "Sym1", "AntiSym1", "dH1", "C", "slope"]),
+             "singleLorentz_AsymBg": (singleLorentz_AsymBg, ["Hr1", "Sym1", "AntiSym1", "dH1", "Hr2", "AntiSym2", "dH2", "C"]),
+             "doubleLorentzians": (doubleLorentzians, ["Hr1", "Hr2", "Sym1", "AntiSym1", "Sym2", "AntiSym2", "dH1", "dH2", "C"]),
+             }
+Criteria = ["bic", "aicc"]
+ResultsFile = "fit_results.csv"
+
+
+def informationCriterion(rss, n, k, criterion="bic"):
+    """Least squares AICc or BIC of a fit with k parameters to n points. Lower is better"""
+    if rss <= 0 or n <= k + 1: return np.inf
+    logLikelihood = n * np.log(rss / n)
+    if criterion == "bic": return logLikelihood + k * np.log(n)
+    return logLikelihood + 2 * k + 2 * k * (k + 1) / (n - k - 1)
+
+
+def initialGuesses(fields, lockin, Hres, sym, antiSym, dH, H1, H2, signal_max, signal_min, fits):
+    """p0 of every model. fits holds the parameters of the models fitted already"""
+    if H1 > H2: antiSym = -antiSym #The max of the derivative is below the resonance for AntiSym > 0
+    single = list(fits.get("singleLorentzian", [Hres, sym, antiSym, max(dH, 1e-3), 0.5 * (signal_max + signal_min)]))
+    Hr1, Sym1, AntiSym1, dH1, C = single
+    #Second resonance: peak-to-peak guess on what the single Lorentzian leaves
+    rest = lockin - singleLorentzian(fields, *single)
+    Hr2, sym2, antiSym2, dH2, H1_2, H2_2 = peakToPeakGuess(fields, rest)[:6]
+    if H1_2 > H2_2: antiSym2 = -antiSym2
+    broad = 5 * dH1
+    return {"singleLorentzian": single,
+            "singleLorentz_LinBg": single + [0.0],
+            "singleLorentz_AsymBg": [Hr1, Sym1, AntiSym1, dH1, Hr1, 0.1 * AntiSym1 * (broad / dH1) ** 3, broad, C],
+            "doubleLorentzians": [Hr1, Hr2, Sym1, AntiSym1, sym2, antiSym2, dH1, max(dH2, 1e-3), C]}
+
+
+def fitModels(fields, lockin, guesses, models=tuple(FitModels), criterion="bic"):
+    """{model: (params, errors, rss, criterion value)} of the fits that converged"""
+    results, fits = {}, {}
+    for name in models:
+        function, paramNames = FitModels[name]
+        p0 = initialGuesses(fields, lockin, *guesses, fits)[name]
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", OptimizeWarning)
+                params, cov = curve_fit(function, fields, lockin, p0=p0, jac=Jacobians[function], maxfev=5000)
+        except (RuntimeError, ValueError):
+            continue
+        rss = float(np.sum((function(fields, *params) - lockin) ** 2))
+        errors = np.sqrt(np.abs(np.diag(cov))) if np.all(np.isfinite(cov)) else np.full(len(params), np.nan)
+        fits[name] = list(params)
+        results[name] = (params, errors, rss, informationCriterion(rss, len(fields), len(params), criterion))
+    return results
+
+
+def fitFile(path, models=tuple(FitModels), criterion="bic"):
+    """One row of the results table. Runs in the worker processes"""
+    folder, file = os.path.split(path)
+    stat = os.stat(path)
+    row = {"File": path, "Size": stat.st_size, "MTime": stat.st_mtime_ns}
+    try:
+        freq, temp, fields, lockin, *guesses = loadCSVandPreprocess(folder, file)
+        row.update({"Temp(K)": float(temp), "RF Freq(GHz)": float(freq), "Points": len(fields)})
+        mask = np.isfinite(fields) & np.isfinite(lockin)
+        fields, lockin = fields[mask].astype(float), lockin[mask].astype(float)
+        results = fitModels(fields, lockin, guesses, models, criterion)
+    except Exception as e:
+        row["Error"] = "{}: {}".format(type(e).__name__, e)
+        return row
+    if not results:
+        row["Error"] = "No model converged"
+        return row
+    best = min(results, key=lambda name: results[name][3])
+    params, errors, rss, value = results[best]
+    row.update({"Model": best, "RSS": rss})
+    for name in results: row["{}_{}".format(criterion.upper(), name)] = results[name][3]
+    for name, value, error in zip(FitModels[best][1], params, errors):
+        row[name], row[name + "_err"] = value, error
+    row["dH1"] = abs(row["dH1"]) #Only dH1 squared enters the models
+    return row
+
+
+def findSpectra(root):
+    """The field scan csv files under root. Frequency scans (named ..._<field>G_...) and the coarse scans of
+    a resonance search are left out"""
+    spectra = []
+    for folder, dirs, files in os.walk(root):
+        for file in sorted(files):
+            if file.endswith(".csv") and file != ResultsFile and "GHz" in file and not file.endswith("_search.csv"):
+                spectra.append(os.path.join(folder, file))
+    return spectra
+
+
+def batchFit(root, output=None, models=tuple(FitModels), criterion="bic", workers=None, refit=False):
+    """Fit every new or changed spectrum under root and update the results table. Returns the table"""
+    if criterion not in Criteria: raise ValueError("Unknown criterion {}".format(criterion))
+    output = output or os.path.join(root, ResultsFile)
+    models = [name for name in FitModels if name in models] #The later models start from the earlier fits
+    workers = workers or os.cpu_count() or 1
+    spectra = findSpectra(root)
+    old = pd.read_csv(output) if os.path.exists(output) and not refit else pd.DataFrame(columns=["File", "Size", "MTime"])
+    old = old[old["File"].isin(spectra)] #Files that were deleted drop out of the table
+    known = {row.File: (row.Size, row.MTime) for row in old.itertuples()}
+    todo = []
+    for path in spectra:
+        stat = os.stat(path)
+        if known.get(path) != (stat.st_size, stat.st_mtime_ns): todo.append(path)
+    print("{} spectra, {} new or changed".format(len(spectra), len(todo)))
+    start, rows = time.time(), []
+    if todo:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            chunk = max(1, len(todo) // (4 * workers))
+            rows = list(pool.map(fitFile, todo, [models] * len(todo), [criterion] * len(todo), chunksize=chunk))
+    table = pd.concat([old[~old["File"].isin(todo)], pd.DataFrame(rows)], ignore_index=True)
+    table = table.sort_values([c for c in ("Temp(K)", "RF Freq(GHz)", "File") if c in table]).reset_index(drop=True)
+    table.to_csv(output, index=False)
+    print("Fitted {} spectra in {:.1f}s. Results in {}".format(len(todo), time.time() - start, output))
+    return table
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fit the lineshape of every field scan csv under a folder")
+    parser.add_argument("folder")
+    parser.add_argument("--output", default=None, help="Results table, default <folder>/" + ResultsFile)
+    parser.add_argument("--models", default=",".join(FitModels), help="Comma separated, from " + ", ".join(FitModels))
+    parser.add_argument("--criterion", default="bic", help="bic or aicc")
+    parser.add_argument("--workers", type=int, default=None, help="Processes, default one per core")
+    parser.add_argument("--refit", action="store_true", help="Fit everything again")
+    args = parser.parse_args()
+    batchFit(args.folder, args.output, [m.strip() for m in args.models.split(",")], args.criterion, args.workers, args.refit)
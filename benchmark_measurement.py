@@ -0,0 +1,130 @@
+"""Points-per-hour benchmark of the MeasurementEngine scan loops, run on the simulated instruments.
+
+    python benchmark_measurement.py --freqs 10,12,15 --temps 300 --timeconst 8 --step 1
+
+Reports points/hour, the per-point overhead and where the (simulated) time went: instrument I/O,
+waits/settling in the measurement code, magnet and temperature waits, plotting and file writes.
+Run it before and after touching the acquisition loop to catch throughput regressions.
+"""
+import argparse, json, tempfile, time
+import measurement_engine, lockin_control, field_sweep, settle_scheduler
+from measurement_engine import MeasurementEngine, ScanPlan, guarded
+from fmr_simulator import SimulatedSetup, SimSample
+from live_plot import LivePlot
+from data_writer import ScanWriter
+from status_poller import lockPPMS
+from async_instruments import AsyncIO
+from io_trace import tracer, TracedInstrument
+
+
+def run_benchmark(freqs=(10, 12), temps=(300,), timeConst=8, stepSize=1, linewidths=(4, 5),
+                  latencyScale=1.0, sample=None, folder=None, seed=0, readMode="snap",
+                  scanMode="step", sweepRate=1, speedup=None, settleMode="model", order="given", powers="", currents="",
+                  asyncIO=False):
+    """Run the plan once on a SimulatedSetup and return the timing summary as a dict.
+    The sweep mode samples on several threads and asyncIO overlaps the buses, so they need a clock with a finite speedup"""
+    sample = sample or SimSample()
+    if (scanMode == "sweep" or asyncIO) and not speedup: speedup = 20
+    setup = SimulatedSetup(sample=sample, latencyScale=latencyScale, seed=seed, temperature=temps[0], speedup=speedup)
+    setup.lockin.write("OFLT {}".format(timeConst))
+    folder = folder or tempfile.mkdtemp(prefix="fmr_bench_")
+    freqsandFields = ", ".join("{}: {}".format(f, round(sample.resonanceField(f, temps[0]), 1)) for f in freqs)
+    tempsandShifts = ", ".join("{}: {}".format(T, round(sample.tempShift * (T - temps[0]), 1)) for T in temps)
+    plan = ScanPlan.fromText("Bench", folder, tempsandShifts, freqsandFields, linewidths, stepSize, powers=powers, currents=currents,
+                             readMode=readMode, scanMode=scanMode, sweepRate=sweepRate, settleMode=settleMode, order=order)
+    engine = MeasurementEngine(lockPPMS(TracedInstrument(setup.ppms, "PPMS")), guarded(setup.lockin, "SR830"),
+                               guarded(setup.rfSource, "N5183"), guarded(setup.acSource, "6221"), LivePlot(360, 240),
+                               io=AsyncIO(clock=setup.clock) if asyncIO else None)
+
+    timings = {"plotting": 0.0, "file writes": 0.0}
+    counts = {"points": 0}
+    original_time, original_plot = measurement_engine.time, measurement_engine.savePoints
+    def timed(func, key):
+        def wrapper(*args, **kwargs):
+            t0 = time.perf_counter()
+            try: return func(*args, **kwargs)
+            finally: timings[key] += time.perf_counter() - t0
+        return wrapper
+    #The GUI timer renders on its own thread, so only the work done by the measurement thread counts
+    engine.livePlot.append = timed(engine.livePlot.append, "plotting")
+    engine.livePlot.save = timed(engine.livePlot.save, "plotting")
+    timedAdd = timed(ScanWriter.add, "file writes")
+    class TimedScanWriter(ScanWriter): #add() and close() include the batched flushes
+        __init__ = timed(ScanWriter.__init__, "file writes")
+        def add(self, *args, **kwargs):
+            counts["points"] += 1
+            return timedAdd(self, *args, **kwargs)
+        close = timed(ScanWriter.close, "file writes")
+    measurement_engine.time, lockin_control.time, field_sweep.time = setup.clock, setup.clock, setup.clock
+    settle_scheduler.time = setup.clock
+    tracer.clock = setup.clock #The trace files of the scans are written into the benchmark folder
+    measurement_engine.ScanWriter, measurement_engine.savePoints = TimedScanWriter, timed(original_plot, "plotting")
+    start = setup.clock.time()
+    try: engine.run(plan)
+    finally:
+        if engine.io is not None: engine.io.close()
+        measurement_engine.time, lockin_control.time, field_sweep.time = original_time, original_time, original_time
+        settle_scheduler.time = original_time
+        tracer.clock = time
+        measurement_engine.ScanWriter, measurement_engine.savePoints = ScanWriter, original_plot
+    total = setup.clock.time() - start
+
+    slept = setup.clock.slept
+    breakdown = {"io": slept.get("io", 0.0), "waits": slept.get("settling", 0.0),
+                 "magnet": slept.get("magnet", 0.0), "temperature": slept.get("temperature", 0.0),
+                 "plotting": timings["plotting"], "file writes": timings["file writes"]}
+    breakdown["other"] = total - sum(breakdown.values())
+    points = counts["points"]
+    return {"points": points, "duration(s)": total,
+            "points/hour": 3600 * points / total if total else 0,
+            "per point(s)": total / points if points else 0,
+            "per-point overhead(s)": (total - breakdown["waits"] - breakdown["temperature"]) / points if points else 0,
+            "breakdown(s)": breakdown,
+            "io per instrument(s)": {name: inst.ioTime for name, inst in setup.instruments.items()},
+            "commands": {name: inst.commandCounts for name, inst in setup.instruments.items()},
+            "folder": folder}
+
+
+def print_report(result):
+    print("\n---------------- measurement benchmark ----------------")
+    print("{:<24}{:>12d}".format("points", result["points"]))
+    for key in ("duration(s)", "points/hour", "per point(s)", "per-point overhead(s)"):
+        print("{:<24}{:>12.3f}".format(key, result[key]))
+    total = result["duration(s)"] or 1
+    print("Time spent in:")
+    for key, value in result["breakdown(s)"].items():
+        print("    {:<20}{:>12.3f}s {:>6.1f}%".format(key, value, 100 * value / total))
+    if result["breakdown(s)"]["other"] < 0:
+        print("    (several threads waited at the same time, so the parts add up to more than the duration)")
+    print("I/O per instrument:")
+    for key, value in result["io per instrument(s)"].items():
+        print("    {:<20}{:>12.3f}s  {}".format(key, value, sum(result["commands"][key].values())))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the measurement engine on simulated instruments")
+    parser.add_argument("--freqs", default="10,12", help="RF frequencies in GHz, e.g. 10,12,15")
+    parser.add_argument("--temps", default="300", help="Temperatures in K, e.g. 300,250")
+    parser.add_argument("--timeconst", type=int, default=8, help="SR830 OFLT index, 8 = 100ms")
+    parser.add_argument("--step", type=float, default=1, help="Fixed field step size in G")
+    parser.add_argument("--latency-scale", type=float, default=1.0, help="Multiplies every command latency")
+    parser.add_argument("--read-mode", default="snap", help="Lock-in read mode: query, snap or buffer")
+    parser.add_argument("--scan-mode", default="step", help="step, sweep, frequency, interleave or adaptive")
+    parser.add_argument("--sweep-rate", type=float, default=1, help="Field sweep rate in G/s")
+    parser.add_argument("--settle", default="model", help="Settling: model (settle_scheduler) or fixed (5 x time constant)")
+    parser.add_argument("--order", default="given", help="Order of the scans: given, serpentine, nearest or best")
+    parser.add_argument("--powers", default="", help="RF powers in dBm to sweep, e.g. 0,5")
+    parser.add_argument("--currents", default="", help="6221 modulation amplitudes in mA to sweep, e.g. 50,100")
+    parser.add_argument("--async-io", action="store_true", help="Overlap the PPMS and GPIB calls (async_instruments.py)")
+    parser.add_argument("--speedup", type=float, default=None, help="Simulated/wall time ratio. Default: skip waits")
+    parser.add_argument("--json", default="", help="Also write the result to this json file")
+    args = parser.parse_args()
+    result = run_benchmark(freqs=[float(f) for f in args.freqs.split(',')],
+                           temps=[float(T) for T in args.temps.split(',')],
+                           timeConst=args.timeconst, stepSize=args.step, latencyScale=args.latency_scale,
+                           readMode=args.read_mode, scanMode=args.scan_mode, sweepRate=args.sweep_rate,
+                           speedup=args.speedup, settleMode=args.settle,
+                           order=args.order, powers=args.powers, currents=args.currents, asyncIO=args.async_io)
+    print_report(result)
+    if args.json:
+        with open(args.json, "w") as file: json.dump(result, file, indent=2)
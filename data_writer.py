@@ -0,0 +1,126 @@
+"""Buffered writer of the points of one field scan.
+
+Points go into a preallocated numpy array and are appended to a binary .npy file in batches, so at
+most flushEvery points (or flushInterval seconds) are lost if the program dies. The .npy header is
+rewritten after every batch, so the file on disk is always a valid array that np.load can read:
+    data = np.load("Sample_300K_10p0GHz_0dBm_20p0mA.npy")
+    fields, X = data["Field_Actual(G)"], data["Lockin_X_Ave"]
+The legacy csv (Temp(K),RF Freq(GHz),Field(G),...) is written by toCSV() or npyToCSV(). Sensitivity(V) is the
+lock-in full scale each point was read at (see lockin_control.AutoRange); files from before it have no such column.
+"""
+import os, time
+import numpy as np
+from io_trace import tracer
+
+ScanColumns = ["Time(s)", "Temp(K)", "RF Freq(GHz)", "Field(G)", "Field_Actual(G)",
+               "Lockin_X_Ave", "Lockin_Y_Ave", "Lockin_X_Err", "Lockin_Y_Err", "TimeConst", "Sensitivity(V)"]
+LegacyColumns = ["Temp(K)", "RF Freq(GHz)", "Field(G)", "Lockin_X_Ave", "Lockin_Y_Ave", "TimeConst"]
+NPY_MAGIC = b"\x93NUMPY\x01\x00"
+
+
+def _npyHeader(dtype, count, size=None):
+    """Version 1.0 .npy header. Padded to size bytes so it can be rewritten in place"""
+    d = "{{'descr': {}, 'fortran_order': False, 'shape': ({},), }}".format(repr(np.lib.format.dtype_to_descr(dtype)), count)
+    if size is None: #Leave room for a 12 digit count and round up to a multiple of 64 as numpy does
+        size = len(NPY_MAGIC) + 2 + len(d) + 12 + 1
+        size += -size % 64
+    headerLength = size - len(NPY_MAGIC) - 2
+    return NPY_MAGIC + headerLength.to_bytes(2, "little") + (d.ljust(headerLength - 1) + "\n").encode("latin1")
+
+
+class ScanWriter:
+    """writer = ScanWriter(filename.replace(".csv", ".npy"), capacity=len(fields))
+    writer.add(temp, freq, field, fieldActual, X, Y, xErr, yErr, timeConst, fullScale)  #for every point
+    writer.close(csv=filename)  #flushes, and writes the legacy csv if a name is given
+    resume=True keeps the points of an existing file (e.g. of an interrupted run) and appends to them. A file
+    with fewer columns is rewritten with NaN in the ones it lacks"""
+    def __init__(self, path, capacity=256, flushEvery=16, flushInterval=10.0, columns=ScanColumns, resume=False):
+        self.path, self.flushEvery, self.flushInterval = path, flushEvery, flushInterval
+        self.dtype = np.dtype([(name, "<f8") for name in columns])
+        existing = loadScan(path) if resume and os.path.exists(path) else None
+        if existing is not None and existing.dtype != self.dtype:
+            if set(existing.dtype.names) - set(self.dtype.names): raise ValueError("{} has other columns".format(path))
+            existing = upgradeScan(existing, self.dtype)
+            with open(path, "wb") as file: file.write(_npyHeader(self.dtype, len(existing)) + existing.tobytes())
+        self.n = self.flushed = len(existing) if existing is not None else 0
+        self.data = np.zeros(max(1, capacity + self.n), dtype=self.dtype)
+        self.lastFlush = time.time()
+        if existing is not None:
+            self.data[:self.n] = existing
+            self.file = open(path, "r+b")
+            np.lib.format.read_magic(self.file)
+            np.lib.format.read_array_header_1_0(self.file)
+            self._headerSize = self.file.tell()
+            self.file.truncate(self._headerSize + self.n * self.dtype.itemsize) #Points written after the last header update
+        else:
+            self._headerSize = len(_npyHeader(self.dtype, 0))
+            self.file = open(path, "wb")
+            self.file.write(_npyHeader(self.dtype, 0))
+        self.file.flush()
+
+    def add(self, *values, timestamp=None):
+        """values are the columns after Time(s), in order. Returns the index of the point"""
+        if self.n == len(self.data): #More points than expected, e.g. a rescan
+            self.data = np.concatenate([self.data, np.zeros_like(self.data)])
+        self.data[self.n] = (time.time() if timestamp is None else timestamp,) + tuple(values)
+        self.n += 1
+        if self.n - self.flushed >= self.flushEvery or time.time() - self.lastFlush >= self.flushInterval:
+            self.flush()
+        return self.n - 1
+
+    def flush(self):
+        """Append the unwritten points, then update the point count in the header"""
+        if self.file is None or self.n == self.flushed: return
+        with tracer.span("flush npy", "file"):
+            self.file.seek(0, os.SEEK_END)
+            self.file.write(self.data[self.flushed:self.n].tobytes())
+            self.file.flush()
+            self.file.seek(0)
+            self.file.write(_npyHeader(self.dtype, self.n, self._headerSize))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        self.flushed, self.lastFlush = self.n, time.time()
+
+    @property
+    def points(self):
+        """The points written so far, as a structured array"""
+        return self.data[:self.n]
+
+    def toCSV(self, filename, columns=LegacyColumns):
+        with tracer.span("write csv", "file"): writeCSV(self.points, filename, columns)
+
+    def close(self, csv=None):
+        if self.file is None: return
+        self.flush()
+        self.file.close()
+        self.file = None
+        if csv: self.toCSV(csv)
+
+    def __enter__(self): return self
+    def __exit__(self, *args): self.close()
+
+
+def writeCSV(points, filename, columns=LegacyColumns):
+    with open(filename, "w") as file:
+        file.write(",".join(columns) + "\n")
+        for row in points[columns].tolist():
+            file.write(",".join(repr(v) for v in row) + "\n")
+
+
+def loadScan(path):
+    """Read a .npy written by ScanWriter, also one that was left behind by a crash"""
+    return np.load(path)
+
+
+def upgradeScan(points, dtype):
+    """points with the columns of dtype, NaN in those it does not have (e.g. a scan of an older version)"""
+    upgraded = np.full(len(points), np.nan, dtype=dtype)
+    for name in points.dtype.names: upgraded[name] = points[name]
+    return upgraded
+
+
+def npyToCSV(path, filename=None, columns=LegacyColumns):
+    """Regenerate the legacy csv from the binary file, e.g. after a crash"""
+    filename = filename or os.path.splitext(path)[0] + ".csv"
+    writeCSV(loadScan(path), filename, columns)
+    return filename
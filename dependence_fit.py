@@ -0,0 +1,138 @@
+"""Kittel and damping fits of the lineshape results, with bootstrap uncertainties.
+
+Reads the results table of batch_fit.py (Hr1 and dH1 of every spectrum) and, for every sample folder and
+temperature, fits
+    f(Hres) = resFreq_vs_Field                        -> gamma, Meff
+    dH(f)   = linewidth_Linear (or LinearandNonlinear) -> alpha, dH0 (A, tau)
+The linewidth is fitted with the FixedGamma models and alpha rescaled by gamma / gamma_0, which is exact
+since only alpha / gamma enters them. The uncertainties come from a bootstrap over the frequencies: all
+resamples of a temperature are fitted at once with fitBatch, and the temperatures run on all cores.
+    python dependence_fit.py "D:\\Data\\LSC441\\fit_results.csv" --resamples 5000
+writes Meff_vs_T.csv and alpha_vs_T.csv next to the results table.
+"""
+import argparse, os, time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from Common_FuncsClasses import fitBatch, gamma_0, resFreq_vs_Field, resFreq_vs_Field_FixedGamma, \
+    linewidth_Linear_FixedGamma, linewidth_LinearandNonlinear_FixedGamma
+
+LinewidthModels = {"linear": (linewidth_Linear_FixedGamma, ["alpha", "dH0"]),
+                   "nonlinear": (linewidth_LinearandNonlinear_FixedGamma, ["alpha", "dH0", "A", "tau"])}
+MeffFile, AlphaFile = "Meff_vs_T.csv", "alpha_vs_T.csv"
+
+
+def kittelGuess(H, freq, fixedGamma=False):
+    """[gamma, Meff] (or [Meff]) from the linear least squares of (2 pi f)^2 = gamma^2 (H^2 + 4 pi Meff H)"""
+    y = (2 * np.pi * freq) ** 2
+    if fixedGamma:
+        return [np.sum((y / gamma_0 ** 2 - H ** 2) * H) / np.sum(H ** 2) / (4 * np.pi)]
+    a, b = np.linalg.lstsq(np.column_stack([H ** 2, H]), y, rcond=None)[0]
+    if a <= 0: return [gamma_0, b / (4 * np.pi * gamma_0 ** 2)]
+    return [np.sqrt(a), b / (4 * np.pi * a)]
+
+
+def linewidthGuess(freq, dH, model="linear"):
+    """p0 of the FixedGamma linewidth model from a straight line through dH(f)"""
+    slope, dH0 = np.polyfit(freq, dH, 1)
+    alpha = slope * gamma_0 / (4 * np.pi)
+    if model == "linear": return [alpha, dH0]
+    #The nonlinear term peaks at 2 pi f tau = 1 with A / 2: put the peak in the middle of the frequencies
+    rest = dH - (dH0 + slope * freq)
+    return [alpha, dH0, 2 * max(np.ptp(rest), 1e-3), 1 / (2 * np.pi * np.median(freq))]
+
+
+def bootstrapIndices(n, resamples, minUnique, rng):
+    """(resamples + 1, n) indices into the n points, row 0 is the data itself. Resamples with fewer than
+    minUnique different points cannot fix the model and are drawn again"""
+    rows = [np.arange(n)[np.newaxis, :]]
+    count = 0
+    while count < resamples and n >= minUnique:
+        index = rng.integers(0, n, (resamples - count, n))
+        ordered = np.sort(index, axis=1)
+        index = index[np.count_nonzero(np.diff(ordered, axis=1), axis=1) + 1 >= minUnique]
+        rows.append(index)
+        count += len(index)
+    return np.concatenate(rows)[:resamples + 1]
+
+
+def _summary(name, values, converged):
+    """Estimate (row 0), bootstrap standard error and 16/84 percentiles of one parameter"""
+    sample = values[1:][converged[1:] & np.isfinite(values[1:])]
+    if not len(sample): return {name: values[0], name + "_err": np.nan, name + "_lo": np.nan, name + "_hi": np.nan}
+    low, high = np.percentile(sample, [15.87, 84.13])
+    return {name: values[0], name + "_err": np.std(sample, ddof=1) if len(sample) > 1 else np.nan,
+            name + "_lo": low, name + "_hi": high}
+
+
+def fitTemperature(sample, temp, freq, Hres, dH, resamples=2000, fixedGamma=False, model="linear", seed=0):
+    """(Meff row, alpha row) of one sample and temperature. Runs in the worker processes"""
+    rng = np.random.default_rng([seed, int(round(1000 * temp))])
+    freq, Hres, dH = (np.asarray(v, dtype=float) for v in (freq, Hres, dH))
+    function, names = LinewidthModels[model]
+    index = bootstrapIndices(len(freq), resamples, len(names) + 1, rng)
+    base = {"Sample": sample, "Temp(K)": temp, "Points": len(freq)}
+    if len(freq) < len(names) + 1:
+        print("{} {}K: {} frequencies are too few".format(sample, temp, len(freq)))
+        return dict(base, Error="Too few frequencies"), dict(base, Error="Too few frequencies")
+    #Kittel: every resample is a row of the batch
+    kittel = resFreq_vs_Field_FixedGamma if fixedGamma else resFreq_vs_Field
+    p0 = np.tile(kittelGuess(Hres, freq, fixedGamma), (len(index), 1))
+    params, cov, rss, kittelConverged = fitBatch(kittel, Hres[index], freq[index], p0)
+    gamma = np.full(len(index), gamma_0) if fixedGamma else params[:, 0]
+    meffRow = dict(base, Resamples=int(kittelConverged[1:].sum()))
+    if not fixedGamma: meffRow.update(_summary("gamma", gamma, kittelConverged))
+    meffRow.update(_summary("Meff", params[:, -1], kittelConverged))
+    #Linewidth with the same resamples, so the uncertainty of gamma goes into alpha
+    p0 = np.tile(linewidthGuess(freq, dH, model), (len(index), 1))
+    params, cov, rss, converged = fitBatch(function, freq[index], dH[index], p0)
+    params[:, 0] *= gamma / gamma_0
+    converged &= kittelConverged
+    alphaRow = dict(base, Resamples=int(converged[1:].sum()))
+    for j, name in enumerate(names): alphaRow.update(_summary(name, params[:, j], converged))
+    return meffRow, alphaRow
+
+
+def loadResults(path):
+    """Rows of the batch_fit results table that have a resonance, with the sample (folder) of each"""
+    table = pd.read_csv(path)
+    if "Error" in table: table = table[table["Error"].isna()]
+    table = table[np.isfinite(table["Hr1"]) & np.isfinite(table["dH1"]) & (table["Hr1"] > 0)].copy()
+    table["Sample"] = [os.path.basename(os.path.dirname(file)) for file in table["File"]]
+    return table
+
+
+def dependenceFit(results, output=None, resamples=2000, fixedGamma=False, model="linear", workers=None, seed=0):
+    """Fit every sample and temperature of the batch_fit results table. Returns (Meff table, alpha table)"""
+    if model not in LinewidthModels: raise ValueError("Unknown linewidth model {}".format(model))
+    output = output or os.path.dirname(os.path.abspath(results))
+    table = loadResults(results)
+    groups = [(sample, temp, group["RF Freq(GHz)"].values, group["Hr1"].values, group["dH1"].values)
+              for (sample, temp), group in table.groupby(["Sample", "Temp(K)"])]
+    print("{} temperatures, {} bootstrap resamples each".format(len(groups), resamples))
+    start = time.time()
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1) as pool:
+        futures = [pool.submit(fitTemperature, *group, resamples, fixedGamma, model, seed) for group in groups]
+        rows = [future.result() for future in futures]
+    meff = pd.DataFrame([row[0] for row in rows])
+    alpha = pd.DataFrame([row[1] for row in rows])
+    meff.to_csv(os.path.join(output, MeffFile), index=False)
+    alpha.to_csv(os.path.join(output, AlphaFile), index=False)
+    print("Fitted in {:.1f}s. Results in {} and {}".format(time.time() - start, MeffFile, AlphaFile))
+    return meff, alpha
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fit Meff(T) and alpha(T) from the batch_fit results table")
+    parser.add_argument("results", help="fit_results.csv of batch_fit.py")
+    parser.add_argument("--output", default=None, help="Folder of the tables, default that of the results")
+    parser.add_argument("--resamples", type=int, default=2000, help="Bootstrap resamples per temperature")
+    parser.add_argument("--model", default="linear", help="Linewidth model: " + ", ".join(LinewidthModels))
+    parser.add_argument("--fixed-gamma", action="store_true", help="Use gamma_0 instead of fitting gamma")
+    parser.add_argument("--workers", type=int, default=None, help="Processes, default one per core")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    meff, alpha = dependenceFit(args.results, args.output, args.resamples, args.fixed_gamma, args.model, args.workers, args.seed)
+    with pd.option_context("display.width", 200, "display.max_columns", 20):
+        print(meff)
+        print(alpha)
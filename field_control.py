@@ -1,71 +1,75 @@
-import time
+import json, math, string, time
+import numpy as np
+from io_trace import tracer
 #import visa
 
+HexDigits = np.frombuffer(b"0123456789ABCDEF", dtype=np.uint8)
+HexValues = np.full(256, -1, dtype=np.int64) #Byte to nibble, -1 if not a hex digit
+HexValues[HexDigits] = np.arange(16)
+HexValues[np.frombuffer(b"abcdef", dtype=np.uint8)] = np.arange(10, 16)
+HexChars = set(string.hexdigits)
+MaxField = 2.0 ** 15 #Exponent nibble 0xF: |field| < 32768
+
+
+class HexCodecError(ValueError):
+    pass
+
+class FieldRangeError(HexCodecError):
+    """The value can not be encoded: not finite or |value| >= MaxField"""
+
+class MalformedReplyError(HexCodecError):
+    """Not an 8 digit VSM number: wrong length, not hex, or a sign digit other than 0 or 8"""
+
+
+def encode_fields(values):
+    """VSM 8 digit hex of every value: sign digit (0 or 8), exponent digit e + 1, 24 bit mantissa of
+    |value| / 2**e, truncated. The same digits as the original one-value-at-a-time num_to_hex"""
+    x = np.atleast_1d(np.asarray(values, dtype=float))
+    bad = ~np.isfinite(x) | (np.abs(x) >= MaxField)
+    if bad.any(): raise FieldRangeError("Can not encode {}".format(x[bad][:5].tolist()))
+    a = np.abs(x)
+    e = np.maximum(np.frexp(a)[1] - 1, 0) #a = m * 2**e with 1 <= m < 2, or e = 0 below 1
+    mantissa = np.floor(np.ldexp(a, 23 - e)).astype(np.int64)
+    codes = ((x < 0).astype(np.int64) << 31) | ((e + 1) << 24) | mantissa
+    codes[a == 0] = 0
+    nibbles = (codes[:, None] >> np.arange(28, -1, -4)) & 0xF
+    return HexDigits[nibbles].view("S8").ravel().astype(str)
+
+
+def decode_fields(strings):
+    """Values of VSM 8 digit hex strings (either case). Raises MalformedReplyError"""
+    strings = np.atleast_1d(np.asarray(strings))
+    try: raw = strings.astype("S8")
+    except UnicodeEncodeError: raise MalformedReplyError("Not hex: {}".format(strings[:5].tolist()))
+    lengths = np.char.str_len(raw)
+    nibbles = HexValues[raw.view(np.uint8).reshape(len(raw), 8)]
+    bad = (lengths != 8) | (np.char.str_len(strings.astype(str)) != 8) | (nibbles < 0).any(axis=1) | ((nibbles[:, 0] & 7) != 0)
+    if bad.any(): raise MalformedReplyError("Not a VSM number: {}".format(strings[bad][:5].tolist()))
+    mantissa = (nibbles[:, 2:] << np.arange(20, -1, -4)).sum(axis=1)
+    values = np.ldexp(mantissa.astype(float), nibbles[:, 1] - 24)
+    return np.where(nibbles[:, 0] == 8, -values, values)
+
+
+def conto_table(fields):
+    """The CONTO command of every field of a scan, encoded at once"""
+    return np.char.add("CONTO ", encode_fields(fields))
+
+
 def num_to_hex(x):
-    if int(x) == float(x):
-        x = int(x)
-    if x == 0 or float(x) == 0:
-        return "00000000"
-    res = []
-    if x > 0:
-        res.append(str(0))
-    else:
-        res.append(str(8))
-    x = abs(x)
-    e = 0
-    m = x
-    while m >= 2:
-        m = m / 2
-        e += 1
-
-    res.append(hex(e + 1)[2:])
-    #print("e:{}".format(e))
-
-    m = m * 128
-    m_int = int(m)
-    m_digit = m - m_int
-    m_digit = int(m_digit * 65536)
-    #print("m int:")
-    #print(m_int)
-
-    m_int = hex(m_int)[2:]
-    m_int = "0" * (2 - len(m_int)) + m_int
-    m_digit = hex(m_digit)[2:]
-    m_digit = "0" * (4 - len(m_digit)) + m_digit
-
-    res.append(m_int)
-    res.append(m_digit)
-    res = "".join(res).upper()
-    if not len(res) == 8:
-        print(res)
-        print(x)
-        print(type(x))
-        print("error!!")
-        return "00000000"
-    return res
+    """encode_fields of one value, without the array overhead"""
+    x = float(x)
+    if not math.isfinite(x) or abs(x) >= MaxField: raise FieldRangeError("Can not encode {}".format(x))
+    if x == 0: return "00000000"
+    e = max(math.frexp(abs(x))[1] - 1, 0)
+    return "{:08X}".format((x < 0) << 31 | (e + 1) << 24 | int(math.ldexp(abs(x), 23 - e)))
 
 
 def hex_to_num(s):
-    sign = s[0]
-    if sign == '0':
-        sign = 1
-    elif sign == '8':
-        sign = -1
-    else:
-        return 0
-
-    e = int(s[1], 16) - 1
-    m_int = s[2:4].lstrip('0')
-    if len(m_int) == 0:
-        m_int = '0'
-    m_int = int(m_int, 16)
-    m_float = s[4:].lstrip('0')
-    if len(m_float) == 0:
-        m_float = '0'
-    m_float = int(m_float, 16)
-    m = (m_int + (m_float / 65536)) / 128
-    res = sign * m * 2 ** e
-    return res
+    """decode_fields of one string"""
+    if len(s) != 8 or s[0] not in "08" or not HexChars.issuperset(s): raise MalformedReplyError("Not a VSM number: {!r}".format(s))
+    code = int(s, 16)
+    value = math.ldexp(code & 0xFFFFFF, ((code >> 24) & 0xF) - 24)
+    return -value if s[0] == "8" else value
 
 
 def read_field(gauss):
@@ -76,38 +80,149 @@ def read_field(gauss):
 def vsm_read_field(vsm):
     f = vsm.query("READ?")[18:26].lower()
     if not(len(f) == 8):
-        raise
+        raise MalformedReplyError("Short READ? reply: {!r}".format(f))
     f = hex_to_num(f)
     return f
 
-def check_stable(vsm, time_per_point=0.5):
+def check_stable(vsm, time_per_point=0.5, timeout=None):
+    """Wait for three stable CONST? readings in a row. False if timeout (s) passed first"""
     current = [0, 0 ,0]
     target = [2, 2, 2]
+    start = time.time()
     while True:
         next_point = int(vsm.query("CONST?")[0])
         current.pop(0)
         current.append(next_point)
         if current == target:
-            return
-        time.sleep(time_per_point)
+            return True
+        if timeout is not None and time.time() - start > timeout:
+            return False
+        with tracer.span("check_stable", "sleep"): time.sleep(time_per_point)
 
 def vsm_set_field(vsm, field, rate=1000):
     vsm.write("CONTO " + num_to_hex(field))
 
+class FieldController:
+    """Field of the VSM magnet with the gaussmeter in the loop.
+        control = FieldController(vsm, gauss)
+        control.set_field(2400)        #the field read by the gaussmeter at the end
+    RANGE, CMODE and CONTR are only sent when they change. The CONTO setpoint comes from the offsets
+    (setpoint - field) learned at earlier fields, separately for rising and falling fields because of the
+    hysteresis, so most points are right on the first setpoint. Moves up to small_step G skip the CONST?
+    polling and only wait settle_time s. The setpoint is then corrected by the error left until the
+    gaussmeter is within tolerance G, at most max_iterations times. Without a gaussmeter it is open loop"""
+    def __init__(self, vsm, gauss=None, rate=1000, tolerance=0.2, small_step=10, settle_time=0.3,
+                 max_iterations=4, bin_width=50, learning_rate=0.5):
+        self.vsm, self.gauss, self.rate = vsm, gauss, rate
+        self.tolerance, self.small_step, self.settle_time = tolerance, small_step, settle_time
+        self.max_iterations, self.bin_width, self.learning_rate = max_iterations, bin_width, learning_rate
+        self.offsets = {1: {}, -1: {}} #{direction: {field bin: offset}}
+        self.mode = {} #The setup commands last sent
+        self.field, self.setpoint, self.rising = None, None, True
+        self.last = {}
+
+    def invalidate(self):
+        """Forget the mode sent, e.g. after the VSM was reset or used from its front panel"""
+        self.mode = {}
+
+    def send(self, command, value):
+        if self.mode.get(command) == value: return False
+        self.vsm.write(command + " " + value)
+        self.mode[command] = value
+        return True
+
+    def configure(self, rate=None):
+        self.send("RANGE", "0 ") # high field range
+        if self.send("CMODE", "2 "): # field ramp mode
+            time.sleep(0.1)
+        self.send("CONTR", num_to_hex(self.rate if rate is None else rate))
+
+    def go_to(self, setpoint):
+        """CONTO setpoint and wait until it is reached. Returns the stability waits needed"""
+        move = abs(setpoint - self.setpoint) if self.setpoint is not None else float("inf")
+        self.vsm.write("CONTO " + num_to_hex(setpoint))
+        self.setpoint = setpoint
+        if move <= self.small_step:
+            with tracer.span("field settle", "sleep"): time.sleep(self.settle_time)
+            return 0
+        check_stable(self.vsm)
+        return 1
+
+    def predict(self, field, rising):
+        """CONTO setpoint expected to give field when coming from below (rising) or above"""
+        table = self.offsets[1 if rising else -1] or self.offsets[-1 if rising else 1]
+        if not table: return field
+        bins = sorted(table)
+        return field + float(np.interp(field, bins, [table[b] for b in bins]))
+
+    def learn(self, field, rising, setpoint):
+        table = self.offsets[1 if rising else -1]
+        key = round(field / self.bin_width) * self.bin_width
+        offset = setpoint - field
+        table[key] = offset if key not in table else table[key] + self.learning_rate * (offset - table[key])
+
+    def sweep_table(self, fields):
+        """CONTO commands of a whole scan, with the setpoints predicted from the learned offsets"""
+        setpoints, last, rising = [], self.field, self.rising
+        for field in fields:
+            if last is not None and field != last: rising = field > last
+            setpoints.append(self.predict(field, rising))
+            last = field
+        return conto_table(setpoints)
+
+    def set_field(self, field, rate=None):
+        """Go to field (G). Returns the gaussmeter reading, None without a gaussmeter"""
+        self.configure(rate)
+        if self.field is not None and field != self.field: self.rising = field > self.field
+        setpoint = self.predict(field, self.rising)
+        waits = self.go_to(setpoint)
+        measured = None
+        for iteration in range(self.max_iterations + 1):
+            if self.gauss is None: break
+            measured = read_field(self.gauss)
+            error = field - measured
+            if abs(error) <= self.tolerance:
+                self.learn(field, self.rising, setpoint)
+                break
+            if iteration == self.max_iterations:
+                print("Field {}G not within {}G after {} corrections, gaussmeter reads {}G".format(
+                    field, self.tolerance, self.max_iterations, measured))
+                break
+            setpoint += error
+            waits += self.go_to(setpoint)
+        self.field = field
+        self.last = {"setpoint": setpoint, "measured": measured, "waits": waits,
+                     "corrections": iteration}
+        return measured
+
+    def save(self, path):
+        """Write the learned offsets to a json file"""
+        with open(path, "w") as file:
+            json.dump({"rising": self.offsets[1], "falling": self.offsets[-1]}, file)
+
+    def load(self, path):
+        with open(path) as file: saved = json.load(file)
+        self.offsets = {1: {float(k): v for k, v in saved["rising"].items()},
+                        -1: {float(k): v for k, v in saved["falling"].items()}}
+
+
+_controllers = {}
+
 def set_field(vsm, gauss, field, rate=1000):
-    vsm.write("RANGE 0 ") # high field range
-    vsm.write("CMODE 2 ") # field ramp mode
-    time.sleep(0.1)
-    vsm.write("CONTR " + num_to_hex(rate))
-    vsm.write("CONTO " + num_to_hex(field))
-    check_stable(vsm)
-    current = read_field(gauss)
-    diff = field - current
-    new_f = field + diff
-    vsm.write("CONTO " + num_to_hex(new_f))
-    check_stable(vsm)
+    """FieldController.set_field, with one controller (and its learned offsets) kept per vsm"""
+    if vsm not in _controllers: _controllers[vsm] = FieldController(vsm, gauss, rate)
+    controller = _controllers[vsm]
+    controller.gauss = gauss
+    return controller.set_field(field, rate)
 
 if __name__ == "__main__":
-    for i in range(-100,100):
-        print(hex_to_num(num_to_hex(i)))
-    #print(num_to_hex(4))
+    #Speed of the codec. The checks are in test_field_control.py
+    x = np.random.default_rng(0).uniform(-MaxField, MaxField, 200000)
+    for name, func, data in (("encode", encode_fields, x), ("decode", decode_fields, encode_fields(x))):
+        start = time.perf_counter()
+        func(data)
+        seconds = time.perf_counter() - start
+        print("{} {} values: {:.3f}s, {:.2f} us per value".format(name, len(data), seconds, 1e6 * seconds / len(data)))
+    start = time.perf_counter()
+    for value in x[:10000]: num_to_hex(value)
+    print("num_to_hex one at a time: {:.2f} us per value".format(100 * (time.perf_counter() - start)))
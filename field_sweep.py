@@ -0,0 +1,144 @@
+"""Continuous field-sweep acquisition.
+
+Instead of stepping the magnet point by point, the PPMS ramps the field continuously through the scan
+window at a chosen rate. The lock-in (SNAP? 1,2) and the PPMS field readback are polled by two
+independent TimestampedSampler threads, and afterwards every lock-in sample is matched to the field
+at (its timestamp - the output filter delay) and averaged onto the requested field grid.
+"""
+import threading, time
+import numpy as np
+from io_trace import tracer
+from lockin_control import SR830_TimeConsts
+
+
+class TimestampedSampler(threading.Thread):
+    """Calls read() every interval seconds on its own thread. read() returns a tuple of floats, stored
+    with the midpoint time of the call in self.data[:, 0]"""
+    def __init__(self, read, nValues, interval=0.0, capacity=4096):
+        threading.Thread.__init__(self, daemon=True)
+        self.read, self.interval = read, interval
+        self.data = np.empty((capacity, nValues + 1))
+        self.n, self.running, self.error = 0, True, None
+        self.lock = threading.Lock()
+
+    def run(self):
+        while self.running:
+            t0 = time.time()
+            try: values = self.read()
+            except Exception as e:
+                print("Sampler stopped:", e)
+                self.error = e
+                return
+            t1 = time.time()
+            with self.lock:
+                if self.n == len(self.data):
+                    self.data = np.concatenate([self.data, np.empty_like(self.data)])
+                self.data[self.n] = (0.5 * (t0 + t1),) + tuple(values)
+                self.n += 1
+            if self.interval: time.sleep(max(0.0, self.interval - (t1 - t0)))
+
+    def stop(self):
+        self.running = False
+        self.join()
+
+    def samples(self):
+        with self.lock: return self.data[:self.n].copy()
+
+
+def filterDelay(timeConst, slope_i):
+    """Low frequency group delay of the SR830 output filter: tau per pole, slope_i + 1 poles (6~24dB/oct)"""
+    return (slope_i + 1) * timeConst
+
+
+def fieldsOfSamples(lockinSamples, fieldSamples, lag):
+    """Field at (t - lag) for every lock-in sample, interpolated from the PPMS readbacks.
+    Samples outside the time span of the readbacks are marked with nan"""
+    t = lockinSamples[:, 0] - lag
+    if len(fieldSamples) < 2: return np.full(len(t), np.nan)
+    fields = np.interp(t, fieldSamples[:, 0], fieldSamples[:, 1])
+    fields[(t < fieldSamples[0, 0]) | (t > fieldSamples[-1, 0])] = np.nan
+    return fields
+
+
+def mergeOntoGrid(lockinSamples, fieldSamples, grid, lag):
+    """Average the lag-corrected lock-in samples into bins centred on the grid fields.
+    Returns a structured array, one row per grid field that got at least one sample, in grid order"""
+    grid = np.asarray(grid, dtype=float)
+    result = np.zeros(len(grid), dtype=[("Time(s)", "f8"), ("Field(G)", "f8"), ("Field_Actual(G)", "f8"),
+                                        ("Lockin_X_Ave", "f8"), ("Lockin_Y_Ave", "f8"),
+                                        ("Lockin_X_Err", "f8"), ("Lockin_Y_Err", "f8"), ("Samples", "i8")])
+    result["Field(G)"] = grid
+    fields = fieldsOfSamples(lockinSamples, fieldSamples, lag)
+    order = np.argsort(grid)
+    sortedGrid = grid[order]
+    if len(grid) > 1:
+        edges = np.concatenate([[1.5 * sortedGrid[0] - 0.5 * sortedGrid[1]], 0.5 * (sortedGrid[1:] + sortedGrid[:-1]),
+                                [1.5 * sortedGrid[-1] - 0.5 * sortedGrid[-2]]])
+    else:
+        edges = np.array([sortedGrid[0] - 0.5, sortedGrid[0] + 0.5])
+    valid = ~np.isnan(fields)
+    bins = np.searchsorted(edges, fields[valid]) - 1
+    inside = (bins >= 0) & (bins < len(grid))
+    bins = order[bins[inside]] #Back to the index in the original grid order
+    t, X, Y = [lockinSamples[valid, i][inside] for i in (0, 1, 2)]
+    counts = np.bincount(bins, minlength=len(grid))
+    filled = counts > 0
+    c = np.maximum(counts, 1)
+    for column, values in (("Time(s)", t), ("Field_Actual(G)", fields[valid][inside]), ("Lockin_X_Ave", X), ("Lockin_Y_Ave", Y)):
+        result[column] = np.bincount(bins, values, len(grid)) / c
+    for column, mean, values in (("Lockin_X_Err", "Lockin_X_Ave", X), ("Lockin_Y_Err", "Lockin_Y_Ave", Y)):
+        variance = np.maximum(np.bincount(bins, values ** 2, len(grid)) / c - result[mean] ** 2, 0)
+        result[column] = np.sqrt(variance / np.maximum(counts - 1, 1))
+    result["Samples"] = counts
+    return result[filled]
+
+
+class FieldSweep:
+    """sweep = FieldSweep(ppms, lockin, fields, rate=1)  #rate in G/s
+    points = sweep.run(onSample=livePlot.append, shouldStop=lambda: not flag)
+    The sweep starts a few filter delays before fields[0] and ends after fields[-1], so the first and
+    last grid points see a settled lock-in output. run() raises the error of a sampler that failed."""
+    def __init__(self, ppms, lockin, fields, rate, lockinInterval=None, fieldInterval=0.2):
+        self.ppms, self.lockin, self.fields, self.rate = ppms, lockin, list(fields), float(rate)
+        self.lockinInterval, self.fieldInterval = lockinInterval, fieldInterval
+        self.stopped = False
+
+    def run(self, onSample=None, shouldStop=None, approachRate=100, refresh=0.5):
+        timeConst = SR830_TimeConsts[int(self.lockin.query("OFLT?").strip())]
+        lag = filterDelay(timeConst, int(self.lockin.query("OFSL?").strip()))
+        direction = 1 if self.fields[-1] >= self.fields[0] else -1
+        sweepStart = self.fields[0] - direction * 3 * lag * self.rate
+        sweepEnd = self.fields[-1] + direction * 2 * lag * self.rate
+        self.ppms.setField(sweepStart, approachRate)
+        self.ppms.waitForField(timeout=240)
+
+        lockinSampler = TimestampedSampler(lambda: [float(v) for v in self.lockin.query("SNAP? 1,2").split(',')], 2,
+                                           self.lockinInterval if self.lockinInterval is not None else 0.5 * timeConst)
+        fieldSampler = TimestampedSampler(lambda: (self.ppms.getField()[1],), 1, self.fieldInterval)
+        fieldSampler.start()
+        lockinSampler.start()
+        self.ppms.setField(sweepEnd, self.rate)
+        duration, start, reported = abs(sweepEnd - sweepStart) / self.rate, time.time(), 0
+        print("Sweeping {}G -> {}G at {}G/s. Filter delay {}s".format(sweepStart, sweepEnd, self.rate, lag))
+        while time.time() - start < duration + lag:
+            with tracer.span("sweep", "sleep"): time.sleep(refresh)
+            if shouldStop and shouldStop():
+                self.stopped = True
+                self.ppms.setField(self.ppms.getField()[1], approachRate) #Stop the ramp where it is
+                break
+            if lockinSampler.error or fieldSampler.error: break
+            if onSample: #Live view of the samples whose field is already known
+                lockinSamples, fieldSamples = lockinSampler.samples(), fieldSampler.samples()
+                fields = fieldsOfSamples(lockinSamples[reported:], fieldSamples, lag)
+                for field, sample in zip(fields, lockinSamples[reported:]):
+                    if len(fieldSamples) < 2 or sample[0] - lag > fieldSamples[-1, 0]: break
+                    if not np.isnan(field): onSample(field, sample[1], sample[2])
+                    reported += 1
+        lockinSampler.stop()
+        fieldSampler.stop()
+        error = lockinSampler.error or fieldSampler.error
+        if error is not None: #A partial sweep would be saved as a complete scan
+            try: self.ppms.setField(self.ppms.getField()[1], approachRate)
+            except Exception as e: print("Could not stop the ramp:", e)
+            raise error
+        return mergeOntoGrid(lockinSampler.samples(), fieldSampler.samples(), self.fields, lag)
@@ -0,0 +1,442 @@
+"""Simulated PPMS + electronics so that the measurement code can run without the real setup.
+
+SimulatedSetup builds stand-ins for the Dynacool wrapper, the SR830 lock-in, the N5183 RF source
+and the 6221 current source. They answer the same GPIB strings/methods as the real instruments,
+share one SimClock and produce FMR derivative lineshapes from the models in Common_FuncsClasses.py.
+"""
+import threading, time, math
+import numpy as np
+from Common_FuncsClasses import singleLorentzian, doubleLorentzians, linewidth_Linear, gamma_0
+
+#Full scale of the SR830 sensitivity settings, same order as Sensitivity_Index in PPMS_FMR.py
+SR830_Sensitivities = [2e-9, 5e-9, 1e-8, 2e-8, 5e-8, 1e-7, 2e-7, 5e-7,
+                       1e-6, 2e-6, 5e-6, 1e-5, 2e-5, 5e-5, 1e-4, 2e-4, 5e-4,
+                       1e-3, 2e-3, 5e-3, 1e-2, 2e-2, 5e-2, 1e-1, 2e-1, 5e-1, 1.0]
+#Time constants in seconds, same order as TConstNum_Index in PPMS_FMR.py
+SR830_TimeConsts = [10e-6, 30e-6, 100e-6, 300e-6, 1e-3, 3e-3, 10e-3, 30e-3, 100e-3, 300e-3,
+                    1, 3, 10, 30, 100, 300, 1e3, 3e3, 10e3, 30e3]
+#Internal buffer sample rates (SRAT 0~13) in Hz. SRAT 14 is the external trigger
+SR830_SampleRates = [62.5e-3 * 2 ** n for n in range(14)]
+SR830_BufferSize = 16383
+
+
+class SimClock:
+    """Clock shared by all the simulated instruments. time() is the simulated time in seconds.
+    speedup=None makes every wait return immediately while the simulated time still advances by the
+    requested amount. This is exact, but only for a single thread that does all the waiting.
+    speedup=20 runs the simulated time 20x faster than the wall clock and sleeps 1/20 of every wait,
+    which also works when several threads wait at the same time (samplers, pollers...).
+    The time spent in sleeps is accumulated per category, e.g. 'io' for instrument latency."""
+    def __init__(self, speedup=None):
+        self.speedup = speedup
+        self._t0 = time.perf_counter()
+        self._skipped = 0.0
+        self._lock = threading.Lock()
+        self.slept = {}
+
+    def time(self):
+        if self.speedup: return (time.perf_counter() - self._t0) * self.speedup
+        return time.perf_counter() - self._t0 + self._skipped
+
+    perf_counter = monotonic = time
+
+    def sleep(self, seconds, category="settling"):
+        if seconds <= 0: return
+        if self.speedup: time.sleep(seconds / self.speedup)
+        with self._lock:
+            if not self.speedup: self._skipped += seconds
+            self.slept[category] = self.slept.get(category, 0) + seconds
+
+    def __getattr__(self, name):
+        #So the clock can replace the time module of PPMS_FMR, e.g. PPMS_FMR.time = clock
+        return getattr(time, name)
+
+
+class SimSample:
+    """Magnetic film on the CPW. Hres follows the Kittel relation resFreq_vs_Field, the linewidth
+    follows linewidth_Linear and Hres moves by tempShift G/K away from refTemp.
+    amplitude is the peak of the antisymmetric derivative signal in V at 10mA mod and 0dBm.
+    secondMode = {"offset": G, "amplitudeRatio": , "linewidthRatio": } adds a 2nd resonance."""
+    def __init__(self, Meff=230, gamma=gamma_0, alpha=3e-4, dH0=2, amplitude=2e-4, symRatio=0.1,
+                 phase=0.3, noise=2e-7, tempShift=0.05, refTemp=300, background=0, secondMode=None):
+        self.Meff, self.gamma, self.alpha, self.dH0 = Meff, gamma, alpha, dH0
+        self.amplitude, self.symRatio, self.phase, self.noise = amplitude, symRatio, phase, noise
+        self.tempShift, self.refTemp, self.background = tempShift, refTemp, background
+        self.secondMode = secondMode
+
+    def resonanceField(self, freq, temp=None):
+        #Invert f = gamma/2pi * sqrt(H(H+4pi Meff)) for H. freq in GHz
+        x = 2 * np.pi * freq / self.gamma
+        Hres = -2 * np.pi * self.Meff + np.sqrt((2 * np.pi * self.Meff) ** 2 + x ** 2)
+        if temp is not None: Hres += self.tempShift * (temp - self.refTemp)
+        return Hres
+
+    def linewidth(self, freq):
+        return linewidth_Linear(freq, self.alpha, self.gamma, self.dH0)
+
+    def signal(self, field, freq, temp, drive=1.0):
+        """Lock-in signal magnitude (V) before phase rotation. field can be an array"""
+        Hr, dH = self.resonanceField(freq, temp), self.linewidth(freq)
+        w = dH / 2
+        antiSym = self.amplitude * 16 * np.sqrt(3) * w ** 3 / 9 #Peak of x/(x^2+w^2)^2 is 9/(16sqrt(3)w^3)
+        sym = self.symRatio * self.amplitude * w ** 4
+        if self.secondMode:
+            Hr2 = Hr + self.secondMode["offset"]
+            w2 = w * self.secondMode.get("linewidthRatio", 1)
+            antiSym2 = self.secondMode.get("amplitudeRatio", 0.5) * self.amplitude * 16 * np.sqrt(3) * w2 ** 3 / 9
+            sym2 = self.symRatio * self.secondMode.get("amplitudeRatio", 0.5) * self.amplitude * w2 ** 4
+            s = doubleLorentzians(field, Hr, Hr2, sym, antiSym, sym2, antiSym2, dH, 2 * w2, 0)
+        else:
+            s = singleLorentzian(field, Hr, sym, antiSym, dH, 0)
+        return drive * s + self.background
+
+
+class SimInstrument:
+    """Base of the simulated GPIB/LAN instruments. Every command costs latency[kind] seconds
+    (+-jitter) of simulated time, and only one command is on the bus at a time"""
+    name = "SIM"
+    def __init__(self, setup, latency):
+        self.setup, self.clock = setup, setup.clock
+        self.latency = dict(latency)
+        self.lock = threading.RLock()
+        self.ioTime, self.commandCounts = 0.0, {}
+        self.timeout = 2000
+
+    def _spend(self, kind, command):
+        lat = self.latency.get(kind, 0) * (1 + self.setup.jitter * (2 * self.setup.rng.random() - 1))
+        self.clock.sleep(lat, "io")
+        self.ioTime += lat
+        head = command.split(' ')[0].strip()
+        self.commandCounts[head] = self.commandCounts.get(head, 0) + 1
+
+    def write(self, command):
+        with self.lock:
+            self._spend("write", command)
+            self.handle(command.strip())
+
+    def query(self, command):
+        with self.lock:
+            self._spend("query", command)
+            return "{}\n".format(self.handle(command.strip()))
+
+    def close(self):
+        pass
+
+    def handle(self, command):
+        if command.upper() == "*IDN?": return self.name
+        raise ValueError("{} does not understand '{}'".format(self.name, command))
+
+
+def _normalize(command):
+    """':SOUR:FREQ:CW 10GHz' -> ('FREQ:CW', '10GHz')"""
+    head, _, args = command.strip().partition(' ')
+    head = head.upper().lstrip(':')
+    if head.startswith("SOUR:"): head = head[5:]
+    return head, args.strip()
+
+
+def _parseFreq(value):
+    """'10GHz' -> 1e10 Hz"""
+    value = value.strip().upper()
+    for unit, scale in (("GHZ", 1e9), ("MHZ", 1e6), ("KHZ", 1e3), ("HZ", 1)):
+        if value.endswith(unit): return float(value[:-len(unit)]) * scale
+    return float(value)
+
+
+class SimN5183(SimInstrument):
+    """CW frequency/power/output, and the list mode (:LIST:FREQ, :FREQ:MODE LIST, :INIT, *TRG)"""
+    name = "Agilent Technologies, N5183A, SIMULATED"
+    def __init__(self, setup, latency, outputOn=True):
+        super().__init__(setup, latency)
+        self.freq, self.power, self.outputOn = 10e9, 0.0, outputOn
+        self.cwFreq, self.freqMode, self.list, self.listIndex = self.freq, "CW", [], 0
+
+    def handle(self, command):
+        head, args = _normalize(command)
+        if head in ("FREQ:CW", "FREQ"):
+            self.cwFreq = _parseFreq(args)
+            if self.freqMode == "CW": self.freq = self.cwFreq
+        elif head in ("FREQ:CW?", "FREQ?"): return "{:+.11E}".format(self.freq)
+        elif head == "LIST:FREQ": self.list = [_parseFreq(f) for f in args.split(',')]
+        elif head == "LIST:FREQ:POIN?": return str(len(self.list))
+        elif head in ("LIST:TYPE", "LIST:DWEL", "LIST:TRIG:SOUR", "INIT:CONT"): pass
+        elif head == "FREQ:MODE":
+            self.freqMode = args.upper()
+            if self.freqMode == "CW": self.freq = self.cwFreq
+        elif head == "FREQ:MODE?": return self.freqMode
+        elif head == "INIT":
+            if self.freqMode == "LIST" and self.list: self.listIndex, self.freq = 0, self.list[0]
+        elif head == "*TRG":
+            if self.freqMode == "LIST" and self.listIndex + 1 < len(self.list):
+                self.listIndex += 1
+                self.freq = self.list[self.listIndex]
+        elif head in ("POW", "POW:AMPL"): self.power = float(args.upper().replace("DBM", ""))
+        elif head in ("POW?", "POW:AMPL?"): return "{:+.8E}".format(self.power)
+        elif head == "OUTP": self.outputOn = args.upper() in ("ON", "1")
+        elif head == "OUTP?": return "1" if self.outputOn else "0"
+        elif head.startswith("OUTP:MOD"): pass
+        else: return super().handle(command)
+
+    def drive(self):
+        return 10 ** (self.power / 10) if self.outputOn else 0.0
+
+
+class Sim6221(SimInstrument):
+    name = "KEITHLEY INSTRUMENTS INC.,MODEL 6221, SIMULATED"
+    def __init__(self, setup, latency, outputOn=True):
+        super().__init__(setup, latency)
+        self.freq, self.amplitude, self.outputOn = 573.1, 0.01, outputOn
+        self.armed = False
+
+    def handle(self, command):
+        head, args = _normalize(command)
+        if head == "WAVE:FREQ": self.freq = float(args)
+        elif head == "WAVE:FREQ?": return "{:.4E}".format(self.freq)
+        elif head == "WAVE:AMPL": self.amplitude = float(args)
+        elif head == "WAVE:AMPL?": return "{:.4E}".format(self.amplitude)
+        elif head == "WAVE:ARM": self.armed = True
+        elif head == "WAVE:INIT": self.outputOn = self.armed
+        elif head == "WAVE:ABOR": self.outputOn = self.armed = False
+        elif head == "OUTP:STAT?": return "1" if self.outputOn else "0"
+        elif head in ("CURR:COMP", "WAVE:OFFS", "WAVE:PMAR:STAT", "WAVE:DUR:TIME"): pass
+        else: return super().handle(command)
+
+    def drive(self):
+        #The derivative signal is linear in the (small) modulation amplitude. Normalized to 10mA
+        return self.amplitude / 0.01 if self.outputOn else 0.0
+
+
+class SimSR830(SimInstrument):
+    """SR830 with a cascaded RC output filter (1~4 poles per OFSL), quantized outputs that clip
+    at the sensitivity full scale, LIAS? overload bits and the internal data buffer"""
+    name = "Stanford_Research_Systems,SR830,s/n00000,ver1.07 SIMULATED"
+    def __init__(self, setup, latency, sens=20, timeConst=8, slope=3):
+        super().__init__(setup, latency)
+        self.sens, self.timeConst_i, self.slope = sens, timeConst, slope
+        self.phase = 0.0
+        self._state, self._tLast = None, None
+        self._overload = 0
+        self.displays = {1: 0, 2: 0} #DDEF 1,0 -> X, DDEF 2,0 -> Y
+        self.sampleRate_i, self.bufferLoop = 10, 0
+        self.buffer, self._bufferStart, self._bufferNext = [], None, None
+
+    @property
+    def tau(self):
+        return SR830_TimeConsts[self.timeConst_i]
+
+    def _target(self, t):
+        """Complex (X + iY) the lock-in would read with an infinitely fast filter at time t"""
+        s = self.setup
+        drive = s.rfSource.drive() * s.acSource.drive()
+        if not drive: return 0j
+        value = s.sample.signal(s.ppms.fieldAt(t), s.rfSource.freq / 1e9, s.ppms.temperatureAt(t), drive)
+        return value * np.exp(1j * (s.sample.phase - np.deg2rad(self.phase)))
+
+    def _advance(self, t):
+        """Integrate the output filter up to time t"""
+        nPoles = self.slope + 1
+        if self._state is None or t - self._tLast > 20 * self.tau:
+            self._state, self._tLast = [self._target(t)] * nPoles, t
+            return
+        steps = min(400, max(1, int(math.ceil((t - self._tLast) / (0.25 * self.tau)))))
+        h = (t - self._tLast) / steps
+        k = 1 - math.exp(-h / self.tau)
+        for n in range(1, steps + 1):
+            value = self._target(self._tLast + n * h)
+            for p in range(nPoles):
+                self._state[p] += (value - self._state[p]) * k
+                value = self._state[p]
+        self._tLast = t
+
+    def _read(self, t=None):
+        """Filtered output at time t with noise, clipping and quantization applied"""
+        t = self.clock.time() if t is None else t
+        self._advance(t)
+        noise = self.setup.sample.noise * math.sqrt(0.1 / self.tau)
+        value = self._state[-1] + noise * complex(self.setup.rng.normal(), self.setup.rng.normal())
+        fullScale = SR830_Sensitivities[self.sens]
+        x, y = value.real, value.imag
+        if max(abs(x), abs(y)) > fullScale: self._overload |= 4
+        x, y = [max(-1.09 * fullScale, min(1.09 * fullScale, v)) for v in (x, y)]
+        resolution = fullScale * 1e-4
+        return round(x / resolution) * resolution, round(y / resolution) * resolution
+
+    def _output(self, i, t=None):
+        x, y = self._read(t)
+        return {1: x, 2: y, 3: math.hypot(x, y), 4: math.degrees(math.atan2(y, x))}[i]
+
+    def _fillBuffer(self, t):
+        if self._bufferStart is None: return
+        dt = 1 / SR830_SampleRates[self.sampleRate_i]
+        while self._bufferNext <= t and len(self.buffer) < SR830_BufferSize:
+            x, y = self._read(self._bufferNext)
+            self.buffer.append((x, y))
+            self._bufferNext += dt
+
+    def handle(self, command):
+        head, args = _normalize(command)
+        now = self.clock.time()
+        if head == "OUTP?": return "{:.6e}".format(self._output(int(args)))
+        if head == "SNAP?":
+            x, y = self._read(now)
+            values = {1: x, 2: y, 3: math.hypot(x, y), 4: math.degrees(math.atan2(y, x))}
+            return ",".join("{:.6e}".format(values.get(int(i), 0.0)) for i in args.split(','))
+        if head == "SENS?": return str(self.sens)
+        if head == "SENS": self.sens = int(args)
+        elif head == "OFLT?": return str(self.timeConst_i)
+        elif head == "OFLT":
+            self._advance(now)
+            self.timeConst_i = int(args)
+        elif head == "OFSL?": return str(self.slope)
+        elif head == "OFSL":
+            self._advance(now)
+            self.slope, self._state = int(args), None
+        elif head == "FREQ?": return "{:.3f}".format(self.setup.acSource.freq)
+        elif head == "PHAS?": return "{:.2f}".format(self.phase)
+        elif head == "PHAS":
+            self._advance(now)
+            self.phase, self._state = float(args), None
+        elif head == "APHS":
+            self._advance(now)
+            self.phase, self._state = math.degrees(self.setup.sample.phase), None
+        elif head == "LIAS?":
+            self._read(now)
+            status, self._overload = self._overload, 0
+            return str((status >> int(args)) & 1 if args else status)
+        elif head == "DDEF":
+            i, j = [int(a) for a in args.split(',')[:2]]
+            self.displays[i] = j
+        elif head == "SRAT": self.sampleRate_i = int(args)
+        elif head == "SRAT?": return str(self.sampleRate_i)
+        elif head == "SEND": self.bufferLoop = int(args)
+        elif head == "REST": self.buffer, self._bufferStart = [], None
+        elif head == "STRT":
+            self._advance(now)
+            self._bufferStart = self._bufferNext = now
+        elif head == "PAUS":
+            self._fillBuffer(now)
+            self._bufferStart = None
+        elif head == "SPTS?":
+            self._fillBuffer(now)
+            return str(len(self.buffer))
+        elif head == "TRCA?":
+            i, start, n = [int(a) for a in args.split(',')]
+            self._fillBuffer(now)
+            return ",".join("{:.6e}".format(v[i - 1]) for v in self.buffer[start:start + n]) + ","
+        else: return super().handle(command)
+
+    def query_binary_values(self, command, datatype='f', is_big_endian=False, container=list, **kwargs):
+        """TRCB? i,start,n. pyvisa already decodes the IEEE floats of the real instrument"""
+        with self.lock:
+            head, args = _normalize(command)
+            if head != "TRCB?": raise ValueError("{} is not a binary query".format(command))
+            i, start, n = [int(a) for a in args.split(',')]
+            self._fillBuffer(self.clock.time())
+            values = [v[i - 1] for v in self.buffer[start:start + n]]
+            self._spend("query", command)
+            self.clock.sleep(4 * len(values) * self.latency.get("byte", 0), "io")
+            return container(values)
+
+
+class SimDynacool:
+    """Same methods and return values as PPMS_FMR.Dynacool, e.g. getField() -> (0, field, status).
+    The magnet ramps linearly at the requested rate and the temperature at rate K/min"""
+    def __init__(self, setup, latency=0.03, field=0.0, temperature=300.0, fieldNoise=0.05):
+        self.setup, self.clock = setup, setup.clock
+        self.latency, self.fieldNoise = latency, fieldNoise
+        self.lock = threading.RLock()
+        self.ioTime, self.commandCounts = 0.0, {}
+        now = self.clock.time()
+        self._fieldRamp = (now, field, field, 100.0) #(start time, start, target, rate)
+        self._tempRamp = (now, temperature, temperature, 20.0 / 60)
+        self.fieldSettle, self.tempSettle = 1.0, 60.0 #Time the PPMS takes to declare stable
+
+    def _spend(self, name):
+        with self.lock:
+            lat = self.latency * (1 + self.setup.jitter * (2 * self.setup.rng.random() - 1))
+            self.clock.sleep(lat, "io")
+            self.ioTime += lat
+            self.commandCounts[name] = self.commandCounts.get(name, 0) + 1
+
+    @staticmethod
+    def _rampValue(ramp, t):
+        t0, start, target, rate = ramp
+        if rate <= 0: return target
+        travelled = max(0.0, t - t0) * rate
+        if travelled >= abs(target - start): return target
+        return start + math.copysign(travelled, target - start)
+
+    @staticmethod
+    def _rampEnd(ramp):
+        t0, start, target, rate = ramp
+        return t0 + (abs(target - start) / rate if rate > 0 else 0)
+
+    def fieldAt(self, t):
+        return self._rampValue(self._fieldRamp, t)
+
+    def temperatureAt(self, t):
+        return self._rampValue(self._tempRamp, t)
+
+    def getTemperature(self):
+        self._spend("getTemperature")
+        return (0, self.temperatureAt(self.clock.time()), 1)
+
+    def setTemperature(self, temp, rate=20):
+        self._spend("setTemperature")
+        now = self.clock.time()
+        self._tempRamp = (now, self.temperatureAt(now), float(temp), rate / 60)
+        return 0
+
+    def waitForTemperature(self, delay=5, timeout=5400):
+        self._spend("waitForTemperature")
+        remaining = self._rampEnd(self._tempRamp) - self.clock.time()
+        self.clock.sleep(min(timeout, max(0, remaining) + self.tempSettle + delay), "temperature")
+        return 0
+
+    def getField(self):
+        self._spend("getField")
+        return (0, self.fieldAt(self.clock.time()) + self.fieldNoise * self.setup.rng.normal(), 4)
+
+    def setField(self, field, rate=100, persistent=False):
+        self._spend("setField")
+        now = self.clock.time()
+        self._fieldRamp = (now, self.fieldAt(now), float(field), float(rate))
+        return 0
+
+    def waitForField(self, delay=5, timeout=3600):
+        self._spend("waitForField")
+        remaining = self._rampEnd(self._fieldRamp) - self.clock.time()
+        self.clock.sleep(min(timeout, max(0, remaining) + self.fieldSettle + delay), "magnet")
+        return 0
+
+
+DEFAULT_GPIB_LATENCY = {"write": 0.004, "query": 0.012, "byte": 2e-6}
+
+class SimulatedSetup:
+    """All four simulated instruments sharing one clock and one sample.
+        setup = SimulatedSetup(sample=SimSample(Meff=230), speedup=None)
+        app.ppms, app.lockin, app.rfPower, app.acMod = setup.ppms, setup.lockin, setup.rfSource, setup.acSource
+    latencyScale multiplies every command latency, e.g. 0 for an ideal bus."""
+    def __init__(self, sample=None, clock=None, speedup=None, latencyScale=1.0, ppmsLatency=0.03,
+                 jitter=0.2, seed=0, outputsOn=True, temperature=300.0):
+        self.sample = sample or SimSample()
+        self.clock = clock or SimClock(speedup)
+        self.rng = np.random.default_rng(seed)
+        self.jitter = jitter
+        gpib = {k: v * latencyScale for k, v in DEFAULT_GPIB_LATENCY.items()}
+        self.ppms = SimDynacool(self, ppmsLatency * latencyScale, temperature=temperature)
+        self.rfSource = SimN5183(self, gpib, outputOn=outputsOn)
+        self.acSource = Sim6221(self, gpib, outputOn=outputsOn)
+        self.lockin = SimSR830(self, gpib)
+
+    @property
+    def instruments(self):
+        return {"PPMS": self.ppms, "N5183": self.rfSource, "6221": self.acSource, "SR830": self.lockin}
+
+    def ioTime(self):
+        return sum(instrument.ioTime for instrument in self.instruments.values())
+
+    def open_resource(self, address):
+        """Stand-in for pyvisa.ResourceManager().open_resource with the default GUI addresses"""
+        return {"GPIB0::27::INSTR": self.acSource, "GPIB0::11::INSTR": self.rfSource,
+                "GPIB0::8::INSTR": self.lockin}[address]
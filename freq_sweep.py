@@ -0,0 +1,80 @@
+"""Frequency-swept acquisition at a fixed field.
+
+The PPMS field is parked at the resonance field of a Freq:Field pair and the N5183 steps through a
+list of frequencies around that frequency. The list is loaded once (:LIST:FREQ) and every *TRG hops to
+the next frequency, which is much faster than moving the magnet. The field grids made by the usual
+generators are turned into frequency grids with the slope df/dH of the Freq:Field pairs.
+"""
+import numpy as np
+from Common_FuncsClasses import gamma_0
+
+N5183_MaxListPoints = 1601
+
+
+def kittelSlope(Hres_atFreqs):
+    """df/dH in GHz/G at each frequency, from the Freq:Field pairs. With a single pair the
+    high field limit gamma/2pi is used"""
+    freqs = sorted(Hres_atFreqs)
+    if len(freqs) == 1: return {freqs[0]: gamma_0 / (2 * np.pi)}
+    fields = [Hres_atFreqs[f] for f in freqs]
+    slopes = np.gradient(np.array(freqs, dtype=float), np.array(fields, dtype=float))
+    return {f: abs(slope) for f, slope in zip(freqs, slopes)}
+
+
+def frequencyGrids(fields2Scan_atFreqs):
+    """{freq: [fields]} from the field grid generators -> {freq: (center field, [freqs])}.
+    A field offset dH from the center becomes a frequency offset dH * df/dH"""
+    centers = {freq: round(0.5 * (min(fields) + max(fields)), 1) for freq, fields in fields2Scan_atFreqs.items()}
+    slopes = kittelSlope(centers)
+    grids = {}
+    for freq, fields in fields2Scan_atFreqs.items():
+        freqs = [round(freq + (field - centers[freq]) * slopes[freq], 6) for field in fields]
+        grids[freq] = (centers[freq], freqs)
+    return grids
+
+
+class N5183List:
+    """with N5183List(rfSource, freqs) as hops:   #freqs in GHz
+        for freq in hops: ...                   #the source is at freq inside the loop
+    The source goes back to CW mode at the end."""
+    def __init__(self, rfSource, freqs, dwell=0.001):
+        if len(freqs) > N5183_MaxListPoints: raise ValueError("The N5183 list holds at most {} points".format(N5183_MaxListPoints))
+        self.rfSource, self.freqs, self.dwell = rfSource, list(freqs), dwell
+
+    def __enter__(self):
+        self.rfSource.write(":LIST:TYPE LIST")
+        self.rfSource.write(":LIST:FREQ " + ",".join("{:.6f}GHz".format(f) for f in self.freqs))
+        self.rfSource.write(":LIST:DWEL {}".format(self.dwell))
+        self.rfSource.write(":LIST:TRIG:SOUR BUS") #Every *TRG moves to the next point
+        self.rfSource.write(":INIT:CONT OFF")
+        self.rfSource.write(":FREQ:MODE LIST")
+        self.rfSource.write(":INIT") #Arms the list. The source sits at the first frequency
+        return self
+
+    def __iter__(self):
+        for i, freq in enumerate(self.freqs):
+            if i: self.rfSource.write("*TRG")
+            yield freq
+
+    def __exit__(self, *args):
+        self.rfSource.write(":FREQ:MODE CW")
+
+
+class FrequencySweep:
+    """sweep = FrequencySweep(ppms, rfSource, reader, field, freqs)
+    sweep.run(waitTime, onPoint=lambda freq, fieldActual, x, y, xErr, yErr: ..., shouldStop=lambda: not flag)
+    reader is a lockin_control.LockinReader"""
+    def __init__(self, ppms, rfSource, reader, field, freqs):
+        self.ppms, self.rfSource, self.reader = ppms, rfSource, reader
+        self.field, self.freqs = field, list(freqs)
+
+    def run(self, waitTime, onPoint, shouldStop=None, rate=100):
+        self.ppms.setField(self.field, rate)
+        self.ppms.waitForField(timeout=240)
+        fieldActual = self.ppms.getField()[1]
+        with N5183List(self.rfSource, self.freqs) as hops:
+            for freq in hops:
+                if shouldStop and shouldStop(): return False
+                x, y, xErr, yErr = self.reader.read(waitTime)
+                onPoint(freq, fieldActual, x, y, xErr, yErr)
+        return True
@@ -0,0 +1,85 @@
+"""Several frequencies measured at every magnet setpoint.
+
+Frequencies whose field windows overlap are grouped, and their field grids are merged into one grid.
+At each settled field the N5183 hops through every frequency of the group whose window contains that
+field, and the lock-in is read once per frequency. The points are handed back per frequency, so they
+can be written to the usual per-frequency files.
+"""
+import numpy as np
+
+
+def overlapGroups(fields2Scan_atFreqs):
+    """[[freq, ...], ...]. The frequencies in a group have overlapping (or touching) field windows"""
+    windows = sorted((min(fields), max(fields), freq) for freq, fields in fields2Scan_atFreqs.items())
+    groups, groupEnd = [], None
+    for low, high, freq in windows:
+        if groups and low <= groupEnd:
+            groups[-1].append(freq)
+            groupEnd = max(groupEnd, high)
+        else:
+            groups.append([freq])
+            groupEnd = high
+    return groups
+
+
+def mergedGrid(fields2Scan_atFreqs, group, reverse=False, tolerance=None):
+    """Union of the field grids of the group. Fields closer than tolerance (default: half of the
+    smallest step) are measured once. Returns [(field, [freqs whose window contains the field]), ...]"""
+    fields = np.unique(np.concatenate([np.asarray(fields2Scan_atFreqs[freq], dtype=float) for freq in group]))
+    if tolerance is None:
+        steps = [np.min(np.abs(np.diff(fields2Scan_atFreqs[freq]))) for freq in group if len(fields2Scan_atFreqs[freq]) > 1]
+        tolerance = 0.5 * min(steps) if steps else 0
+    merged = [fields[0]]
+    for field in fields[1:]:
+        if field - merged[-1] > tolerance: merged.append(field)
+    windows = {freq: (min(fields2Scan_atFreqs[freq]), max(fields2Scan_atFreqs[freq])) for freq in group}
+    grid = [(round(field, 1), [freq for freq in sorted(group) if windows[freq][0] - tolerance <= field <= windows[freq][1] + tolerance])
+            for field in merged]
+    return grid[::-1] if reverse else grid
+
+
+class InterleavedScan:
+    """scan = InterleavedScan(ppms, rfSource, reader, fields2Scan_atFreqs)
+    scan.run(waitTime, onPoint=lambda freq, field, fieldActual, x, y, xErr, yErr: ..., shouldStop=...)
+    reader is a lockin_control.LockinReader"""
+    def __init__(self, ppms, rfSource, reader, fields2Scan_atFreqs, reverse=False):
+        self.ppms, self.rfSource, self.reader = ppms, rfSource, reader
+        self.fields2Scan_atFreqs, self.reverse = fields2Scan_atFreqs, reverse
+        self.groups = overlapGroups(fields2Scan_atFreqs)
+
+    def fieldsOfFreqs(self):
+        """{freq: [fields]} the scan measures each frequency at, from the merged grids"""
+        fields = {freq: [] for freq in self.fields2Scan_atFreqs}
+        for group in (self.groups[::-1] if self.reverse else self.groups):
+            for field, freqs in mergedGrid(self.fields2Scan_atFreqs, group, self.reverse):
+                for freq in freqs: fields[freq].append(field)
+        return fields
+
+    def run(self, waitTime, onPoint, shouldStop=None, shouldSkip=None, onGroup=None, rate=100, remaining=None):
+        """Returns False if shouldStop() ended the scan. shouldSkip() ends the current group early.
+        onGroup(freqs) is called before each group. remaining: {freq: fields of fieldsOfFreqs()} to measure,
+        e.g. of a resumed scan. Groups with nothing left are passed over"""
+        remaining = {freq: set(fields) for freq, fields in remaining.items()} if remaining is not None else None
+        for group in (self.groups[::-1] if self.reverse else self.groups):
+            grid = mergedGrid(self.fields2Scan_atFreqs, group, self.reverse)
+            if remaining is not None:
+                grid = [(field, [freq for freq in freqs if field in remaining[freq]]) for field, freqs in grid]
+                grid = [(field, freqs) for field, freqs in grid if freqs]
+                if not grid: continue
+            if onGroup: onGroup(group)
+            self.ppms.setField(grid[0][0], rate)
+            self.ppms.waitForField(timeout=240)
+            currentFreq = None
+            for field, freqs in grid:
+                if shouldStop and shouldStop(): return False
+                if shouldSkip and shouldSkip(): break
+                self.ppms.setField(field, rate)
+                #Keep the frequency of the last point first, so one hop is saved at every field
+                if currentFreq in freqs: freqs = [currentFreq] + [f for f in freqs if f != currentFreq]
+                for freq in freqs:
+                    if freq != currentFreq:
+                        self.rfSource.write(":SOUR:FREQ:CW {}GHz".format(freq))
+                        currentFreq = freq
+                    x, y, xErr, yErr = self.reader.read(waitTime)
+                    onPoint(freq, field, self.ppms.getField()[1], x, y, xErr, yErr)
+        return True
@@ -0,0 +1,127 @@
+"""Latency tracing of the instrument I/O, the waits and the file/plot work of a scan.
+
+    lockin = TracedInstrument(lockin, "SR830")    #every method call is timed
+    with tracer.span("settle", "sleep"): time.sleep(waitTime)
+    tracer.save("scan_trace.json")                #open in chrome://tracing or ui.perfetto.dev
+The instrument calls are also counted into latency histograms per instrument and command, see report().
+"""
+import json, threading, time
+from contextlib import contextmanager
+import numpy as np
+
+LatencyBins = np.logspace(-5, 3, 33) #Bin edges in s, 10us to 1000s with 4 bins per decade
+WaitCategories = {"waitForField": "magnet", "waitForTemperature": "temperature"}
+
+
+class Tracer:
+    def __init__(self, clock=time, enabled=True, maxEvents=500000):
+        self.clock, self.enabled, self.maxEvents = clock, enabled, maxEvents
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Start a new timeline and new histograms, e.g. at every scan"""
+        with self._lock:
+            self.events, self.threads, self.latencies = [], {}, {}
+            self.origin = self.clock.time()
+
+    def record(self, name, category, start, duration, instrument=None, args=None):
+        if not self.enabled: return
+        thread = threading.current_thread()
+        with self._lock:
+            self.threads[thread.ident] = thread.name
+            if len(self.events) < self.maxEvents:
+                self.events.append((name, category, start, duration, thread.ident, instrument, args))
+            if instrument is None: return
+            key = (instrument, name)
+            if key not in self.latencies: self.latencies[key] = [np.zeros(len(LatencyBins) + 1, dtype=int), 0.0, 0.0]
+            histogram = self.latencies[key]
+            histogram[0][np.searchsorted(LatencyBins, duration)] += 1
+            histogram[1] += duration
+            histogram[2] = max(histogram[2], duration)
+
+    @contextmanager
+    def span(self, name, category, instrument=None, **args):
+        start = self.clock.time()
+        try: yield
+        finally: self.record(name, category, start, self.clock.time() - start, instrument, args or None)
+
+    def histograms(self):
+        """{instrument: {command: {"bins": edges, "counts": [len(edges) + 1], "total": s, "max": s}}}
+        counts[i] is the number of calls with latency between edges[i - 1] and edges[i]"""
+        with self._lock: latencies = {key: (counts.copy(), total, longest) for key, (counts, total, longest) in self.latencies.items()}
+        result = {}
+        for (instrument, name), (counts, total, longest) in latencies.items():
+            result.setdefault(instrument, {})[name] = {"bins": LatencyBins.tolist(), "counts": counts.tolist(),
+                                                       "total": total, "max": longest}
+        return result
+
+    def categoryTotals(self):
+        """{category: seconds} of the recorded events, e.g. io, sleep, magnet, plot, file"""
+        totals = {}
+        with self._lock:
+            for name, category, start, duration, tid, instrument, args in self.events:
+                totals[category] = totals.get(category, 0.0) + duration
+        return totals
+
+    def report(self, top=12):
+        """Text of the time per category and a table of the commands that took the most time"""
+        rows = []
+        for instrument, commands in self.histograms().items():
+            for name, h in commands.items():
+                n = sum(h["counts"])
+                #Median from the histogram: middle of the (log) bin holding the middle call
+                i = np.searchsorted(np.cumsum(h["counts"]), (n + 1) / 2)
+                edges = np.concatenate([[LatencyBins[0]], LatencyBins, [LatencyBins[-1]]])
+                median = min(np.sqrt(edges[i] * edges[i + 1]), h["max"])
+                rows.append((h["total"], instrument, name, n, median, h["max"]))
+        lines = ["  ".join("{} {:.3f}s".format(category, total) for category, total in sorted(self.categoryTotals().items()))]
+        lines.append("{:<8}{:<28}{:>7}{:>11}{:>11}{:>11}".format("Instr", "Command", "Calls", "Total(s)", "Median(s)", "Max(s)"))
+        for total, instrument, name, n, median, longest in sorted(rows, reverse=True)[:top]:
+            lines.append("{:<8}{:<28}{:>7d}{:>11.3f}{:>11.2g}{:>11.3f}".format(instrument, name[:27], n, total, median, longest))
+        return "\n".join(lines)
+
+    def traceEvents(self):
+        """The timeline as Chrome trace events (complete events, times in us)"""
+        with self._lock: events, threads, origin = list(self.events), dict(self.threads), self.origin
+        trace = [{"name": "thread_name", "ph": "M", "pid": 0, "tid": tid, "args": {"name": name}} for tid, name in threads.items()]
+        for name, category, start, duration, tid, instrument, args in events:
+            event = {"name": name if instrument is None else "{} {}".format(instrument, name), "cat": category, "ph": "X",
+                     "ts": round(1e6 * (start - origin), 1), "dur": round(1e6 * duration, 1), "pid": 0, "tid": tid}
+            if args: event["args"] = args
+            trace.append(event)
+        return trace
+
+    def save(self, path):
+        """Write the trace of the scan, with the latency histograms under "latencyHistograms" """
+        if not self.enabled: return None
+        with open(path, "w") as file:
+            json.dump({"traceEvents": self.traceEvents(), "displayTimeUnit": "ms",
+                       "latencyHistograms": self.histograms()}, file)
+        return path
+
+
+tracer = Tracer() #Shared by the whole program, so the module level functions can trace their waits
+
+
+class TracedInstrument:
+    """Times every method call of a pyvisa resource or the Dynacool object. The event is named after
+    the method and the first word of the command, e.g. "query SNAP?" or "getField" """
+    def __init__(self, instrument, name, tracer=tracer):
+        self.instrument, self.name, self.tracer = instrument, name, tracer
+
+    def __getattr__(self, method):
+        attribute = getattr(self.instrument, method)
+        if not callable(attribute): return attribute
+        category = WaitCategories.get(method, "io")
+        def traced(*args, **kwargs):
+            name, command = method, None
+            if args and isinstance(args[0], str):
+                command = args[0].strip()
+                name = "{} {}".format(method, command.split()[0] if command else "")
+            start = self.tracer.clock.time()
+            try: return attribute(*args, **kwargs)
+            finally:
+                self.tracer.record(name, category, start, self.tracer.clock.time() - start, self.name,
+                                   {"command": command[:80]} if command else None)
+        return traced
@@ -0,0 +1,83 @@
+"""Live plot of the running field scan.
+
+The measurement thread appends each point to an in-memory buffer, and the GUI timer redraws the
+existing line artists only when new points came in. The rendered RGBA buffer goes straight into a
+wx.Bitmap, and the PNG next to the csv is written once when the scan of a frequency ends.
+"""
+import threading
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from io_trace import tracer
+
+
+class LivePlot:
+    def __init__(self, width=360, height=240, dpi=100, plotTotal=False):
+        self.plotTotal = plotTotal
+        self.fig = Figure(figsize=(width / dpi, height / dpi), dpi=dpi)
+        self.canvas = FigureCanvasAgg(self.fig)
+        self.ax = self.fig.add_subplot(111)
+        self.ax.set_xlabel("Field (G)")
+        self.ax.set_ylabel("Lockin_Ave")
+        self.ax.grid(True)
+        self.line_X, = self.ax.plot([], [], '-bo', markersize=3)
+        self.line_Y, = self.ax.plot([], [], '-ro', markersize=3)
+        self.line_Total, = self.ax.plot([], [], '--y')
+        self.fig.tight_layout()
+        self._dataLock = threading.Lock() #Held only briefly, so append() never waits for a redraw
+        self._drawLock = threading.Lock()
+        self.version, self._drawnVersion = 0, -1
+        self.reset()
+
+    def reset(self, title="", xlabel="Field (G)"):
+        """Start a new scan, e.g. at every frequency"""
+        with self._dataLock:
+            self.data = np.empty((256, 3)) #Field, X, Y. Doubles in size when full
+            self.n, self.title, self.xlabel = 0, title, xlabel
+            self.version += 1
+
+    def append(self, field, x, y):
+        """Called by the measurement thread for every point"""
+        with self._dataLock:
+            if self.n == len(self.data):
+                self.data = np.concatenate([self.data, np.empty_like(self.data)])
+            self.data[self.n] = field, x, y
+            self.n += 1
+            self.version += 1
+
+    def _update(self, force=False):
+        with self._dataLock:
+            if self.version == self._drawnVersion and not force: return False
+            data, version, title, xlabel = self.data[:self.n].copy(), self.version, self.title, self.xlabel
+        fields, X, Y = data[np.argsort(data[:, 0], kind="stable")].T #Adaptive scans come in any order
+        self.line_X.set_data(fields, X)
+        self.line_Y.set_data(fields, Y)
+        if self.plotTotal:
+            total = np.sqrt(X ** 2 + Y ** 2)
+            self.line_Total.set_data(fields, np.where(X >= 0, total, -total))
+            self.ax.legend(['X', 'Y', "Total"], loc="upper right", fontsize="small")
+        else:
+            self.line_Total.set_data([], [])
+            self.ax.legend(['X', 'Y'], loc="upper right", fontsize="small")
+        self.ax.set_title(title, fontsize="small")
+        self.ax.set_xlabel(xlabel)
+        self.ax.relim()
+        self.ax.autoscale_view()
+        self.canvas.draw()
+        self._drawnVersion = version
+        return True
+
+    def render(self):
+        """Redraw if there are new points. Returns (width, height, rgba bytes) for
+        wx.Bitmap.FromBufferRGBA, or None if nothing changed since the last call"""
+        with self._drawLock, tracer.span("render", "plot"):
+            if not self._update(): return None
+            width, height = self.canvas.get_width_height()
+            return width, height, bytes(self.canvas.buffer_rgba())
+
+    def save(self, figName, dpi=200):
+        """Write the PNG of the current scan. Called once when the scan of a frequency ends"""
+        with self._drawLock, tracer.span("save png", "plot"):
+            self._update(force=True)
+            self.fig.savefig(figName, dpi=dpi)
+        return figName
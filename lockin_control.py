@@ -0,0 +1,214 @@
+"""Reading the SR830 lock-in with as few GPIB transactions as possible.
+
+Modes of LockinReader:
+    "query"  - OUTP? 1 and OUTP? 2 for every sample, like the original lockinRead
+    "snap"   - SNAP? 1,2 returns X and Y of the same instant in one transaction
+    "buffer" - the SR830 fills its internal buffer at SRAT, then each channel comes back in one binary TRCB? transfer
+The samples are reduced with a trimmed mean (or median) and its standard error, kept with each point.
+AutoRange wraps a LockinReader and steps the sensitivity (SENS) so the points neither overload nor sit at
+the bottom of the range.
+"""
+import time
+import numpy as np
+from io_trace import tracer
+
+LockinReadModes = ["query", "snap", "buffer"]
+#SRAT 0~13 in Hz
+SR830_SampleRates = [62.5e-3 * 2 ** n for n in range(14)]
+SR830_TimeConsts = [10e-6, 30e-6, 100e-6, 300e-6, 1e-3, 3e-3, 10e-3, 30e-3, 100e-3, 300e-3,
+                    1, 3, 10, 30, 100, 300, 1e3, 3e3, 10e3, 30e3]
+#Full scale in V of SENS 0~26
+SR830_Sensitivities = [2e-9, 5e-9, 1e-8, 2e-8, 5e-8, 1e-7, 2e-7, 5e-7, 1e-6, 2e-6, 5e-6, 1e-5, 2e-5, 5e-5,
+                       1e-4, 2e-4, 5e-4, 1e-3, 2e-3, 5e-3, 1e-2, 2e-2, 5e-2, 1e-1, 2e-1, 5e-1, 1.0]
+OverloadBits = 0b111 #LIAS? bits 0~2: input (reserve), time constant filter and output overload
+
+
+def robustMean(samples, trim=0.2, estimator="trimmed"):
+    """Reduce samples of shape (n, channels) along the first axis.
+    "trimmed": mean after discarding the highest and lowest trim fraction (1 each out of 5 at 0.2),
+               error from the winsorized standard deviation.
+    "median":  median, error 1.2533*std/sqrt(n).
+    Returns (estimate, standard error), each of shape (channels,)"""
+    samples = np.sort(np.asarray(samples, dtype=float), axis=0)
+    n = len(samples)
+    if n == 1: return samples[0], np.zeros(samples.shape[1:])
+    if estimator == "median":
+        return np.median(samples, axis=0), 1.2533 * samples.std(axis=0, ddof=1) / np.sqrt(n)
+    k = min(int(trim * n), (n - 1) // 2)
+    kept = samples[k:n - k]
+    winsorized = np.clip(samples, kept[0], kept[-1])
+    error = winsorized.std(axis=0, ddof=1) / ((1 - 2 * k / n) * np.sqrt(n))
+    return kept.mean(axis=0), error
+
+
+class LockinReader:
+    """reader = LockinReader(lockin, mode="snap")
+    reader.configure()                       #once per scan, after the time constant is set
+    x, y, xErr, yErr = reader.read(waitTime) #every point
+    interval is the separation of the samples in s. By default one time constant, so they are not correlated"""
+    def __init__(self, lockin, mode="snap", samples=5, interval=None, estimator="trimmed", trim=0.2):
+        if mode not in LockinReadModes: raise ValueError("Unknown lock-in read mode {}".format(mode))
+        self.lockin, self.mode, self.samples = lockin, mode, samples
+        self.interval, self.estimator, self.trim = interval, estimator, trim
+        self.sampleRate_i = None
+        self._ahead = None
+
+    def configure(self):
+        interval = self.interval
+        if interval is None:
+            interval = SR830_TimeConsts[int(self.lockin.query("OFLT?").strip())]
+        self._interval = interval
+        if self.mode == "buffer":
+            #Fastest rate whose sample separation is still >= interval
+            rates = [i for i, rate in enumerate(SR830_SampleRates) if 1 / rate >= interval]
+            self.sampleRate_i = rates[-1] if rates else 0
+            self.lockin.write("DDEF 1,0,0") #Channel 1 display is X
+            self.lockin.write("DDEF 2,0,0") #Channel 2 display is Y
+            self.lockin.write("SRAT {}".format(self.sampleRate_i))
+            self.lockin.write("SEND 0") #Stop when the buffer is full
+        return self
+
+    def _sleep(self, seconds, remaining, name="sample interval"):
+        """Sleep. remaining is the time from the end of the sleep to the last sample. A pending ahead
+        callback (see read()) is run during the sleep at lead seconds before the last sample"""
+        ahead = self._ahead
+        if ahead and remaining <= ahead[0]:
+            self._ahead = None
+            first = max(0.0, min(seconds, seconds + remaining - ahead[0]))
+            with tracer.span(name, "sleep"): time.sleep(first)
+            start = time.time()
+            ahead[1]()
+            seconds = seconds - first - (time.time() - start)
+        with tracer.span(name, "sleep"): time.sleep(max(0.0, seconds))
+
+    def acquire(self):
+        """Raw samples of shape (n, 2) with columns X and Y"""
+        if self.mode == "query":
+            samples = []
+            for i in range(self.samples):
+                self._sleep(self._interval, (self.samples - 1 - i) * self._interval)
+                samples.append((float(self.lockin.query("OUTP? 1")), float(self.lockin.query("OUTP? 2"))))
+            return np.array(samples)
+        if self.mode == "snap":
+            samples = []
+            for i in range(self.samples):
+                if i: self._sleep(self._interval, (self.samples - 1 - i) * self._interval)
+                samples.append([float(v) for v in self.lockin.query("SNAP? 1,2").split(',')])
+            return np.array(samples)
+        return self._acquireBuffer()
+
+    def _acquireBuffer(self):
+        n, rate = self.samples, SR830_SampleRates[self.sampleRate_i]
+        self.lockin.write("REST")
+        self.lockin.write("STRT")
+        self._sleep(n / rate, 0.0, "buffer fill")
+        for attempt in range(20):
+            stored = int(self.lockin.query("SPTS?").strip())
+            if stored >= n: break
+            with tracer.span("buffer fill", "sleep"): time.sleep((n - stored) / rate)
+        self.lockin.write("PAUS")
+        n = min(n, stored)
+        channels = [self.lockin.query_binary_values("TRCB? {},0,{}".format(i, n), datatype='f', is_big_endian=False,
+                                                    header_fmt='empty', expect_termination=False, data_points=n)
+                    for i in (1, 2)]
+        return np.column_stack(channels)
+
+    def sampleOffsets(self):
+        """Times of the samples after the end of the wait in read(), ignoring the bus time"""
+        if not hasattr(self, "_interval"): self.configure()
+        if self.mode == "buffer":
+            rate = SR830_SampleRates[self.sampleRate_i]
+            return [(i + 1) / rate for i in range(self.samples)]
+        return [(i + (self.mode == "query")) * self._interval for i in range(self.samples)]
+
+    def read(self, waitTime=0, ahead=None):
+        """Wait waitTime (s) for the signal to settle, then return X, Y and their standard errors.
+        ahead = (lead, callback): callback() is run lead seconds before the last sample is taken, e.g. to
+        command the next field while the current point is still being read (settle_scheduler)"""
+        if not hasattr(self, "_interval"): self.configure()
+        self._ahead = ahead
+        self._sleep(waitTime, self.sampleOffsets()[-1], "settle")
+        samples = self.acquire()
+        if self._ahead: #Not run during the read, e.g. a single sample
+            self._ahead = None
+            ahead[1]()
+        (x, y), (xErr, yErr) = robustMean(samples, self.trim, self.estimator)
+        return x, y, xErr, yErr
+
+
+def fullScaleOf(lockin):
+    """Full scale in V of the present SENS"""
+    return SR830_Sensitivities[int(lockin.query("SENS?").strip())]
+
+
+class AutoRange:
+    """Keeps the SR830 sensitivity where the signal uses its range, around the reads of a LockinReader:
+        reader = AutoRange(LockinReader(lockin)).configure()
+        reader.probe(ppms, [H1, Hres, H2], waitTime)   #pre-select the range from where the line is expected
+        x, y, xErr, yErr = reader.read(waitTime)        #as LockinReader.read
+        reader.readAt                                   #full scale in V the last point was read at
+    A point that overloads (LIAS? bits 0~2, or X or Y above high x full scale) is read again less sensitive.
+    Without an ahead callback that is done in read() after `settle` time constants; with one the magnet has
+    already left for the next field, so read() sets redo and the caller steps the point again. Between points
+    the range only goes more sensitive while the largest signal of the scan so far (or probed) stays below
+    target x full scale, so the wings of the line do not take it below what the resonance needs."""
+    def __init__(self, reader, target=0.4, high=0.9, settle=3, minSens=0):
+        self.reader, self.lockin = reader, reader.lockin
+        self.target, self.high, self.settle, self.minSens = target, high, settle, minSens
+        self.sens, self.peak, self.readAt, self.changes, self.redo = None, 0.0, None, 0, False
+
+    def __getattr__(self, name): #sampleOffsets, mode... of the reader
+        return getattr(self.reader, name)
+
+    def configure(self):
+        self.reader.configure()
+        self.sens = int(self.lockin.query("SENS?").strip())
+        self.tau = SR830_TimeConsts[int(self.lockin.query("OFLT?").strip())]
+        self.lockin.query("LIAS?") #Reading the status clears the bits latched before the scan
+        self.peak = 0.0
+        return self
+
+    @property
+    def fullScale(self):
+        return SR830_Sensitivities[self.sens]
+
+    def select(self, peak):
+        """The most sensitive SENS index whose full scale keeps peak below target"""
+        for i in range(self.minSens, len(SR830_Sensitivities)):
+            if peak <= self.target * SR830_Sensitivities[i]: return i
+        return len(SR830_Sensitivities) - 1
+
+    def setSens(self, sens):
+        with tracer.span("SENS {}".format(sens), "range"):
+            self.lockin.write("SENS {}".format(sens))
+            self.lockin.query("LIAS?") #The change itself may latch an overload
+        self.sens = sens
+        self.changes += 1
+
+    def read(self, waitTime=0, ahead=None):
+        self.redo = False
+        while True:
+            x, y, xErr, yErr = self.reader.read(waitTime, ahead)
+            magnitude, fullScale = max(abs(x), abs(y)), self.fullScale
+            status = int(self.lockin.query("LIAS?").strip()) & OverloadBits
+            if not status and magnitude <= self.high * fullScale or self.sens == len(SR830_Sensitivities) - 1: break
+            #A clipped or overloaded reading is only a lower bound of the signal: at least 2 steps up
+            bound = max(self.peak, magnitude if magnitude < fullScale and not status else 2.5 * fullScale)
+            self.setSens(max(self.select(bound), self.sens + 1))
+            if ahead is not None: #The magnet is on its way to the next field
+                self.redo = True
+                return x, y, xErr, yErr
+            waitTime = self.settle * self.tau
+        self.readAt, self.peak = fullScale, max(self.peak, magnitude)
+        if self.select(self.peak) < self.sens: self.setSens(self.select(self.peak)) #For the next point
+        return x, y, xErr, yErr
+
+    def probe(self, ppms, fields, waitTime, rate=100):
+        """Read at fields (e.g. the center and the extrema of the expected line) to start the scan in the range
+        of its largest signal. Returns that signal in V"""
+        with tracer.span("probe range", "range"):
+            for field in fields:
+                ppms.setField(field, rate)
+                ppms.waitForField(timeout=240)
+                self.read(waitTime)
+        return self.peak
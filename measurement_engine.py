@@ -0,0 +1,700 @@
+"""The scan loops of the FMR measurement, without wx.
+
+    engine = MeasurementEngine(ppms, lockin, rfPower, acMod, poller=poller)
+    plan = ScanPlan.fromText("Test", folder, "300: 0", "10: 2400, 12: 3000", linewidths=("4", "5"), stepSize="1")
+    engine.start(plan)     #on a thread. engine.run(plan) blocks, e.g. for unattended runs from a script
+    engine.skipRest()      #finish the scan of the current frequency early
+    engine.abort()
+The engine never touches a widget. What the GUI shows comes through engine.events: the GUI timer drains the
+queue and gets only the last event of each kind that just replaces a state (Coalesced). The measured
+values go to the StatusPoller as before.
+"""
+import os, threading, time
+import numpy
+from live_plot import LivePlot
+from data_writer import ScanWriter, loadScan
+from lockin_control import LockinReader, AutoRange, SR830_TimeConsts, fullScaleOf
+from field_sweep import FieldSweep
+from freq_sweep import FrequencySweep, frequencyGrids
+from interleaved_scan import InterleavedScan
+from adaptive_sampling import AdaptiveSampler
+from status_poller import LockedInstrument
+from io_trace import tracer, TracedInstrument
+from settle_scheduler import SettleScheduler, FixedSettle
+from async_instruments import AsyncSettle
+from run_journal import RunJournal, scanKey, remainingFields
+from sweep_planner import SweepPlanner, SweepOrders, TimingModel, TimingFile
+from resonance_tracker import ResonanceTracker, WindowWidth
+from resonance_search import findResonances, fineWindows, coarseFields, SearchSuffix
+
+TimeConst_WaitTime_Conversion = 5
+#"step": set the field and read the lock-in point by point. "sweep": ramp the field continuously, see field_sweep.py
+#"frequency": park the field at each Freq:Field pair and step the N5183 frequency, see freq_sweep.py
+#"interleave": hop through all frequencies with overlapping windows at each field, see interleaved_scan.py
+#"adaptive": step mode that picks the fields from the running fit and stops early, see adaptive_sampling.py
+ScanModes = ["step", "sweep", "frequency", "interleave", "adaptive"]
+#Events that only replace a state shown by the GUI: of these, only the last one since the previous drain counts
+Coalesced = {"shift", "reverse", "rf", "progress"}
+
+
+def guarded(device, name):
+    #Every call waits for the instrument, so the status poller and the measurement never talk to it at once,
+    #and is timed for the per-scan trace files (io_trace)
+    return LockedInstrument(TracedInstrument(device, name)) if device else None
+
+
+def savePoints(plot, points, title, figName):
+    """Draw the points of a ScanWriter on plot (a LivePlot that is not on screen) and write the PNG"""
+    plot.reset(title)
+    for p in points: plot.append(p["Field(G)"], p["Lockin_X_Ave"], p["Lockin_Y_Ave"])
+    return plot.save(figName)
+
+
+def generateFieldswithCentersandLinewidths_DenseatCenter(Hres_atFreqs, linewidth_0, linewidth_1, reverse, fieldStepSize=0):
+    #We want there to be 10 data points between the peak-peak
+    #For each frequency, there is a set of fields the measurement will scan
+    fields2Scan_atFreqs = {}
+    for freq in Hres_atFreqs:
+        freqs = sorted(list(Hres_atFreqs.keys()))
+        if len(Hres_atFreqs) == 1:
+            DeltaH_pk2pk = linewidth_0
+        else:
+            a, b = freqs[0], freqs[-1]
+            DeltaH_pk2pk = linewidth_0 + (linewidth_1 - linewidth_0) * (freq - a) / (b - a)
+        centerField = Hres_atFreqs[freq]
+        fieldRange = 7 * DeltaH_pk2pk
+        stepSize = fieldStepSize if fieldStepSize else round(DeltaH_pk2pk / 16, 1)
+        field_init, field_1 = centerField - 0.5 * fieldRange, centerField - 0.25 * fieldRange
+        field_2, field_3 = centerField - 0.12 * fieldRange, centerField + 0.12 * fieldRange
+        field_4, field_end = centerField + 0.25 * fieldRange, centerField + 0.5 * fieldRange
+        #Start making the fields at this frequency
+        numDataPoints = int((field_1-field_init) / (4 * stepSize))
+        fields2Scan_atFreqs[freq] = [round(num, 1) for num in numpy.linspace(field_init, field_1, numDataPoints)]
+        numDataPoints = int((field_2-field_1) / (3 * stepSize))
+        fields2Scan_atFreqs[freq] += [round(num, 1) for num in numpy.linspace(field_1, field_2, numDataPoints)][1:]
+        numDataPoints = int((field_3-field_2) / stepSize)
+        fields2Scan_atFreqs[freq] += [round(num, 1) for num in numpy.linspace(field_2, field_3, numDataPoints)][1:]
+        numDataPoints = int((field_4-field_3) / (3 * stepSize))
+        fields2Scan_atFreqs[freq] += [round(num, 1) for num in numpy.linspace(field_3, field_4, numDataPoints)][1:]
+        numDataPoints = int((field_end-field_4) / (4 * stepSize))
+        fields2Scan_atFreqs[freq] += [round(num, 1) for num in numpy.linspace(field_4, field_end, numDataPoints)][1:]
+        print("Reverse the fields?", reverse)
+        if reverse:
+            fields2Scan_atFreqs[freq] = list(reversed(fields2Scan_atFreqs[freq]))
+        print("At frequency {}GHz: Step Size: {}. Num of steps: {}".format(freq, stepSize, numDataPoints))
+        print("\t", fields2Scan_atFreqs[freq][0:5], ".....", fields2Scan_atFreqs[freq][-5:-1])
+    return fields2Scan_atFreqs
+
+
+def generateFieldswithCentersandLinewidths_equalSpace(Hres_atFreqs, linewidth_0, linewidth_1, reverse, fieldStepSize):
+    #We want there to be 10 data points between the peak-peak
+    #For each frequency, there is a set of fields the measurement will scan
+    fields2Scan_atFreqs = {}
+    for freq in Hres_atFreqs:
+        freqs = sorted(list(Hres_atFreqs.keys()))
+        if len(Hres_atFreqs) == 1:
+            DeltaH_pk2pk = linewidth_0
+        else:
+            a, b = freqs[0], freqs[-1]
+            DeltaH_pk2pk = linewidth_0 + (linewidth_1 - linewidth_0) * (freq - a) / (b - a)
+        centerField = Hres_atFreqs[freq]
+        fieldRange = 7 * DeltaH_pk2pk
+        stepSize = fieldStepSize if fieldStepSize else round(DeltaH_pk2pk / 16, 1)
+        field_init, field_end = centerField - 0.5 * fieldRange, centerField + 0.5 * fieldRange
+        numDataPoints = int( (field_end-field_init) / stepSize )
+        #Start making the fields at this frequency
+        fields2Scan_atFreqs[freq] = [round(num, 1) for num in numpy.linspace(field_init, field_end, numDataPoints)]
+        print("Reverse the fields?", reverse)
+        if reverse:
+            fields2Scan_atFreqs[freq] = list(reversed(fields2Scan_atFreqs[freq]))
+        print("At frequency {}GHz: Step Size: {}. Num of steps: {}".format(freq, stepSize, numDataPoints))
+        print("\t", fields2Scan_atFreqs[freq][0:5], ".....", fields2Scan_atFreqs[freq][-5:-1])
+    return fields2Scan_atFreqs
+
+
+def parseTempsandShifts(text):
+    """{temperature: field shift} from "21: 3, 22: 4". Empty text gives {} (scan at the current temperature)"""
+    temps_to_shifts = {}
+    for temp_shift in text.split(",") if text.strip() else []:
+        try: s_temp, s_shift = temp_shift.split(":")
+        except ValueError: raise ValueError("':' is missing in {!r}".format(temp_shift.strip()))
+        temps_to_shifts[round(float(s_temp), 1)] = round(float(s_shift), 1)
+    return temps_to_shifts
+
+
+def parseFreqsandFields(text):
+    """{freq: Hres} from "19: 6000, 20: 6001" """
+    Hres_atFreqs = {}
+    for pair in text.split(','): #pair is string '3: 480'
+        try: freq, Hres = pair.split(':')
+        except ValueError: raise ValueError("':' is missing in {!r}".format(pair.strip()))
+        Hres_atFreqs[float(freq.strip())] = float(Hres.strip())
+    if not Hres_atFreqs: raise ValueError("No Freq:Field pairs")
+    return Hres_atFreqs
+
+
+def parseValues(text):
+    """[0.0, -5.0] from "0, -5". Empty text gives []"""
+    return [float(value) for value in text.split(',') if value.strip()]
+
+
+class ScanPlan:
+    """Everything a measurement needs from the user. waitTime=None takes 5 x the lock-in time constant.
+    powers (dBm) and currents (mA, 6221 amplitude): extra sweep axes of the field scan modes, empty keeps the
+    present setting. order: how SweepPlanner orders the scans (SweepOrders). track: center and size the windows
+    from the spectra measured so far (resonance_tracker.py). search: (from, to, step) in G of a coarse scan at
+    the OFLT index searchTimeConst that finds the resonances before the fine scan (resonance_search.py).
+    autoRange: probe the lock-in range at the expected resonance and keep it ranged during the scan (AutoRange)"""
+    def __init__(self, sampleID, folder, tempsandShifts, freqsandFields, linewidths=(4, 5), stepSize=1, shift=0,
+                 reverse=False, equallySpace=True, scanMode="step", readMode="snap", settleMode="model", sweepRate=1,
+                 plotTotal=False, waitTime=None, powers=(), currents=(), order="given", track=False, search=None,
+                 searchTimeConst=6, autoRange=False):
+        if scanMode not in ScanModes: raise ValueError("Unknown scan mode {}".format(scanMode))
+        if order not in SweepOrders: raise ValueError("Unknown sweep order {}".format(order))
+        if scanMode in ("frequency", "interleave") and (len(powers) > 1 or len(currents) > 1):
+            raise ValueError("RF power and modulation sweeps need a field scan mode")
+        if scanMode in ("frequency", "interleave") and track: raise ValueError("Resonance tracking needs a field scan mode")
+        if scanMode in ("frequency", "interleave") and autoRange: raise ValueError("Lock-in auto range needs a field scan mode")
+        if search is not None:
+            if scanMode in ("frequency", "interleave"): raise ValueError("Resonance search needs a field scan mode")
+            if len(search) != 3 or search[2] <= 0 or search[1] <= search[0]:
+                raise ValueError("Resonance search needs from < to and a step > 0, got {}".format(list(search)))
+            search = tuple(search)
+        self.sampleID, self.folder = sampleID, folder
+        self.tempsandShifts, self.freqsandFields = dict(tempsandShifts), dict(freqsandFields)
+        self.linewidths, self.stepSize, self.shift = linewidths, stepSize, shift
+        self.reverse, self.equallySpace = reverse, equallySpace
+        self.scanMode, self.readMode, self.settleMode, self.sweepRate = scanMode, readMode, settleMode, sweepRate
+        self.plotTotal, self.waitTime = plotTotal, waitTime
+        self.powers, self.currents, self.order, self.track = list(powers), list(currents), order, track
+        self.search, self.searchTimeConst, self.autoRange = search, searchTimeConst, autoRange
+
+    @classmethod
+    def fromText(cls, sampleID, folder, tempsandShifts, freqsandFields, linewidths=("4", "5"), stepSize="1", shift="0",
+                 powers="", currents="", search="", **options):
+        """Plan from the texts of the GUI inputs. Raises ValueError on bad input"""
+        try: linewidths = (round(float(linewidths[0])), round(float(linewidths[1]))) #Only read in interger linewidth
+        except ValueError: raise ValueError("Initial or final linewidth is wrong")
+        return cls(sampleID, folder, parseTempsandShifts(tempsandShifts), parseFreqsandFields(freqsandFields), linewidths,
+                   round(float(stepSize), 1), round(float(shift), 1), powers=[round(p, 1) for p in parseValues(powers)],
+                   currents=[round(c, 1) for c in parseValues(currents)], search=parseValues(search) or None, **options)
+
+    def toDict(self):
+        """The plan as json types, e.g. for the run journal"""
+        saved = dict(vars(self))
+        saved["tempsandShifts"] = list(self.tempsandShifts.items()) #Ordered pairs, json keys would be strings
+        saved["freqsandFields"] = list(self.freqsandFields.items())
+        return saved
+
+    @classmethod
+    def fromDict(cls, saved):
+        saved = dict(saved)
+        saved["linewidths"] = tuple(saved["linewidths"])
+        return cls(**saved)
+
+
+def prepareFieldstoScan(plan, shift, reverse):
+    """{Freq: [field1, field2...]} for each freq to scan, from the {Freq: Hres} pairs shifted by shift"""
+    Hres_atFreqs = {freq: Hres + round(shift) for freq, Hres in plan.freqsandFields.items()}
+    linewidth_0, linewidth_1 = plan.linewidths
+    print(Hres_atFreqs, linewidth_0, linewidth_1)
+    if plan.equallySpace:
+        return generateFieldswithCentersandLinewidths_equalSpace(Hres_atFreqs, linewidth_0, linewidth_1, reverse, plan.stepSize)
+    return generateFieldswithCentersandLinewidths_DenseatCenter(Hres_atFreqs, linewidth_0, linewidth_1, reverse, plan.stepSize)
+
+
+def planLinewidth(plan, freq):
+    """Peak-to-peak linewidth in G the plan expects at freq: from the initial to the final linewidth over the
+    frequencies, as the field grid generators interpolate it"""
+    freqs = sorted(plan.freqsandFields)
+    linewidth_0, linewidth_1 = plan.linewidths
+    if len(freqs) < 2 or freqs[0] == freqs[-1]: return linewidth_0
+    return linewidth_0 + (linewidth_1 - linewidth_0) * (freq - freqs[0]) / (freqs[-1] - freqs[0])
+
+
+def prepareWindow(plan, freq, center, width):
+    """[field1, field2...] of one scan at freq, width G around center, spaced as prepareFieldstoScan does"""
+    linewidth = width / WindowWidth
+    if plan.equallySpace:
+        return generateFieldswithCentersandLinewidths_equalSpace({freq: center}, linewidth, linewidth, False, plan.stepSize)[freq]
+    return generateFieldswithCentersandLinewidths_DenseatCenter({freq: center}, linewidth, linewidth, False, plan.stepSize)[freq]
+
+
+def probeFields(fields):
+    """Where AutoRange.probe reads before a scan: the center of the window, where the line is expected, and the
+    extrema of a line WindowWidth times narrower than the window"""
+    center, halfWidth = 0.5 * (min(fields) + max(fields)), 0.5 * (max(fields) - min(fields)) / WindowWidth
+    return [round(center - halfWidth, 1), round(center, 1), round(center + halfWidth, 1)]
+
+
+def waitTimeOf(lockin):
+    """The original fixed settle time of every point: TimeConst_WaitTime_Conversion x the time constant"""
+    return round(SR830_TimeConsts[int(lockin.query("OFLT?").strip())] * TimeConst_WaitTime_Conversion, 2)
+
+
+class EventQueue:
+    """Thread safe (kind, data) events from the engine to the GUI"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._events = []
+
+    def put(self, kind, **data):
+        with self._lock: self._events.append((kind, data))
+
+    def drain(self):
+        """The events since the last drain, in order. Of the kinds in Coalesced only the last one is kept"""
+        with self._lock: events, self._events = self._events, []
+        last = {kind: i for i, (kind, data) in enumerate(events) if kind in Coalesced}
+        return [(kind, data) for i, (kind, data) in enumerate(events) if kind not in Coalesced or last[kind] == i]
+
+
+class MeasurementEngine:
+    """Runs ScanPlans on the instruments (LockedInstrument wrapped, see guarded()). Events:
+    log(text), shift(shift), reverse(reverse), rf(freq, power), progress(temp, freq, done, total),
+    skipped(), finished(aborted). io: AsyncIO (async_instruments.py) to overlap the PPMS and GPIB calls of a point"""
+    def __init__(self, ppms, lockin, rfPower, acMod=None, livePlot=None, poller=None, events=None, io=None):
+        self.ppms, self.lockin, self.rfPower, self.acMod, self.io = ppms, lockin, rfPower, acMod, io
+        self.livePlot = livePlot or LivePlot(360, 240)
+        self.poller = poller
+        self.events = events or EventQueue()
+        self.running, self.skipRestofFields, self.restabilize = False, False, False
+        self.thread = None
+
+    def start(self, plan, resume=False):
+        """Run the plan on a new thread"""
+        self.running = True
+        self.thread = threading.Thread(target=self.run, args=(plan, resume), name="measurement")
+        self.thread.start()
+        return self.thread
+
+    def isAlive(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def abort(self):
+        self.running = False
+
+    def skipRest(self, skip=True):
+        """Finish the scan at the current frequency (field) early"""
+        self.skipRestofFields = skip
+
+    def log(self, text):
+        self.events.put("log", text=text)
+
+    def publish(self, **values):
+        if self.poller is not None: self.poller.publish(**values)
+
+    def run(self, plan, resume=False):
+        """Blocks until the plan is done or aborted. Returns False if it was aborted or the input was wrong.
+        resume: continue the run journaled in the folder of the plan (run_journal.py)"""
+        self.running = True
+        #While scanning, the poller leaves the lock-in and sources alone and shows the measured points
+        if self.poller is not None: self.poller.scanning = True
+        print("Resuming measurement" if resume else "Starting measurement")
+        self.journal, done = None, False
+        try:
+            done = self.measure(plan, resume)
+            return done
+        finally:
+            if self.journal is not None: self.journal.finish(aborted=not done)
+            if self.poller is not None: self.poller.scanning = False
+            self.events.put("finished", aborted=not self.running)
+            self.running = False
+            print("Measurement stopped ")
+
+    def _skipped(self, what="field"):
+        """True once after the user asked to skip the rest of the scan"""
+        if not self.skipRestofFields: return False
+        print("Will skip the rest of the {}s".format(what))
+        self.log("Finish the {} scan early as user needs".format(what))
+        self.skipRestofFields = False
+        self.events.put("skipped")
+        return True
+
+    def measure(self, plan, resume=False):
+        self.plan, self.reverse = plan, plan.reverse
+        self.waitTime = plan.waitTime if plan.waitTime is not None else waitTimeOf(self.lockin)
+        self.timeConst = self.waitTime / TimeConst_WaitTime_Conversion
+        self.rfPower_indBm = round(float(self.rfPower.query("POW?").strip()))
+        self.acCurrent_inmA = round(1000 * float(self.acMod.query(":SOUR:WAVE:AMPL?").strip()), 1) if self.acMod else 0
+        temps_to_shifts = plan.tempsandShifts
+        if not temps_to_shifts:
+            print("Failed to read any temperatures. Using the current temp")
+            temps_to_shifts = {round(float(self.ppms.getTemperature()[1]), 1): plan.shift}
+
+        print("\n--------------Measurements at temperatures with shifts:", temps_to_shifts, "\n--------------")
+        folderName = os.path.join(plan.folder, plan.sampleID)
+        os.makedirs(folderName, exist_ok=True)
+        self.journal = RunJournal(folderName)
+        if resume: self.journal.resume()
+        else: self.journal.begin(plan)
+        self.restabilize = resume #After an interruption the first scan waits for the temperature again
+        if plan.scanMode not in ("frequency", "interleave"): return self.scanSweep(temps_to_shifts, folderName)
+        for i, (temp, shift) in enumerate(temps_to_shifts.items()):
+            if not self.running: return False
+            if i % 2: #Every other temperature scans the fields the other way
+                self.reverse = not self.reverse
+                self.events.put("reverse", reverse=self.reverse)
+            #Every file is journaled on its own, under the frequency of its Freq:Field pair
+            keys = {freq: scanKey(temp, freq, self.rfPower_indBm, self.acCurrent_inmA) for freq in plan.freqsandFields}
+            if all(self.journal.status(key) == "complete" for key in keys.values()):
+                self.log("{}K was measured before, skipped".format(temp))
+                continue
+            self.events.put("shift", shift=shift)
+            temp = self.goToTemperature(temp)
+            fields2Scan_atFreqs = prepareFieldstoScan(plan, shift, self.reverse)
+            if plan.scanMode == "frequency": done = self.scanFrequencies(fields2Scan_atFreqs, temp, folderName, keys)
+            else: done = self.scanInterleaved(fields2Scan_atFreqs, temp, folderName, keys)
+            if not done: return False
+        return True
+
+    def goToTemperature(self, temp):
+        """Set and wait for temp unless the PPMS is there already (and stable, after a resume).
+        Returns the temperature reached"""
+        present = round(self.ppms.getTemperature()[1], 1)
+        if self.restabilize:
+            self.restabilize = False
+            self.log("Resuming: waiting for {}K to be stable again".format(temp))
+            with tracer.span("temperature", "transition", start=present, target=temp):
+                self.ppms.setTemperature(temp)
+                self.ppms.waitForTemperature()
+        elif temp != present:
+            #Transitions are traced with where they start and end, for run_estimator.calibrate
+            with tracer.span("temperature", "transition", start=present, target=temp):
+                self.ppms.setTemperature(temp)
+                print("Going to set temperature {}K. Waiting to stabilize".format(temp))
+                self.ppms.waitForTemperature()
+            print("Stabilized at {}K. Starting measurement".format(temp))
+        return round(float(self.ppms.getTemperature()[1]), 1)
+
+    def setRFPower(self, power):
+        with tracer.span("rf power", "transition", start=self.rfPower_indBm, target=power):
+            self.rfPower.write("POW {}".format(power))
+        self.rfPower_indBm = round(power)
+
+    def setModulation(self, current):
+        """6221 amplitude in mA. A running wave is aborted and started again, as toggle_ACMod does"""
+        with tracer.span("modulation", "transition", start=self.acCurrent_inmA, target=current):
+            running = '1' in self.acMod.query(":OUTP:STAT?")
+            if running: self.acMod.write(":SOUR:WAVE:ABOR")
+            self.acMod.write(":SOUR:WAVE:AMPL {}".format(0.001 * current))
+            if running:
+                self.acMod.write(":SOUR:WAVE:ARM")
+                time.sleep(1)
+                self.acMod.write(":SOUR:WAVE:INIT")
+        self.acCurrent_inmA = current
+
+    def sweepPlanner(self, temps_to_shifts):
+        """SweepPlanner of the field scan modes, from the present state of the PPMS and the sources"""
+        plan = self.plan
+        fieldsAtTemps = {temp: prepareFieldstoScan(plan, shift, False) for temp, shift in temps_to_shifts.items()}
+        #Calibrated on the past runs under the data folder if run_estimator.py has been run there
+        path = os.path.join(plan.folder, TimingFile)
+        coarse = coarseFields(plan.search) if plan.search else None
+        model = (TimingModel.load(path) if os.path.exists(path) else TimingModel()).costModel(plan, self.timeConst, coarse)
+        return SweepPlanner(fieldsAtTemps, plan.powers or [self.rfPower_indBm], plan.currents or [self.acCurrent_inmA], model,
+                            startTemp=round(self.ppms.getTemperature()[1], 1), startField=self.ppms.getField()[1],
+                            startPower=self.rfPower_indBm, startCurrent=self.acCurrent_inmA)
+
+    def scanSweep(self, temps_to_shifts, folderName):
+        """Step, adaptive and sweep modes: one field scan per temperature, frequency, RF power and
+        modulation amplitude, in the order of the plan. Returns False if aborted"""
+        planner = self.sweepPlanner(temps_to_shifts)
+        points = planner.order(self.plan.order, self.reverse)
+        seconds, parts = planner.cost(points)
+        self.log("{} scans in {} order, about {:.1f} h".format(len(points), self.plan.order, seconds / 3600))
+        print("Estimated time per part (s):", {part: round(value) for part, value in parts.items()})
+        self.log("Start scanning fields at various freqs")
+        self.log("Freqs: {}".format(self.plan.freqsandFields.keys()))
+        temp, setTemp = None, None
+        tracker = ResonanceTracker(temps_to_shifts) if self.plan.track else None
+        for point in points:
+            if not self.running: return False
+            key = scanKey(point.temp, point.freq, point.power, point.current)
+            fields, filename = planner.fields(point), self.journal.file(key)
+            if self.journal.status(key) == "complete":
+                self.log("{}K {}GHz {}dBm {}mA was measured before, skipped".format(point.temp, point.freq, point.power, point.current))
+                if tracker is not None and filename: self.track(tracker, point, filename)
+                continue
+            window = tracker.window(point.temp, point.freq) if tracker is not None else None
+            if window: #Centered on the resonance predicted from the scans so far
+                fields = prepareWindow(self.plan, point.freq, *window)
+                if point.reverse: fields = fields[::-1]
+                self.log("{}K {}GHz: tracked window {:.1f}G, {:.0f}G wide".format(point.temp, point.freq, *window))
+            tracer.reset() #One timeline per scan, from the changes before it, saved next to the csv
+            if point.temp != setTemp:
+                self.events.put("shift", shift=temps_to_shifts[point.temp])
+                temp, setTemp = self.goToTemperature(point.temp), point.temp
+            if point.reverse != self.reverse:
+                self.reverse = point.reverse
+                self.events.put("reverse", reverse=self.reverse)
+            if point.power != self.rfPower_indBm: self.setRFPower(point.power)
+            if point.current != self.acCurrent_inmA: self.setModulation(point.current)
+            if window is None and self.plan.search: #Hres unknown: only around what a coarse scan finds
+                searched = self.searchFields(point, temp, filename or self.scanFilename(temp, point.freq, folderName), filename is not None)
+                if searched is None: return False
+                fields = searched or fields
+            if filename: #Interrupted: only the fields that are not on disk yet
+                fields = remainingFields(fields, filename.replace(".csv", ".npy"))
+                self.log("Resuming {} with {} fields left".format(os.path.basename(filename), len(fields)))
+            resumed, filename = filename is not None, filename or self.scanFilename(temp, point.freq, folderName)
+            self.journal.started(key, filename)
+            if fields and not self.scanFields(point.freq, fields, temp, filename, resumed): return False
+            self.journal.complete(key)
+            if tracker is not None: self.track(tracker, point, filename)
+        return True
+
+    def track(self, tracker, point, filename):
+        """Fit the scan of point for the windows of the scans to come"""
+        path = filename.replace(".csv", ".npy")
+        if not os.path.exists(path): return
+        scan = loadScan(path)
+        fields, signal = scan["Field(G)"], scan["Lockin_X_Ave"]
+        windows = self.searchWindows(filename, point.freq)
+        if windows: #Only the strongest resonance of a searched scan
+            center, width = windows[0]
+            inside = numpy.abs(fields - center) <= 0.5 * width
+            fields, signal = fields[inside], signal[inside]
+        fit = tracker.add(point.temp, point.freq, fields, signal)
+        if fit: self.log("{}K {}GHz: Hres {:.1f}G, dH {:.1f}G".format(point.temp, point.freq, *fit))
+        else: self.log("{}K {}GHz: the resonance is not in the window".format(point.temp, point.freq))
+        print("Resonance tracking:", tracker.summary())
+
+    def searchWindows(self, filename, freq):
+        """[(center, width)] of the fine scans at freq around the resonances in the coarse scan of filename,
+        strongest first. [] if it was not searched"""
+        path = filename.replace(".csv", SearchSuffix + ".npy")
+        if not self.plan.search or not os.path.exists(path): return []
+        scan = loadScan(path)
+        return fineWindows(findResonances(scan["Field(G)"], scan["Lockin_X_Ave"]), self.plan.search[2], planLinewidth(self.plan, freq))
+
+    def searchFields(self, point, temp, filename, reuse=False):
+        """The fields of the fine scan of point around the resonances found by a coarse scan of plan.search at
+        the time constant plan.searchTimeConst. [] if none was found, None if aborted. reuse: take the
+        resonances from the coarse scan on disk, for a resumed scan"""
+        start, stop, step = self.plan.search
+        searchName = filename.replace(".csv", SearchSuffix + ".csv")
+        if not (reuse and os.path.exists(searchName.replace(".csv", ".npy"))):
+            coarse = coarseFields(self.plan.search)
+            self.log("{}K {}GHz: searching {}~{}G in {}G steps".format(point.temp, point.freq, start, stop, step))
+            timeConstIndex = int(self.lockin.query("OFLT?").strip())
+            waitTime, timeConst = self.waitTime, self.timeConst
+            self.lockin.write("OFLT {}".format(self.plan.searchTimeConst))
+            self.timeConst = SR830_TimeConsts[self.plan.searchTimeConst]
+            self.waitTime = self.timeConst * TimeConst_WaitTime_Conversion
+            try: done = self.scanFields(point.freq, coarse[::-1] if point.reverse else coarse, temp, searchName, probe=False)
+            finally:
+                self.lockin.write("OFLT {}".format(timeConstIndex))
+                self.waitTime, self.timeConst = waitTime, timeConst
+            if not done: return None
+            tracer.reset() #The fine scan gets its own timeline
+        windows = self.searchWindows(filename, point.freq)
+        if not windows:
+            self.log("{}K {}GHz: no resonance found, scanning the planned window".format(point.temp, point.freq))
+            return []
+        self.log("{}K {}GHz: resonances at {}G".format(point.temp, point.freq, ", ".join("{:.1f}".format(c) for c, w in windows)))
+        fields = sorted({field for center, width in windows for field in prepareWindow(self.plan, point.freq, center, width)})
+        return fields[::-1] if point.reverse else fields
+
+    def saveTrace(self, filename):
+        """Write the timeline of the scan to <csv name>_trace.json and print the slowest commands"""
+        path = tracer.save(filename.replace(".csv", "_trace.json"))
+        if path: print("Scan timeline: {}\n{}".format(path, tracer.report()))
+
+    def scanFilename(self, temp, freq, folderName):
+        filename = "{}_{}K_{}GHz_{}dBm_{}mA.csv".format(self.plan.sampleID, int(temp), str(freq).replace('.', 'p'),
+                                                        self.rfPower_indBm, str(self.acCurrent_inmA).replace('.', 'p'))
+        return os.path.join(folderName, filename)
+
+    def scanFields(self, freq, fields, temp, filename, resume=False, probe=True):
+        """One field scan in step, adaptive or sweep mode. resume: add to the points already in the .npy
+        of filename. probe: with plan.autoRange, range the lock-in at probeFields first. Returns False if aborted"""
+        plan = self.plan
+        self.log("Scanning at Freq {} GHz".format(freq))
+        self.rfPower.write(":SOUR:FREQ:CW {}GHz".format(freq))
+        self.events.put("rf", freq=freq, power=self.rfPower_indBm)
+        self.publish(rfFreq=freq)
+        ctrIndex = int(len(fields) / 2)
+        self.log("Initial field {}, final field {} and stepSize {}".format(fields[0], fields[-1], fields[ctrIndex]-fields[ctrIndex-1]))
+        reader = AutoRange(LockinReader(self.lockin, mode=plan.readMode)).configure() if plan.autoRange else None
+        if reader is not None and probe and len(fields) > 1:
+            #Farthest from the first field first, so the magnet ends up next to it
+            peak = reader.probe(self.ppms, sorted(probeFields(fields), key=lambda field: -abs(field - fields[0])), self.waitTime)
+            self.log("Lock-in range {:g} V for a signal of {:.3g} V".format(reader.fullScale, peak))
+            self.publish(sensitivity=reader.sens)
+        #Need to go to the first field and make it settle for a few seconds
+        with tracer.span("first field", "transition", start=self.ppms.getField()[1], target=fields[0]):
+            self.ppms.setField(fields[0], 100)
+            self.ppms.waitForField(timeout=240)
+        print("Start the field scan at {}".format(self.ppms.getField()[1]))
+        figName = filename.replace("csv", "png")
+        self.livePlot.plotTotal = plan.plotTotal
+        self.livePlot.reset("{}K {}GHz".format(temp, freq))
+        #Points are kept in memory and written to the .npy in batches. The csv is written when the scan ends
+        writer = ScanWriter(filename.replace(".csv", ".npy"), capacity=len(fields), resume=resume)
+        for p in writer.points: self.livePlot.append(p["Field(G)"], p["Lockin_X_Ave"], p["Lockin_Y_Ave"])
+        with tracer.span("fields", "scan", points=len(fields), span=abs(fields[-1] - fields[0]), timeConst=self.timeConst,
+                         scanMode=plan.scanMode, settleMode=plan.settleMode, readMode=plan.readMode, sweepRate=plan.sweepRate):
+            if plan.scanMode == "sweep": done = self.sweepFields(fields, temp, freq, writer, figName, filename)
+            else: done = self.stepFields(fields, temp, freq, writer, figName, filename, reader)
+        if not done:
+            if plan.scanMode == "sweep": self.saveTrace(filename)
+            return False
+        self.log("Move on to next freq in 2s")
+        with tracer.span("next freq", "sleep"): time.sleep(2)
+        self.saveTrace(filename)
+        return True
+
+    def stepFields(self, fields, temp, freq, writer, figName, filename, reader=None):
+        """Step (or adaptive) scan through fields. reader: an AutoRange to range the lock-in point by point.
+        Returns False if the measurement was aborted"""
+        fullScale = fullScaleOf(self.lockin) if reader is None else None
+        reader = reader or LockinReader(self.lockin, mode=self.plan.readMode).configure()
+        sampler = AdaptiveSampler(fields) if self.plan.scanMode == "adaptive" else None
+        #"model": each point waits as long as its step needs, and the next field is commanded during the read
+        if self.plan.settleMode == "model": settle = SettleScheduler.fromLockin(self.lockin, rate=100)
+        else: settle = FixedSettle(self.waitTime, rate=100)
+        if self.io is not None: settle = AsyncSettle(self.io, settle, self.ppms, self.lockin)
+        for i, field in enumerate(sampler or fields):
+            if not self.running: #Abort the measurement
+                writer.close(csv=filename)
+                self.livePlot.save(figName)
+                self.saveTrace(filename)
+                return False
+            if self._skipped(): break #If enabled, the rest of the field points at this freq will skipped.
+            nextField = fields[i + 1] if not sampler and i + 1 < len(fields) else None #Adaptive fields depend on the read
+            fieldActual, ave_1, ave_2, err_1, err_2 = settle.step(self.ppms, reader, field, nextField)
+            if fullScale is None:
+                sens = reader.sens
+                while reader.redo: #Overloaded after the next field was commanded: back to field, less sensitive
+                    fieldActual, ave_1, ave_2, err_1, err_2 = settle.step(self.ppms, reader, field, nextField)
+                if reader.sens != sens: self.publish(sensitivity=reader.sens)
+            writer.add(temp, freq, field, fieldActual, ave_1, ave_2, err_1, err_2, self.timeConst, fullScale or reader.readAt)
+            self.livePlot.append(field, ave_1, ave_2)
+            self.publish(field=fieldActual, X=ave_1, Y=ave_2)
+            self.events.put("progress", temp=temp, freq=freq, done=i + 1, total=len(fields))
+            if sampler: sampler.add(field, ave_1)
+        if sampler:
+            self.log("Adaptive scan: {} of {} points, converged: {}".format(len(sampler.measuredFields), len(fields), sampler.converged))
+        writer.close(csv=filename)
+        self.livePlot.save(figName)
+        return True
+
+    def sweepFields(self, fields, temp, freq, writer, figName, filename):
+        """Continuous sweep through fields. Returns False if the measurement was aborted"""
+        sweep = FieldSweep(self.ppms, self.lockin, fields, rate=float(self.plan.sweepRate))
+        fullScale = fullScaleOf(self.lockin) #The sweep keeps the range the probe left, if any
+        def onSample(field, x, y):
+            self.livePlot.append(field, x, y)
+            self.publish(field=field, X=x, Y=y)
+        try: points = sweep.run(onSample=onSample, shouldStop=lambda: not self.running or self.skipRestofFields)
+        except Exception:
+            writer.close() #The scan stays "started" in the journal, so a resume measures it
+            raise
+        self._skipped()
+        #Replace the raw samples in the live plot by the points on the field grid
+        self.livePlot.reset("{}K {}GHz".format(temp, freq))
+        for p in points:
+            writer.add(temp, freq, p["Field(G)"], p["Field_Actual(G)"], p["Lockin_X_Ave"], p["Lockin_Y_Ave"],
+                       p["Lockin_X_Err"], p["Lockin_Y_Err"], self.timeConst, fullScale, timestamp=p["Time(s)"])
+            self.livePlot.append(p["Field(G)"], p["Lockin_X_Ave"], p["Lockin_Y_Ave"])
+        writer.close(csv=filename)
+        self.livePlot.save(figName)
+        return self.running
+
+    def scanFrequencies(self, fields2Scan_atFreqs, temp, folderName, keys):
+        """At the field of each Freq:Field pair, step the N5183 through the frequencies that correspond to
+        the field grid. Files are named with the field in place of the frequency and journaled under
+        keys[freq of the pair]: complete ones are skipped, started ones continue. Returns False if aborted"""
+        grids = frequencyGrids(fields2Scan_atFreqs)
+        self.log("Start scanning freqs at fields {}".format([grids[f][0] for f in grids]))
+        reader = LockinReader(self.lockin, mode=self.plan.readMode).configure()
+        cwFreq = float(self.rfPower.query(":SOUR:FREQ:CW?").strip()) #Hz, restored however the scans end
+        try:
+            for centerFreq in sorted(grids, reverse=self.reverse):
+                field, freqs = grids[centerFreq]
+                if not self.running: return False
+                key = keys[centerFreq]
+                if self.journal.status(key) == "complete":
+                    self.log("{}K {}G was measured before, skipped".format(temp, field))
+                    continue
+                filename = self.journal.file(key)
+                resumed = filename is not None
+                if resumed: #Interrupted: only the frequencies that are not on disk yet
+                    freqs = remainingFields(freqs, filename.replace(".csv", ".npy"), column="RF Freq(GHz)")
+                    self.log("Resuming {} with {} freqs left".format(os.path.basename(filename), len(freqs)))
+                else:
+                    filename = "{}_{}K_{}G_{}dBm_{}mA.csv".format(self.plan.sampleID, int(temp), str(field).replace('.', 'p'),
+                                                                  self.rfPower_indBm, str(self.acCurrent_inmA).replace('.', 'p'))
+                    filename = os.path.join(folderName, filename)
+                self.journal.started(key, filename, mode="frequency")
+                if freqs:
+                    self.log("Scanning {}~{} GHz at {} G".format(freqs[0], freqs[-1], field))
+                    tracer.reset()
+                    writer = ScanWriter(filename.replace(".csv", ".npy"), capacity=len(freqs), resume=resumed)
+                    fullScale = fullScaleOf(self.lockin)
+                    self.livePlot.plotTotal = self.plan.plotTotal
+                    self.livePlot.reset("{}K {}G".format(temp, field), xlabel="RF Freq (GHz)")
+                    for p in writer.points: self.livePlot.append(p["RF Freq(GHz)"], p["Lockin_X_Ave"], p["Lockin_Y_Ave"])
+                    def onPoint(freq, fieldActual, x, y, xErr, yErr):
+                        writer.add(temp, freq, field, fieldActual, x, y, xErr, yErr, self.timeConst, fullScale)
+                        self.livePlot.append(freq, x, y)
+                        self.publish(field=fieldActual, X=x, Y=y, rfFreq=freq)
+                    sweep = FrequencySweep(self.ppms, self.rfPower, reader, field, freqs)
+                    sweep.run(self.waitTime, onPoint, shouldStop=lambda: not self.running or self.skipRestofFields)
+                    self._skipped("freq")
+                    writer.close(csv=filename)
+                    self.livePlot.save(filename.replace("csv", "png"))
+                    self.saveTrace(filename)
+                if not self.running: return False
+                self.journal.complete(key)
+        finally: self.rfPower.write(":SOUR:FREQ:CW {}GHz".format(cwFreq / 1e9))
+        return self.running
+
+    def scanInterleaved(self, fields2Scan_atFreqs, temp, folderName, keys):
+        """Frequencies with overlapping field windows share the magnet setpoints. Each frequency still
+        gets its own csv/npy/png, journaled under keys[freq]: complete ones are skipped and started ones
+        only measure the fields that are not on disk yet. Returns False if aborted"""
+        reader = LockinReader(self.lockin, mode=self.plan.readMode).configure()
+        scan = InterleavedScan(self.ppms, self.rfPower, reader, fields2Scan_atFreqs, self.reverse)
+        remaining = {} #{freq: fields}, from the grids the scan will use
+        for freq, fields in scan.fieldsOfFreqs().items():
+            filename = self.journal.file(keys[freq])
+            if self.journal.status(keys[freq]) == "complete": remaining[freq] = []
+            elif filename is None: remaining[freq] = fields
+            else:
+                remaining[freq] = remainingFields(fields, filename.replace(".csv", ".npy"))
+                self.log("Resuming {} with {} fields left".format(os.path.basename(filename), len(remaining[freq])))
+        writers, filenames, live = {}, {}, {}
+        pngPlot = LivePlot(360, 240, plotTotal=self.plan.plotTotal) #The live plot only shows one frequency
+        def closeWriters(complete):
+            for freq, writer in writers.items():
+                writer.close(csv=filenames[freq])
+                savePoints(pngPlot, writer.points, "{}K {}GHz".format(temp, freq), filenames[freq].replace("csv", "png"))
+                if complete: self.journal.complete(keys[freq])
+            if writers: self.saveTrace(filenames[min(writers)]) #One timeline per group
+            writers.clear()
+        def onGroup(freqs):
+            closeWriters(True)
+            tracer.reset()
+            self.log("Interleaving freqs {} GHz".format(freqs))
+            for freq in freqs:
+                if not remaining[freq]: continue
+                resumed = self.journal.file(keys[freq]) is not None
+                filenames[freq] = self.journal.file(keys[freq]) or self.scanFilename(temp, freq, folderName)
+                self.journal.started(keys[freq], filenames[freq], mode="interleave")
+                writers[freq] = ScanWriter(filenames[freq].replace(".csv", ".npy"), capacity=len(remaining[freq]), resume=resumed)
+            live["freq"] = min(writers) #The live plot follows the lowest frequency of the group
+            live["fullScale"] = fullScaleOf(self.lockin)
+            self.livePlot.plotTotal = self.plan.plotTotal
+            self.livePlot.reset("{}K {}GHz".format(temp, live["freq"]))
+            for p in writers[live["freq"]].points: self.livePlot.append(p["Field(G)"], p["Lockin_X_Ave"], p["Lockin_Y_Ave"])
+        def onPoint(freq, field, fieldActual, x, y, xErr, yErr):
+            writers[freq].add(temp, freq, field, fieldActual, x, y, xErr, yErr, self.timeConst, live["fullScale"])
+            if freq == live["freq"]: self.livePlot.append(field, x, y)
+            self.publish(field=fieldActual, X=x, Y=y, rfFreq=freq)
+        done = False
+        try:
+            done = scan.run(self.waitTime, onPoint, shouldStop=lambda: not self.running, shouldSkip=self._skipped,
+                            onGroup=onGroup, remaining=remaining)
+            return done
+        finally: closeWriters(done)
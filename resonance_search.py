@@ -0,0 +1,82 @@
+"""Coarse-to-fine search for resonances whose field is not known.
+
+A coarse scan over a wide range (ScanPlan.search = (from, to, step) in G) at a short lock-in time constant
+(ScanPlan.searchTimeConst, an OFLT index) is saved as <scan>_search.csv. findResonances picks the resonances
+out of it with the peak-to-peak logic of loadCSVandPreprocess (peakToPeakGuess): the strongest point, the
+max and min of the derivative signal around it, and the next strongest once the tail of that one is below
+the noise. The fine scan then only covers a window around each of them (fineWindows), at the time constant
+of the plan. With resonance tracking only the scans without a tracked window are searched.
+    python resonance_search.py "D:\\Data\\LSC441_YIG\\LSC441_YIG_300K_10p0GHz_0dBm_10p0mA_search.npy"
+"""
+import argparse
+import numpy as np
+from Common_FuncsClasses import peakToPeakGuess
+from data_writer import loadScan
+from resonance_tracker import WindowWidth
+
+SearchSuffix = "_search" #Coarse scans are saved as <scan>_search.csv/.npy, which batch_fit and run_catalog leave out
+
+
+def coarseFields(search):
+    """[field1, field2...] ascending of the coarse scan of search = (from, to, step) in G"""
+    start, stop, step = search
+    return [round(field, 1) for field in np.arange(start, stop + 0.5 * step, step)]
+
+
+def noiseLevel(signal):
+    """Standard deviation of the noise from the point to point differences, which the resonances barely change"""
+    return 1.4826 * np.median(np.abs(np.diff(signal))) / np.sqrt(2)
+
+
+def findResonances(fields, signal, threshold=8, maxPeaks=3, maxLinewidth=200):
+    """[(Hres, linewidth, amplitude)] of the resonances of a coarse scan, strongest first. linewidth is the
+    peak-to-peak linewidth in G, amplitude the peak-to-peak signal. Both lobes together must be threshold x the
+    noise and each half of that. maxLinewidth: how far from the strongest point the other lobe is looked for"""
+    order = np.argsort(fields)
+    fields, signal = np.asarray(fields, float)[order], np.asarray(signal, float)[order]
+    if len(fields) < 5: return []
+    signal = signal - np.polyval(np.polyfit(fields, signal, 1), fields) #Offset and drift of the background
+    noise = max(noiseLevel(signal), 1e-30)
+    left, found = np.ones(len(fields), bool), []
+    while len(found) < maxPeaks and left.sum() >= 3:
+        candidates = np.flatnonzero(left)
+        strongest = candidates[np.argmax(np.abs(signal[candidates]))]
+        near = left & (np.abs(fields - fields[strongest]) <= maxLinewidth)
+        Hres, sym, antiSym, dH, H1, H2, top, bottom = peakToPeakGuess(fields[near], signal[near])
+        if top - bottom < threshold * noise or min(top, -bottom) < 0.5 * threshold * noise: break
+        linewidth = abs(H2 - H1)
+        between = (fields >= min(H1, H2)) & (fields <= max(H1, H2))
+        if not left[between].all(): #The lobes of two resonances, or the tails left of them
+            left &= ~between
+            continue
+        found.append((float(Hres), float(linewidth), float(top - bottom)))
+        #The tail of the derivative falls as (half width / distance)^3 from 0.65 x the peak-to-peak amplitude
+        reach = 0.5 * np.sqrt(3) * max(linewidth, np.median(np.diff(fields))) * ((top - bottom) / (0.65 * threshold * noise)) ** (1 / 3)
+        left &= np.abs(fields - Hres) > max(reach, linewidth)
+    return found
+
+
+def fineWindows(resonances, step, linewidth=None):
+    """[(center, width)] in G of the fine scans around the resonances of a coarse scan with step G. A line
+    whose lobes are at most 2 steps apart is not resolved: its width comes from linewidth (the peak-to-peak
+    linewidth the plan expects, one step if None). The center may be off by half a step either way"""
+    return [(round(Hres, 1), WindowWidth * (found if found > 2 * step else linewidth or step) + step)
+            for Hres, found, amplitude in resonances]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="The resonances found in a coarse scan")
+    parser.add_argument("path", help=".npy of a scan")
+    parser.add_argument("--threshold", type=float, default=8)
+    parser.add_argument("--max-linewidth", type=float, default=200)
+    parser.add_argument("--linewidth", type=float, help="Expected peak-to-peak linewidth in G, for lines the coarse step does not resolve")
+    args = parser.parse_args()
+    scan = loadScan(args.path)
+    fields = np.sort(scan["Field(G)"])
+    print("{} points, {}~{} G, noise {:.3g}".format(len(scan), fields[0], fields[-1], noiseLevel(scan["Lockin_X_Ave"][np.argsort(scan["Field(G)"])])))
+    resonances = findResonances(scan["Field(G)"], scan["Lockin_X_Ave"], args.threshold, maxLinewidth=args.max_linewidth)
+    step = float(np.median(np.diff(fields))) if len(fields) > 1 else 0
+    for (Hres, linewidth, amplitude), (center, width) in zip(resonances, fineWindows(resonances, step, args.linewidth)):
+        print("Hres {:.1f} G, linewidth {:.1f} G, amplitude {:.3g}: fine scan {:.1f}~{:.1f} G".format(
+            Hres, linewidth, amplitude, center - 0.5 * width, center + 0.5 * width))
+    if not resonances: print("No resonance above the noise")
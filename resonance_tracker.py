@@ -0,0 +1,169 @@
+"""Re-centering and re-sizing the field windows of a run from the spectra it has measured so far.
+
+After every field scan the spectrum is fitted (singleLorentzian) and its Hres and dH join the models of the run:
+    f(Hres) = resFreq_vs_Field(Hres, gamma, Meff(T))   gamma from the temperatures measured at 2 or more frequencies,
+                                                     gamma_0 before
+    Meff(T)                                          interpolated between the measured temperatures, extrapolated
+                                                     from the two closest ones
+    dH(f)                                            straight line through the linewidths (of the temperature if measured)
+The Freq:Field pairs of the plan only place the scans before the first fit, and its Temps:Shift is used until
+a second temperature is measured. The scans still to come are centered on the predicted Hres and are
+WindowWidth x the predicted peak-to-peak linewidth wide, plus twice the error of the last two predictions on
+each side. Once both landed within half a linewidth the windows narrow to `narrow` x the linewidth. Windows
+at a temperature without a fit yet are NewTempWidth times wider. A scan whose resonance is not well inside
+its window (a miss) is not used and widens the windows that follow.
+    tracker = ResonanceTracker(temps_to_shifts)
+    center, width = tracker.window(temp, freq)     #None before the first fit
+    tracker.add(temp, freq, fields, lockinX)       #after every scan
+    python resonance_tracker.py "D:\\Data\\LSC441_YIG"   #how well the scans of a folder predict the next ones
+"""
+import argparse, glob, os
+import numpy as np
+from Common_FuncsClasses import gamma_0, resFreq_vs_Field
+from adaptive_sampling import fitSingleLorentzian, HRES, DH
+from dependence_fit import kittelGuess
+from data_writer import loadScan
+
+WindowWidth = 7 #The field grid generators scan 7 x the peak-to-peak linewidth
+GammaRange = (0.5 * gamma_0, 2 * gamma_0) #A gamma fitted outside is not trusted, gamma_0 is used instead
+GammaSpread = 0.05 #How far gamma_0 may be off before gamma is fitted, for the width of the windows
+NewTempWidth = 2 #The windows at a temperature without a fit yet are this much wider: its shift is a guess
+
+
+def resonanceField(freq, gamma, Meff):
+    """Hres in G of freq in GHz, the inverse of resFreq_vs_Field"""
+    x = 2 * np.pi * freq / gamma
+    return -2 * np.pi * Meff + np.sqrt((2 * np.pi * Meff) ** 2 + x ** 2)
+
+
+def fitMeff(H, freq, gamma):
+    """Meff of the least squares of (2 pi f / gamma)^2 = H^2 + 4 pi Meff H"""
+    H, freq = np.asarray(H, float), np.asarray(freq, float)
+    return float(np.sum(((2 * np.pi * freq / gamma) ** 2 - H ** 2) * H) / np.sum(H ** 2) / (4 * np.pi))
+
+
+def extrapolate(xs, values, x):
+    """values at x: interpolated inside xs, extrapolated along the two closest points outside"""
+    order = np.argsort(xs)
+    xs, values = np.asarray(xs, float)[order], np.asarray(values, float)[order]
+    if len(xs) == 1: return float(values[0])
+    if x < xs[0]: i = 0
+    elif x > xs[-1]: i = len(xs) - 2
+    else: return float(np.interp(x, xs, values))
+    return float(values[i] + (values[i + 1] - values[i]) * (x - xs[i]) / (xs[i + 1] - xs[i]))
+
+
+class ResonanceTracker:
+    """temps_to_shifts: the {temp: shift} of the plan. narrow: the width of the windows in linewidths once
+    the predictions are good"""
+    def __init__(self, temps_to_shifts, narrow=5):
+        self.shifts, self.narrow = dict(temps_to_shifts), narrow
+        self.observations = [] #(temp, freq, Hres, dH)
+        self.errors = [] #(|measured - predicted|, predicted peak-to-peak linewidth) of the scans with a window
+        self.windows = {} #(temp, freq): (center, width, linewidth) of the last window given out
+        self.misses = 0
+
+    def gamma(self):
+        """gamma of the temperatures with 2 or more frequencies, None while there are none"""
+        gammas = []
+        for temp in {o[0] for o in self.observations}:
+            H, freq = np.array([(o[2], o[1]) for o in self.observations if o[0] == temp]).T
+            if len(set(freq)) < 2: continue
+            gamma = kittelGuess(H, freq)[0]
+            gammas.append(gamma if GammaRange[0] < gamma < GammaRange[1] else gamma_0)
+        return float(np.median(gammas)) if gammas else None
+
+    def Meffs(self, gamma):
+        """{temp: Meff} of the measured temperatures"""
+        Meffs = {}
+        for temp in sorted({o[0] for o in self.observations}):
+            H, freq = np.array([(o[2], o[1]) for o in self.observations if o[0] == temp]).T
+            Meffs[temp] = fitMeff(H, freq, gamma)
+        return Meffs
+
+    def resonance(self, temp, freq, gamma=None):
+        """Predicted Hres in G, None before the first fit"""
+        if not self.observations: return None
+        gamma = gamma or self.gamma() or gamma_0
+        Meffs = self.Meffs(gamma)
+        if temp in Meffs or len(Meffs) > 1: return float(resonanceField(freq, gamma, extrapolate(list(Meffs), list(Meffs.values()), temp)))
+        #One temperature so far: the Temps:Shift of the plan moves it to the others
+        (measured, Meff), = Meffs.items()
+        return float(resonanceField(freq, gamma, Meff)) + round(self.shifts.get(temp, 0)) - round(self.shifts.get(measured, 0))
+
+    def linewidth(self, temp, freq):
+        """Predicted peak-to-peak linewidth in G, None before the first fit"""
+        observed = [o for o in self.observations if o[0] == temp] or self.observations
+        if not observed: return None
+        freqs, dHs = np.array([o[1] for o in observed]), np.array([o[3] for o in observed])
+        dH = np.polyfit(freqs, dHs, 1) @ [freq, 1] if len(set(freqs)) > 1 else dHs.mean()
+        return max(float(dH), 0.5 * dHs.min()) / np.sqrt(3) #dH of singleLorentzian is the full width at half maximum
+
+    def margin(self):
+        """How far off the last predictions were, in G"""
+        return max(e for e, linewidth in self.errors[-2:]) if self.errors else 0.0
+
+    def confident(self):
+        return len(self.errors) >= 2 and all(e < 0.5 * linewidth for e, linewidth in self.errors[-2:])
+
+    def window(self, temp, freq):
+        """(center, width) in G of the scan of freq at temp, None before the first fit"""
+        center = self.resonance(temp, freq)
+        if center is None: return None
+        linewidth = self.linewidth(temp, freq)
+        margin = self.margin()
+        if self.gamma() is None: #Only the Meff of gamma_0 is known: as far as a gamma GammaSpread off would move it
+            margin = max(margin, abs(self.resonance(temp, freq, gamma_0 * (1 + GammaSpread)) - center))
+        width = (self.narrow if self.confident() else WindowWidth) * linewidth + 4 * margin
+        if all(o[0] != temp for o in self.observations): width = NewTempWidth * max(width, WindowWidth * linewidth)
+        self.windows[(temp, freq)] = (center, width, linewidth)
+        return round(center, 1), width
+
+    def add(self, temp, freq, fields, signal):
+        """Fit the spectrum of a finished scan. Returns (Hres, dH), or None if the resonance was missed"""
+        fields, signal = np.asarray(fields, float), np.asarray(signal, float)
+        window = self.windows.pop((temp, freq), None)
+        fit = fitSingleLorentzian(fields, signal) if len(fields) > 5 else None
+        if fit is not None:
+            params, covariance, noise = fit
+            Hres, dH = params[HRES], abs(params[DH])
+            linewidth = dH / np.sqrt(3)
+            if fields.min() + linewidth < Hres < fields.max() - linewidth and dH < np.ptp(fields) \
+                    and np.sqrt(covariance[HRES, HRES]) < linewidth:
+                if window: self.errors.append((abs(Hres - window[0]), window[2]))
+                self.observations.append((temp, freq, float(Hres), float(dH)))
+                return float(Hres), float(dH)
+        self.misses += 1
+        if window: self.errors.append((0.5 * window[1], window[2])) #Off by at least half the window
+        return None
+
+    def summary(self):
+        gamma = self.gamma() or gamma_0
+        text = "{} fits, {} misses".format(len(self.observations), self.misses)
+        if not self.observations: return text
+        Meffs = self.Meffs(gamma)
+        residuals = [o[1] - resFreq_vs_Field(o[2], gamma, Meffs[o[0]]) for o in self.observations]
+        return text + ", gamma {:.5f}, Meff {}, Kittel rms {:.3f} GHz".format(
+            gamma, ", ".join("{}K: {:.0f}".format(t, m) for t, m in Meffs.items()), np.sqrt(np.mean(np.square(residuals))))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay the scans of a folder through the tracker: each scan is predicted "
+                                                 "from the ones before it")
+    parser.add_argument("folder", help="The folder of the sample, with the .npy of the scans")
+    parser.add_argument("--narrow", type=float, default=5)
+    args = parser.parse_args()
+    scans = []
+    for path in sorted(glob.glob(os.path.join(args.folder, "*.npy")), key=os.path.getmtime):
+        if path.endswith("_search.npy"): continue #Coarse scans of a resonance search
+        scan = loadScan(path)
+        if len(scan): scans.append((round(float(np.median(scan["Temp(K)"])), 1), float(scan["RF Freq(GHz)"][0]), scan))
+    tracker = ResonanceTracker({}, args.narrow)
+    print("{:>8}{:>8}{:>12}{:>12}{:>10}".format("T(K)", "f(GHz)", "predicted", "measured", "window"))
+    for temp, freq, scan in scans:
+        window = tracker.window(temp, freq)
+        fit = tracker.add(temp, freq, scan["Field(G)"], scan["Lockin_X_Ave"])
+        print("{:>8}{:>8}{:>12}{:>12}{:>10}".format(temp, freq, "{:.1f}".format(window[0]) if window else "-",
+                                                    "{:.1f}".format(fit[0]) if fit else "missed",
+                                                    "{:.1f}".format(window[1]) if window else "-"))
+    print(tracker.summary())
@@ -0,0 +1,163 @@
+"""SQLite catalog of every scan csv under a data folder, with the features of loadCSVandPreprocess cached.
+
+    catalog = RunCatalog("D:\\Data")          #catalog file D:\\Data\\run_catalog.sqlite
+    catalog.update()                         #parses only the csv files that are new or changed (size, mtime)
+    catalog.query(sample="LSC441_YIG", temp=300, freq=(5, 15))
+The file name gives the key (<sample>_<T>K_<f>GHz_<P>dBm_<I>mA.csv of a field scan, <field>G instead of
+<f>GHz for a frequency scan), the csv the point count and the peak-to-peak guesses (Hres, Sym, AntiSym,
+dH, H1, H2, max, min of Lockin_X_Ave). For frequency scans these are in GHz along the frequency axis.
+    python run_catalog.py "D:\\Data" update
+    python run_catalog.py "D:\\Data" query --sample LSC441_YIG --temp 300 --freq 5 15
+"""
+import argparse, os, sqlite3, time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from Common_FuncsClasses import peakToPeakGuess
+
+CatalogFile = "run_catalog.sqlite"
+KeyColumns = ["sample", "temp", "freq", "field", "power", "current"]
+FeatureColumns = ["points", "Hres", "sym", "antiSym", "dH", "H1", "H2", "signalMax", "signalMin"]
+Columns = ["path", "folder", "kind"] + KeyColumns + ["size", "mtime"] + FeatureColumns + ["error"]
+
+
+def _number(word, unit):
+    return float(word[:-len(unit)].replace('p', '.'))
+
+
+def parseScanName(file):
+    """{"kind", "sample", "temp", "freq", "field", "power", "current"} from the name of a scan csv, or None
+    if it is not one. Missing parts are None"""
+    words = os.path.basename(file)[:-len(".csv")].split('_') if file.endswith(".csv") else []
+    tempIndex = next((i for i, w in enumerate(words) if w.endswith('K') and w[:-1].replace('p', '').isdigit()), None)
+    if not tempIndex: return None #The sample name comes first
+    if words[-1] == "search": return None #The coarse scan of a resonance search, see resonance_search.py
+    key = dict.fromkeys(KeyColumns)
+    key.update(sample="_".join(words[:tempIndex]), temp=_number(words[tempIndex], 'K'))
+    for word in words[tempIndex + 1:]:
+        for unit, name in (("GHz", "freq"), ("dBm", "power"), ("mA", "current"), ("G", "field")):
+            if word.endswith(unit):
+                try: key[name] = _number(word, unit)
+                except ValueError: pass
+                break
+    if key["freq"] is not None: key["kind"] = "field"
+    elif key["field"] is not None: key["kind"] = "frequency"
+    else: return None
+    return key
+
+
+def scanFeatures(path):
+    """Catalog row of one csv. Runs in the worker processes"""
+    stat = os.stat(path)
+    row = dict(parseScanName(path), path=path, folder=os.path.dirname(path), size=stat.st_size, mtime=stat.st_mtime_ns)
+    try:
+        df = pd.read_csv(path)
+        x = df["Field(G)" if row["kind"] == "field" else "RF Freq(GHz)"].values.astype(float)
+        lockin = df["Lockin_X_Ave"].values.astype(float)
+        mask = np.isfinite(x) & np.isfinite(lockin) #Lines of only ,,,, are nan
+        x, lockin = x[mask], lockin[mask]
+        row["points"] = len(x)
+        if len(x): row.update(zip(FeatureColumns[1:], (float(v) for v in peakToPeakGuess(x, lockin))))
+    except Exception as e:
+        row["error"] = "{}: {}".format(type(e).__name__, e)
+    return row
+
+
+class RunCatalog:
+    def __init__(self, root, path=None):
+        self.root = os.path.abspath(root)
+        self.path = path or os.path.join(self.root, CatalogFile)
+        self.db = sqlite3.connect(self.path)
+        types = {"path": "TEXT PRIMARY KEY", "folder": "TEXT", "kind": "TEXT", "sample": "TEXT", "error": "TEXT",
+                 "size": "INTEGER", "mtime": "INTEGER", "points": "INTEGER"}
+        self.db.execute("CREATE TABLE IF NOT EXISTS scans ({})".format(
+            ", ".join("{} {}".format(c, types.get(c, "REAL")) for c in Columns)))
+        self.db.execute("CREATE INDEX IF NOT EXISTS scanKey ON scans (sample, temp, freq, power, current)")
+        self.db.commit()
+
+    def __enter__(self): return self
+
+    def __exit__(self, *exc): self.close()
+
+    def close(self):
+        self.db.close()
+
+    def update(self, workers=None):
+        """Add the new and changed csv files under root, drop the deleted ones. Returns the number parsed"""
+        start = time.time()
+        known = {path: (size, mtime) for path, size, mtime in self.db.execute("SELECT path, size, mtime FROM scans")}
+        found, todo = set(), []
+        for folder, dirs, files in os.walk(self.root):
+            for file in sorted(files):
+                if not parseScanName(file): continue
+                path = os.path.join(folder, file)
+                stat = os.stat(path)
+                found.add(path)
+                if known.get(path) != (stat.st_size, stat.st_mtime_ns): todo.append(path)
+        rows = []
+        if len(todo) > 8:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                rows = list(pool.map(scanFeatures, todo, chunksize=max(1, len(todo) // (4 * (workers or os.cpu_count() or 1)))))
+        else: rows = [scanFeatures(path) for path in todo]
+        with self.db:
+            self.db.executemany("DELETE FROM scans WHERE path = ?", [(path,) for path in set(known) - found])
+            self.db.executemany("INSERT OR REPLACE INTO scans ({}) VALUES ({})".format(", ".join(Columns), ", ".join("?" * len(Columns))),
+                                [tuple(row.get(c) for c in Columns) for row in rows])
+        print("Catalog: {} scans, {} new or changed, {} removed in {:.1f}s".format(
+            len(found), len(todo), len(set(known) - found), time.time() - start))
+        return len(todo)
+
+    def query(self, kind="field", **conditions):
+        """DataFrame of the scans matching every condition. A condition is a value, or a (low, high) range
+        of a number, e.g. query(sample="LSC441_YIG", temp=300, freq=(5, 15), power=0)"""
+        where, args = ["kind = ?"], [kind]
+        for name, value in conditions.items():
+            if name not in KeyColumns + FeatureColumns: raise ValueError("Unknown column {}".format(name))
+            if value is None: continue
+            if isinstance(value, (tuple, list)):
+                where.append("{} BETWEEN ? AND ?".format(name))
+                args += [min(value), max(value)]
+            elif isinstance(value, str):
+                where.append("{} = ?".format(name))
+                args.append(value)
+            else:
+                where.append("ABS({} - ?) < 1e-6".format(name))
+                args.append(float(value))
+        sql = "SELECT * FROM scans WHERE {} ORDER BY sample, temp, freq, field, power, current".format(" AND ".join(where))
+        return pd.read_sql_query(sql, self.db, params=args)
+
+    def features(self, path):
+        """Cached row of one csv as a dict, parsed again if the file changed"""
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        cursor = self.db.execute("SELECT * FROM scans WHERE path = ?", (path,))
+        row = cursor.fetchone()
+        if row is not None:
+            row = dict(zip([d[0] for d in cursor.description], row))
+            if (row["size"], row["mtime"]) == (stat.st_size, stat.st_mtime_ns): return row
+        if not parseScanName(path): raise ValueError("Not a scan file: {}".format(path))
+        row = scanFeatures(path)
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO scans ({}) VALUES ({})".format(", ".join(Columns), ", ".join("?" * len(Columns))),
+                            tuple(row.get(c) for c in Columns))
+        return row
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Catalog of the scans under a data folder")
+    parser.add_argument("folder")
+    parser.add_argument("command", choices=["update", "query"])
+    parser.add_argument("--kind", default="field", help="field or frequency (scans)")
+    parser.add_argument("--sample", default=None)
+    for name in ("temp", "freq", "field", "power", "current"):
+        parser.add_argument("--" + name, type=float, nargs="+", default=None, help="A value, or low and high")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+    with RunCatalog(args.folder) as catalog:
+        if args.command == "update": catalog.update(args.workers)
+        else:
+            conditions = {name: (values if len(values) > 1 else values[0]) for name, values in vars(args).items()
+                          if name in KeyColumns and name != "sample" and values is not None}
+            result = catalog.query(args.kind, sample=args.sample, **conditions)
+            with pd.option_context("display.width", 200, "display.max_columns", 20, "display.max_rows", 500):
+                print(result.drop(columns=["folder", "size", "mtime"]))
@@ -0,0 +1,187 @@
+"""How long a ScanPlan will take, before it runs, from a timing model calibrated on the traces of past runs.
+
+    model = calibrate("D:\\Data")                #every <scan>_trace.json under the folder, saved to timing_model.json
+    result = estimate(plan, model, startTemp=300, startField=0)
+    print(formatEstimate(result))
+The dry run expands the plan through the same field grids (prepareFieldstoScan) and scan order (SweepPlanner) as
+the engine, and adds up the temperature ramps and waitForTemperature, the magnet ramps and waitForField, the
+source changes, the points (settling and lock-in reads) and the pause after every scan. With ScanPlan.search every
+scan is estimated with its coarse scan (travel and points at searchTimeConst) before it, also with resonance
+tracking, which only searches the scans it cannot predict: then the estimate is an upper bound. The traces give the
+calibration: the "transition" spans (temperature, first field, rf power, modulation) with where they started
+and ended, the "fields" span of every scan with its points, time constant and modes, and the "next freq" pauses.
+The engine uses the saved model for the estimate it logs before the first scan.
+    python run_estimator.py "D:\\Data" calibrate
+    python run_estimator.py "D:\\Data" estimate --temps "300: 0, 250: 4" --freqs "10: 2400, 12: 3000" --timeconst 8
+"""
+import argparse, json, os
+import numpy as np
+from measurement_engine import ScanPlan, prepareFieldstoScan, TimeConst_WaitTime_Conversion
+from resonance_search import coarseFields
+from lockin_control import SR830_TimeConsts
+from sweep_planner import SweepPlanner, CostModel, CostParts, TimingModel, TimingFile
+
+
+def traceSummary(path):
+    """What calibrate needs from one trace file: the transitions, the scans and the pauses"""
+    with open(path) as file: events = json.load(file)["traceEvents"]
+    summary = {"transitions": [], "scans": [], "pauses": [], "rf": []}
+    for event in events:
+        if event.get("ph") != "X": continue
+        seconds, args = event["dur"] * 1e-6, event.get("args", {})
+        if event["cat"] == "transition":
+            summary["transitions"].append([event["name"], args.get("start"), args.get("target"), seconds])
+        elif event["cat"] == "scan": summary["scans"].append(dict(args, duration=seconds))
+        elif event["name"] == "next freq": summary["pauses"].append(seconds)
+        elif event["name"].startswith("N5183 write :SOUR:FREQ:CW"): summary["rf"].append(seconds)
+    return summary
+
+
+def _line(x, y):
+    """(slope, intercept) of y = slope * x + intercept, None if x does not spread"""
+    x, y = np.asarray(x, float), np.asarray(y, float)
+    if len(x) < 3 or np.ptp(x) <= 0: return None
+    return tuple(float(v) for v in np.polyfit(x, y, 1))
+
+
+def _ramp(pairs, rate, scale=1):
+    """(rate, settle) from [(distance, seconds)] of seconds = scale * distance / rate + settle.
+    Keeps rate if the distances are all alike"""
+    fit = _line([d for d, s in pairs], [s for d, s in pairs])
+    if fit and fit[0] > 0: return scale / fit[0], max(fit[1], 0.0)
+    return rate, max(float(np.median([s - scale * d / rate for d, s in pairs])), 0.0)
+
+
+def _pointTimes(scans, fieldRate):
+    """{"scanMode/settleMode/readMode": (offset, slope)} of seconds per point = offset + slope x time constant,
+    without the field travel during the scan"""
+    groups = {}
+    for scan in scans:
+        if not scan.get("points"): continue
+        rate = float(scan.get("sweepRate") or 1) if scan["scanMode"] == "sweep" else fieldRate
+        perPoint = (scan["duration"] - scan["span"] / rate) / scan["points"]
+        key = "/".join((scan["scanMode"], scan["settleMode"], scan["readMode"]))
+        groups.setdefault(key, []).append((scan["timeConst"], perPoint))
+    pointTimes = {}
+    for key, samples in groups.items():
+        timeConsts, perPoint = np.array(samples).T
+        fit = _line(timeConsts, perPoint)
+        if fit and fit[0] >= 0: pointTimes[key] = (fit[1], fit[0])
+        elif key.startswith("sweep/"): pointTimes[key] = (max(float(np.median(perPoint)), 0.0), 0.0)
+        else:
+            #One time constant: the offset from the uncalibrated slope, or all of it scales with the time constant
+            timeConst, median = float(np.median(timeConsts)), float(np.median(perPoint))
+            slope = TimeConst_WaitTime_Conversion
+            if median < slope * timeConst: slope, offset = median / timeConst, 0.0
+            else: offset = median - slope * timeConst
+            pointTimes[key] = (offset, slope)
+    return pointTimes
+
+
+def calibrate(root, path=None, save=True):
+    """TimingModel from the traces of the scans under root. The summaries of the traces are kept in the
+    model file, so only new or changed traces are read again"""
+    path = path or os.path.join(root, TimingFile)
+    cached = {}
+    if os.path.exists(path):
+        with open(path) as file: cached = json.load(file).get("traces", {})
+    traces = {}
+    for folder, dirs, files in os.walk(root):
+        for file in sorted(files):
+            if not file.endswith("_trace.json"): continue
+            trace = os.path.join(folder, file)
+            mtime = os.stat(trace).st_mtime_ns
+            if trace in cached and cached[trace][0] == mtime: traces[trace] = cached[trace]
+            else:
+                try: traces[trace] = [mtime, traceSummary(trace)]
+                except (ValueError, KeyError) as e: print("Skipped {}: {}".format(trace, e))
+    summaries = [summary for mtime, summary in traces.values()]
+    transitions = [t for s in summaries for t in s["transitions"] if t[1] is not None and t[2] is not None]
+    default, params, samples = CostModel(), {}, {}
+    temps = [(abs(target - start), seconds) for name, start, target, seconds in transitions if name == "temperature"]
+    if temps: params["tempRate"], params["tempSettle"] = _ramp(temps, default.tempRate, scale=60)
+    fields = [(abs(target - start), seconds) for name, start, target, seconds in transitions if name == "first field"]
+    if fields: params["fieldRate"], params["fieldSettle"] = _ramp(fields, default.fieldRate)
+    for name, key in (("rf power", "powerSwitch"), ("modulation", "modSwitch")):
+        seconds = [t[3] for t in transitions if t[0] == name]
+        if seconds: params[key] = float(np.median(seconds))
+        samples[name] = len(seconds)
+    for name, key in (("rf", "rfSwitch"), ("pauses", "scanPause")):
+        seconds = [value for s in summaries for value in s[name]]
+        if seconds: params[key] = float(np.median(seconds))
+        samples[name] = len(seconds)
+    scans = [scan for s in summaries for scan in s["scans"]]
+    samples.update(temperature=len(temps), field=len(fields), scans=len(scans), traces=len(traces))
+    model = TimingModel(params, _pointTimes(scans, params.get("fieldRate", default.fieldRate)), samples)
+    if save: model.save(path, traces=traces)
+    print("Timing model from {} traces ({} scans): {}".format(len(traces), len(scans), path if save else "not saved"))
+    return model
+
+
+def estimate(plan, model=None, timeConst=0.1, startTemp=None, startField=None, startPower=None, startCurrent=None):
+    """{"total", "parts", "points", "scans"} in seconds of running plan (ScanPlan). timeConst in s is the
+    lock-in time constant if plan.waitTime is None. Frequency and interleave scans are estimated as step
+    scans of the same fields in the given order. With plan.search every scan has its coarse scan ("search" part)"""
+    model = model or TimingModel()
+    if plan.waitTime is not None: timeConst = plan.waitTime / TimeConst_WaitTime_Conversion
+    fieldsAtTemps = {temp: prepareFieldstoScan(plan, shift, False) for temp, shift in plan.tempsandShifts.items()}
+    coarse = coarseFields(plan.search) if plan.search else []
+    costModel = model.costModel(plan, timeConst, coarse)
+    order = plan.order
+    if plan.scanMode in ("frequency", "interleave"):
+        costModel.pointTime = model.pointTime("step", "fixed", plan.readMode, timeConst)
+        order = "given"
+    planner = SweepPlanner(fieldsAtTemps, plan.powers or [startPower], plan.currents or [startCurrent], costModel,
+                           startTemp=startTemp, startField=startField, startPower=startPower, startCurrent=startCurrent)
+    points = planner.order(order, plan.reverse)
+    total, parts = planner.cost(points)
+    return {"total": total, "parts": parts, "points": sum(len(planner.fields(p)) for p in points), "scans": len(points),
+            "order": order, "pointTime": costModel.pointTime, "searchPoints": len(coarse) * len(points), "track": plan.track}
+
+
+def formatEstimate(result):
+    total = result["total"] or 1
+    lines = ["{} scans, {} points in {} order: {:.2f} h ({:.2f} s per point)".format(
+        result["scans"], result["points"], result["order"], result["total"] / 3600, result["pointTime"])]
+    for part in CostParts:
+        seconds = result["parts"][part]
+        if seconds: lines.append("    {:<20}{:>10.0f}s {:>6.1f}%".format(part, seconds, 100 * seconds / total))
+    if result.get("searchPoints"):
+        lines.append("    search: {} coarse points, one coarse scan per scan{}".format(
+            result["searchPoints"], " (an upper bound: tracked scans are not searched)" if result.get("track") else ""))
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Calibrate the timing model on past runs, or estimate a plan")
+    parser.add_argument("folder", help="Data folder: the traces under it and the timing model file")
+    parser.add_argument("command", choices=["calibrate", "estimate"])
+    parser.add_argument("--temps", default="300: 0", help="Temps(K):Shift(G) pairs")
+    parser.add_argument("--freqs", default="10: 2400", help="Freq(GHz):Field(G) pairs")
+    parser.add_argument("--linewidths", default="4,5", help="Initial and final linewidth in G")
+    parser.add_argument("--step", default="1", help="Field step size in G")
+    parser.add_argument("--timeconst", type=int, default=8, help="SR830 OFLT index, 8 = 100ms")
+    parser.add_argument("--scan-mode", default="step")
+    parser.add_argument("--read-mode", default="snap")
+    parser.add_argument("--settle", default="model")
+    parser.add_argument("--sweep-rate", type=float, default=1)
+    parser.add_argument("--order", default="given")
+    parser.add_argument("--powers", default="")
+    parser.add_argument("--currents", default="")
+    parser.add_argument("--search", default="", help="From, to, step(G) of a coarse search scan")
+    parser.add_argument("--search-timeconst", type=int, default=6, help="SR830 OFLT index of the search scan")
+    parser.add_argument("--track", action="store_true")
+    parser.add_argument("--start-temp", type=float, default=None)
+    parser.add_argument("--start-field", type=float, default=None)
+    args = parser.parse_args()
+    path = os.path.join(args.folder, TimingFile)
+    if args.command == "calibrate":
+        model = calibrate(args.folder)
+        print(json.dumps({"params": model.params, "pointTimes": model.pointTimes, "samples": model.samples}, indent=1))
+    else:
+        plan = ScanPlan.fromText("Estimate", args.folder, args.temps, args.freqs, args.linewidths.split(','), args.step,
+                                 powers=args.powers, currents=args.currents, scanMode=args.scan_mode, readMode=args.read_mode,
+                                 settleMode=args.settle, sweepRate=args.sweep_rate, order=args.order, search=args.search,
+                                 searchTimeConst=args.search_timeconst, track=args.track)
+        model = TimingModel.load(path) if os.path.exists(path) else TimingModel()
+        print(formatEstimate(estimate(plan, model, SR830_TimeConsts[args.timeconst], args.start_temp, args.start_field)))
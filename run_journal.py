@@ -0,0 +1,108 @@
+"""Journal of a run, so an interrupted plan can be resumed without measuring anything twice.
+
+The journal (<folder>/<sample>/run_journal.json) holds the plan and the state of every scan, keyed by
+its temperature set point, frequency, RF power and modulation amplitude: "started" or "complete". In
+frequency and interleave runs every file is a scan too: the frequency of the key is that of its Freq:Field
+pair, and the entry also holds the scan mode. It
+is replaced atomically (written to a temporary file, then renamed), so a crash leaves either the old or
+the new version. The points themselves are in the .npy of the scan, flushed in batches by ScanWriter.
+    engine.run(plan)                               #journals as it goes
+    engine.run(ScanPlan.fromDict(RunJournal(folder).load().state["plan"]), resume=True)
+On resume the completed scans are skipped, the temperature of the first scan is stabilized again and an
+interrupted scan continues with the fields (the frequencies of a frequency scan) that are not in its .npy yet.
+    python run_journal.py "D:\\Data\\LSC441_YIG"     #what is done and what is left
+"""
+import argparse, json, os, time
+import numpy as np
+from data_writer import loadScan
+
+JournalFile = "run_journal.json"
+
+
+def scanKey(temp, freq, power=None, current=None):
+    """Journal key of a scan, from its set points"""
+    return "/".join("{:g}".format(v) if v is not None else "-" for v in (temp, freq, power, current))
+
+
+def remainingFields(fields, path, tolerance=1e-6, column="Field(G)"):
+    """The fields of the scan that are not in its .npy yet, in the order given. column: "RF Freq(GHz)" for the
+    frequencies of a frequency scan"""
+    if not os.path.exists(path): return list(fields)
+    try: measured = loadScan(path)[column]
+    except (ValueError, OSError) as e:
+        print("Could not read {}, measuring the scan again: {}".format(path, e))
+        return list(fields)
+    return [field for field in fields if not np.any(np.abs(measured - field) < tolerance)]
+
+
+class RunJournal:
+    def __init__(self, folderName, path=None):
+        self.path = path or os.path.join(folderName, JournalFile)
+        self.state = None
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def load(self):
+        with open(self.path) as file: self.state = json.load(file)
+        return self
+
+    def save(self):
+        self.state["updated"] = time.time()
+        temporary = self.path + ".tmp"
+        with open(temporary, "w") as file:
+            json.dump(self.state, file, indent=1)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, self.path)
+
+    def begin(self, plan):
+        """New journal for plan (ScanPlan). An unfinished one is replaced"""
+        if self.exists():
+            previous = self.load().state
+            if previous.get("status") != "finished":
+                print("Replacing the journal of an unfinished run from {}".format(time.ctime(previous.get("started", 0))))
+        self.state = {"plan": plan.toDict(), "status": "running", "started": time.time(), "scans": {}}
+        self.save()
+        return self
+
+    def resume(self):
+        self.load()
+        self.state["status"] = "running"
+        self.state["resumed"] = self.state.get("resumed", 0) + 1
+        self.save()
+        return self
+
+    def status(self, key):
+        return self.state["scans"].get(key, {}).get("state")
+
+    def file(self, key):
+        return self.state["scans"].get(key, {}).get("file")
+
+    def started(self, key, filename, mode=None):
+        """filename: the csv of the scan. mode: the scan mode of a frequency or interleave scan"""
+        self.state["scans"][key] = {"state": "started", "file": filename, "time": time.time()}
+        if mode is not None: self.state["scans"][key]["mode"] = mode
+        self.save()
+
+    def complete(self, key):
+        self.state["scans"][key]["state"] = "complete"
+        self.save()
+
+    def finish(self, aborted):
+        self.state["status"] = "aborted" if aborted else "finished"
+        self.save()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Progress of a run from its journal")
+    parser.add_argument("folder", help="The folder of the sample, which holds run_journal.json")
+    args = parser.parse_args()
+    journal = RunJournal(args.folder).load()
+    state = journal.state
+    print("{} run started {}, last update {}".format(state["status"], time.ctime(state["started"]), time.ctime(state["updated"])))
+    for key, scan in state["scans"].items():
+        points = ""
+        path = scan["file"].replace(".csv", ".npy")
+        if path.endswith(".npy") and os.path.exists(path): points = "{} points".format(len(loadScan(path)))
+        print("    {:<28}{:<10}{:>12}  {}".format(key, scan["state"], points, os.path.basename(scan["file"])))
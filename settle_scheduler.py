@@ -0,0 +1,196 @@
+"""When each point of a stepped field scan is settled, from the physics instead of a fixed 5x time constant.
+
+After setField the magnet ramps for |step|/rate, and the lock-in output then follows through its n-pole
+RC filter (n = OFSL + 1). A step seen through n poles still lacks the fraction
+    residual(n, t/tau) = exp(-t/tau) * sum(k < n) (t/tau)^k / k!
+of its size after t. A point is read once that residual, averaged over the samples the reader takes, times
+the expected change of the signal is below the noise of the point: in the wings of the line the signal barely changes and the point is ready right after
+the ramp, at the steep parts of the line the full settling is waited. The change of the signal is
+predicted from the slope of the last points, and without that history the point settles to `accuracy`.
+The next setpoint is commanded during the read of the current point, as soon as it leaks less than that
+tolerance into the last sample (LockinReader.read(ahead=...)).
+
+The model is checked on the instrument with recorded settle curves:
+    curves = [recordSettleCurve(ppms, lockin, 2400, step) for step in (1, 2, 5)]
+    print(validate(scheduler, curves))   #predicted vs measured settle times
+    calibrate(scheduler, curves)         #fit the magnet delay
+"""
+import time
+import numpy as np
+from lockin_control import SR830_TimeConsts
+
+SettleModes = ["model", "fixed"] #"fixed": the original waitTime = 5 x time constant
+
+
+def residual(nPoles, x):
+    """Fraction of a step not yet at the output of nPoles cascaded RC filters, x = t / tau after the step"""
+    x = np.maximum(np.asarray(x, dtype=float), 0.0)
+    term, total = np.ones_like(x), np.ones_like(x)
+    for k in range(1, nPoles):
+        term = term * x / k
+        total = total + term
+    return np.exp(-x) * total
+
+
+def rampResidual(nPoles, t, tau, rampTime):
+    """residual() for an input that ramps linearly during rampTime instead of stepping. t from the ramp start"""
+    if rampTime <= 0: return float(residual(nPoles, t / tau))
+    s = (np.arange(16) + 0.5) / 16 * min(rampTime, t) #Midpoints of the part of the ramp before t
+    done = np.mean(1 - residual(nPoles, (t - s) / tau)) * min(rampTime, t) / rampTime
+    return 1 - done
+
+
+def _solve(function, target, high):
+    """Smallest t in [0, high] with function(t) <= target, for a function that decreases with t"""
+    low = 0.0
+    if function(low) <= target: return low
+    while function(high) > target: high *= 2
+    for i in range(50):
+        middle = 0.5 * (low + high)
+        if function(middle) > target: low = middle
+        else: high = middle
+    return high
+
+
+class SettleScheduler:
+    """scheduler = SettleScheduler.fromLockin(lockin, rate=100)
+    for field, nextField in zip(fields, fields[1:] + [None]):
+        fieldActual, x, y, xErr, yErr = scheduler.step(ppms, reader, field, nextField)
+    accuracy: smallest residual ever required. maxResidual: largest residual allowed, however small the signal.
+    noiseFactor: the left-over change may be this many standard errors of the point"""
+    def __init__(self, timeConst, slope_i, rate=100, accuracy=0.005, maxResidual=0.1, noiseFactor=0.5, safety=2.0,
+                 magnetDelay=0.0):
+        self.tau, self.nPoles, self.rate = timeConst, slope_i + 1, float(rate)
+        self.accuracy, self.maxResidual = accuracy, maxResidual
+        self.noiseFactor, self.safety, self.magnetDelay = noiseFactor, safety, magnetDelay
+        self.reset()
+
+    @classmethod
+    def fromLockin(cls, lockin, rate=100, **kwargs):
+        timeConst = SR830_TimeConsts[int(lockin.query("OFLT?").strip())]
+        return cls(timeConst, int(lockin.query("OFSL?").strip()), rate, **kwargs)
+
+    def reset(self):
+        """Forget the signal history, e.g. at the start of every field scan"""
+        self.history = [] #(field, X, Y, error) of the last points
+        self.commandedField, self.commandTime, self.readyAt = None, None, None
+        self.offsets = (0.0,)
+
+    def tolerance(self, step):
+        """Residual allowed for a field step: the expected change of the signal may be left over down to
+        noiseFactor x the standard error of the last point"""
+        if len(self.history) < 2 or step == 0: return self.accuracy
+        slopes = [max(abs(x1 - x0), abs(y1 - y0)) / abs(h1 - h0)
+                  for (h0, x0, y0, e0), (h1, x1, y1, e1) in zip(self.history, self.history[1:]) if h1 != h0]
+        if not slopes: return self.accuracy
+        expected = self.safety * max(slopes) * abs(step)
+        if expected <= 0: return self.maxResidual
+        return min(self.maxResidual, max(self.accuracy, self.noiseFactor * self.history[-1][3] / expected))
+
+    def settleTime(self, step, offsets=(0.0,)):
+        """Time from the setField command until the wait before the samples may end. offsets are the times of
+        the samples after the end of the wait (LockinReader.sampleOffsets())"""
+        rampTime = abs(step) / self.rate
+        epsilon = self.tolerance(step)
+        def meanResidual(t): return np.mean([rampResidual(self.nPoles, t + offset, self.tau, rampTime) for offset in offsets])
+        return self.magnetDelay + _solve(meanResidual, epsilon, 10 * self.tau + rampTime)
+
+    def lead(self, step, offsets=(0.0,)):
+        """How long before the last sample of the current point the next field (step away) may be commanded.
+        The samples before the last one see less of the next step"""
+        epsilon = self.tolerance(step)
+        before = max(offsets) - np.asarray(offsets, dtype=float) #Time of each sample before the last one
+        def meanLeak(lead): return np.mean(1 - residual(self.nPoles, (lead - before) / self.tau))
+        return self.magnetDelay + _solve(lambda lead: -meanLeak(lead), -epsilon, self.tau)
+
+    def commanded(self, field, ppms=None, rate=None):
+        """Send setField (if ppms is given) and note when the point will be ready. The first field of a scan
+        is expected to be reached already (waitForField), so only the filter has to settle"""
+        step = field - self.commandedField if self.commandedField is not None else 0
+        if ppms is not None: ppms.setField(field, rate or self.rate)
+        self.commandTime = time.time()
+        self.readyAt = self.commandTime + self.settleTime(step, self.offsets)
+        self.commandedField = field
+
+    def remaining(self):
+        return max(0.0, self.readyAt - time.time()) if self.readyAt else 0.0
+
+    def step(self, ppms, reader, field, nextField=None):
+        """Read the point at field and command nextField during the read. Returns (fieldActual, x, y, xErr, yErr)"""
+        self.offsets = reader.sampleOffsets()
+        if field != self.commandedField: self.commanded(field, ppms)
+        point = {}
+        def commandNext():
+            point["fieldActual"] = ppms.getField()[1] #Before the magnet leaves
+            self.commanded(nextField, ppms)
+        ahead = (self.lead(nextField - field, self.offsets), commandNext) if nextField is not None else None
+        x, y, xErr, yErr = reader.read(self.remaining(), ahead=ahead)
+        fieldActual = point["fieldActual"] if "fieldActual" in point else ppms.getField()[1]
+        self.history = (self.history + [(field, x, y, max(xErr, yErr))])[-3:]
+        return fieldActual, x, y, xErr, yErr
+
+
+class FixedSettle:
+    """The original scheme: setField, wait waitTime, read. Same step() as SettleScheduler"""
+    def __init__(self, waitTime, rate=100):
+        self.waitTime, self.rate = waitTime, rate
+
+    def reset(self): pass
+
+    def step(self, ppms, reader, field, nextField=None):
+        ppms.setField(field, self.rate)
+        x, y, xErr, yErr = reader.read(waitTime=self.waitTime)
+        return (ppms.getField()[1], x, y, xErr, yErr)
+
+
+def recordSettleCurve(ppms, lockin, field, step, rate=100, duration=None, interval=None, settle=None):
+    """Park at field, command field + step and sample SNAP? 1,2 until duration.
+    Returns {"step": step, "t": times from the command, "X": X, "Y": Y}.
+    Pick a field on the slope of the line, so the step changes the signal well above the noise"""
+    tau = SR830_TimeConsts[int(lockin.query("OFLT?").strip())]
+    duration = duration or abs(step) / rate + 20 * tau
+    interval = interval if interval is not None else 0.1 * tau
+    ppms.setField(field, rate)
+    ppms.waitForField(timeout=240)
+    time.sleep(settle if settle is not None else 20 * tau)
+    samples = []
+    samples.append((0.0,) + tuple(float(v) for v in lockin.query("SNAP? 1,2").split(',')[:2]))
+    start = time.time()
+    ppms.setField(field + step, rate)
+    while time.time() - start < duration:
+        samples.append((time.time() - start,) + tuple(float(v) for v in lockin.query("SNAP? 1,2").split(',')[:2]))
+        time.sleep(interval)
+    t, X, Y = np.array(samples).T
+    return {"step": step, "t": t, "X": X, "Y": Y}
+
+
+def measuredSettleTime(t, signal, epsilon, tail=0.25):
+    """First time after which the signal stays within epsilon x the step of its final value.
+    The final value is the mean of the last tail fraction of the curve"""
+    t, signal = np.asarray(t, dtype=float), np.asarray(signal, dtype=float)
+    final = np.mean(signal[-max(1, int(tail * len(signal))):])
+    size = abs(final - signal[0])
+    if size == 0: return 0.0
+    outside = np.nonzero(np.abs(signal - final) > epsilon * size)[0]
+    if not len(outside): return float(t[0])
+    return float(t[min(outside[-1] + 1, len(t) - 1)])
+
+
+def validate(scheduler, curves, epsilon=0.05):
+    """[(step, predicted, measured), ...] settle times for the recorded curves. A loose epsilon keeps the
+    measurement above the noise of the curve"""
+    results = []
+    for curve in curves:
+        signal = curve["X"] if np.ptp(curve["X"]) >= np.ptp(curve["Y"]) else curve["Y"]
+        rampTime = abs(curve["step"]) / scheduler.rate
+        predicted = scheduler.magnetDelay + _solve(lambda t: rampResidual(scheduler.nPoles, t, scheduler.tau, rampTime),
+                                                   epsilon, 10 * scheduler.tau + rampTime)
+        results.append((curve["step"], predicted, measuredSettleTime(curve["t"], signal, epsilon)))
+    return results
+
+
+def calibrate(scheduler, curves, epsilon=0.05):
+    """Set scheduler.magnetDelay to the median lag of the measured settle times behind the model"""
+    delays = [measured - (predicted - scheduler.magnetDelay) for step, predicted, measured in validate(scheduler, curves, epsilon)]
+    scheduler.magnetDelay = max(0.0, float(np.median(delays))) if delays else scheduler.magnetDelay
+    return scheduler.magnetDelay
@@ -0,0 +1,112 @@
+"""Background polling of the instrument status for the GUI.
+
+Every instrument is wrapped in a LockedInstrument, so one command (e.g. a query = write + read) is on
+its bus at a time. Calls made directly on the wrapper (measurement thread, buttons) have priority: the
+StatusPoller only sends a query when nobody is waiting for the instrument, otherwise it skips it for
+that round. During a scan the lock-in is not polled at all, the measurement publishes its readings instead.
+The GUI only ever reads poller.state, an immutable InstrumentState that is replaced as a whole.
+A round of polling queues all queries at once on the async layer (async_instruments.py), so the PPMS
+on the LAN is read while the GPIB instruments answer.
+"""
+import asyncio, threading, time
+from collections import namedtuple
+from async_instruments import AsyncIO
+
+InstrumentState = namedtuple("InstrumentState", ["time", "field", "temperature", "X", "Y", "sensitivity", "timeConst",
+                                                 "lockinFreq", "rfFreq", "rfPower", "rfOn", "acFreq", "acAmplitude", "acOn"])
+EmptyState = InstrumentState(*([None] * len(InstrumentState._fields)))
+
+
+class LockedInstrument:
+    """Thread safe wrapper around a pyvisa resource or the Dynacool object. All methods of the wrapped
+    object are available and wait for the instrument. poll(name, *args) returns None instead of waiting.
+    Methods in unlocked (e.g. the Dynacool waitForField, which only blocks the caller) skip the lock"""
+    def __init__(self, instrument, unlocked=()):
+        self.instrument, self.unlocked = instrument, set(unlocked)
+        self.lock = threading.Lock()
+        self._waiting = 0 #Number of priority callers waiting for the lock
+        self._countLock = threading.Lock()
+
+    def __getattr__(self, name):
+        attribute = getattr(self.instrument, name)
+        if not callable(attribute) or name in self.unlocked: return attribute
+        def locked(*args, **kwargs):
+            with self._countLock: self._waiting += 1
+            self.lock.acquire()
+            with self._countLock: self._waiting -= 1
+            try: return attribute(*args, **kwargs)
+            finally: self.lock.release()
+        return locked
+
+    def poll(self, name, *args):
+        """Low priority call, skipped if the instrument is busy or someone is waiting for it"""
+        if self._waiting or not self.lock.acquire(blocking=False): return None
+        try: return getattr(self.instrument, name)(*args)
+        finally: self.lock.release()
+
+
+def lockPPMS(ppms):
+    return LockedInstrument(ppms, unlocked=("waitForField", "waitForTemperature"))
+
+
+class StatusPoller(threading.Thread):
+    """poller = StatusPoller(app); poller.start()
+    Reads app.ppms, app.lockin, app.rfPower, app.acMod every interval seconds (whichever are connected)"""
+    def __init__(self, app, interval=0.5, io=None):
+        threading.Thread.__init__(self, daemon=True)
+        self.app, self.interval = app, interval
+        self.io = io or AsyncIO()
+        self.state = EmptyState
+        self.scanning = False #Set by the measurement. The lock-in is then only updated by publish()
+        self.running = True
+        self._publishLock = threading.Lock()
+
+    def publish(self, **values):
+        """Merge values (e.g. X=, Y= from the measurement) into the state"""
+        with self._publishLock:
+            self.state = self.state._replace(time=time.time(), **values)
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        while self.running:
+            t0 = time.time()
+            try: self.publish(**self.pollOnce())
+            except Exception as e: print("Status poll failed:", e)
+            time.sleep(max(0.0, self.interval - (time.time() - t0)))
+
+    def pollOnce(self):
+        return self.io.run(self.pollAsync())
+
+    async def pollAsync(self):
+        app = self.app
+        async def poll(instrument, bus, name, *args):
+            if instrument is None: return None
+            device = self.io.instrument(instrument, bus)
+            if isinstance(instrument, LockedInstrument): return await device.poll(name, *args)
+            return await getattr(device, name)(*args)
+        def number(reply, scale=1.0):
+            return None if reply is None else float(str(reply).strip()) * scale
+        queries = {"field": (app.ppms, "LAN", "getField"), "temperature": (app.ppms, "LAN", "getTemperature"),
+                   "lockinFreq": (app.lockin, None, "query", "FREQ?")}
+        if not self.scanning:
+            queries.update(snap=(app.lockin, None, "query", "SNAP? 1,2"), sensitivity=(app.lockin, None, "query", "SENS?"),
+                           timeConst=(app.lockin, None, "query", "OFLT?"),
+                           rfFreq=(app.rfPower, None, "query", "FREQ?"), rfPower=(app.rfPower, None, "query", "POW?"),
+                           rfOn=(app.rfPower, None, "query", ":OUTP?"),
+                           acFreq=(app.acMod, None, "query", ":SOUR:WAVE:FREQ?"), acAmplitude=(app.acMod, None, "query", ":SOUR:WAVE:AMPL?"),
+                           acOn=(app.acMod, None, "query", ":OUTP:STAT?"))
+        replies = dict(zip(queries, await asyncio.gather(*(poll(*query) for query in queries.values()))))
+        replies = {key: reply for key, reply in replies.items() if reply is not None}
+        values = {}
+        if "field" in replies: values["field"] = replies["field"][1]
+        if "temperature" in replies: values["temperature"] = replies["temperature"][1]
+        if "snap" in replies: values["X"], values["Y"] = [float(v) for v in replies["snap"].split(',')[:2]]
+        for key in ("sensitivity", "timeConst"):
+            if key in replies: values[key] = int(replies[key].strip())
+        for key, scale in (("lockinFreq", 1.0), ("rfFreq", 1e-9), ("rfPower", 1.0), ("acFreq", 1.0), ("acAmplitude", 1000)):
+            if key in replies: values[key] = number(replies[key], scale)
+        for key in ("rfOn", "acOn"):
+            if key in replies: values[key] = '1' in replies[key]
+        return values
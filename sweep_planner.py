@@ -0,0 +1,230 @@
+"""Order of the field scans of a session over temperature, frequency, RF power and 6221 modulation amplitude.
+
+Every combination is one field scan. CostModel prices what happens between two scans (temperature ramp
+and settling, magnet travel to the first field, reconfiguring the N5183 and the 6221) and the scans
+themselves, and SweepPlanner picks the order with the lowest total:
+    "given"      temperatures as entered, frequencies ascending (descending when reversed), the field
+                 direction flipped every other temperature: the original order
+    "serpentine" temperatures monotonic from the current one, the other axes in a reflected (snake) order,
+                 for every nesting of the axes
+    "nearest"    temperatures monotonic, then always the cheapest next scan
+    "best"       the cheapest of serpentine and nearest
+Except for "given", every scan runs in the direction that starts closest to where the magnet is.
+    planner = SweepPlanner({300: {10: fields10, 12: fields12}}, powers=[0, 5], currents=[100])
+    points = planner.order("best")
+    print(planner.cost(points))
+"""
+import itertools, json
+from collections import namedtuple
+from lockin_control import SR830_TimeConsts
+
+SweepOrders = ["given", "serpentine", "nearest", "best"]
+SweepPoint = namedtuple("SweepPoint", ["temp", "freq", "power", "current", "reverse"])
+CostParts = ["temperature ramp", "temperature settle", "magnet ramp", "magnet settle", "rf", "power", "modulation",
+             "search", "points", "pause"]
+TimingFile = "timing_model.json"
+SettleFactors = {"fixed": 5, "model": 5} #Wait per point in time constants, when nothing is calibrated
+
+
+class CostModel:
+    """Seconds spent by the engine. tempRate in K/min as setTemperature, fieldRate in G/s as setField.
+    pointTime: settling + reading of one point. fieldSettle: waitForField after the ramp to the first field.
+    scanRate: G/s of the field during the scan, fieldRate if None. scanPause: the pause after every scan.
+    search: (fields, pointTime) of the coarse scan of resonance_search before every scan, None without search"""
+    def __init__(self, fieldRate=100, tempRate=20, tempSettle=300, fieldSettle=5, rfSwitch=0.1, powerSwitch=0.1,
+                 modSwitch=1.2, pointTime=0.6, scanPause=2.0, scanRate=None, search=None):
+        self.fieldRate, self.tempRate, self.tempSettle, self.fieldSettle = fieldRate, tempRate, tempSettle, fieldSettle
+        self.rfSwitch, self.powerSwitch, self.modSwitch = rfSwitch, powerSwitch, modSwitch
+        self.pointTime, self.scanPause, self.scanRate = pointTime, scanPause, scanRate or fieldRate
+        self.search = search
+
+    def temperature(self, fromTemp, toTemp):
+        """(ramp, settle) seconds"""
+        if fromTemp is None or fromTemp == toTemp: return 0.0, 0.0
+        return 60 * abs(toTemp - fromTemp) / self.tempRate, self.tempSettle
+
+    def magnet(self, fromField, toField):
+        """(ramp, settle) seconds of going to the first field of a scan"""
+        return (abs(toField - fromField) / self.fieldRate if fromField is not None else 0.0), self.fieldSettle
+
+    def scan(self, fields, pointTime=None):
+        """(points, pause) seconds of the scan itself"""
+        pointTime = self.pointTime if pointTime is None else pointTime
+        return len(fields) * pointTime + abs(fields[-1] - fields[0]) / self.scanRate, self.scanPause
+
+    def step(self, state, point, fields):
+        """{part: seconds} (CostParts) of going from state (temp, freq, power, current, field) to the end of the scan.
+        With search, the coarse scan (its travel included) comes first and the scan starts from its end"""
+        temp, freq, power, current, field = state
+        parts = dict(zip(CostParts, self.temperature(temp, point.temp)))
+        parts["magnet ramp"], parts["magnet settle"], parts["search"] = 0.0, 0.0, 0.0
+        if self.search is not None:
+            coarse, pointTime = self.search
+            coarse = coarse[::-1] if point.reverse else coarse
+            ramp, settle = self.magnet(field, coarse[0])
+            points, pause = self.scan(coarse, pointTime)
+            parts["magnet ramp"], parts["magnet settle"], parts["search"] = ramp, settle, points + pause
+            field = coarse[-1]
+        ramp, settle = self.magnet(field, fields[-1] if point.reverse else fields[0])
+        parts["magnet ramp"] += ramp
+        parts["magnet settle"] += settle
+        parts.update(rf=self.rfSwitch if freq != point.freq else 0.0,
+                     power=self.powerSwitch if power is not None and power != point.power else 0.0,
+                     modulation=self.modSwitch if current is not None and current != point.current else 0.0)
+        parts["points"], parts["pause"] = self.scan(fields)
+        return parts
+
+
+class TimingModel:
+    """CostModel parameters and per-point times calibrated on past runs (run_estimator.calibrate).
+    pointTimes: {"scanMode/settleMode/readMode": (offset, slope)}, seconds per point = offset + slope x time constant.
+    Anything not calibrated keeps the CostModel default"""
+    def __init__(self, params=None, pointTimes=None, samples=None):
+        self.params, self.pointTimes, self.samples = dict(params or {}), dict(pointTimes or {}), dict(samples or {})
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as file: saved = json.load(file)
+        return cls(saved.get("params"), saved.get("pointTimes"), saved.get("samples"))
+
+    def save(self, path, **extra):
+        with open(path, "w") as file:
+            json.dump(dict(extra, params=self.params, pointTimes=self.pointTimes, samples=self.samples), file, indent=1)
+        return path
+
+    def pointTime(self, scanMode, settleMode, readMode, timeConst):
+        """Seconds per point, from the closest calibrated combination of modes"""
+        key = "/".join((scanMode, settleMode, readMode))
+        fit = self.pointTimes.get(key) or next((fit for k, fit in sorted(self.pointTimes.items())
+                                                if k.startswith("{}/{}/".format(scanMode, settleMode))), None)
+        if fit is not None: return fit[0] + fit[1] * timeConst
+        if scanMode == "sweep": return 0.0 #Only the travel at the sweep rate
+        return SettleFactors.get(settleMode, 5) * timeConst + 0.5
+
+    def costModel(self, plan, timeConst, coarse=None):
+        """CostModel of the plan (ScanPlan) at the lock-in time constant in s. coarse: the fields of the coarse
+        scan of plan.search (resonance_search.coarseFields), run at plan.searchTimeConst before every scan"""
+        params = dict(self.params)
+        if plan.scanMode == "sweep": params["scanRate"] = float(plan.sweepRate)
+        if coarse:
+            searchTimeConst = SR830_TimeConsts[plan.searchTimeConst]
+            params["search"] = (list(coarse), self.pointTime(plan.scanMode, plan.settleMode, plan.readMode, searchTimeConst))
+        return CostModel(pointTime=self.pointTime(plan.scanMode, plan.settleMode, plan.readMode, timeConst), **params)
+
+
+def snake(axes):
+    """Reflected order of the product of axes: the inner axes run back and forth, so consecutive
+    combinations differ in one axis by one step"""
+    if not axes: return [()]
+    rest = snake(axes[1:])
+    order = []
+    for i, value in enumerate(axes[0]):
+        order += [(value,) + r for r in (rest if i % 2 == 0 else rest[::-1])]
+    return order
+
+
+class SweepPlanner:
+    """fieldsAtTemps: {temp: {freq: fields}} in the order entered, fields ascending (prepareFieldstoScan).
+    powers (dBm) and currents (mA) of the modulation: the values to scan, in the order entered.
+    startTemp/startField: where the PPMS is now, startPower/startCurrent: the present source settings"""
+    def __init__(self, fieldsAtTemps, powers=(None,), currents=(None,), model=None, startTemp=None, startField=None,
+                 startPower=None, startCurrent=None):
+        self.fieldsAtTemps = {temp: {freq: sorted(fields) for freq, fields in grids.items()} for temp, grids in fieldsAtTemps.items()}
+        self.powers, self.currents = list(powers) or [startPower], list(currents) or [startCurrent]
+        self.model = model or CostModel()
+        self.start = (startTemp, None, startPower, startCurrent, startField)
+
+    def fields(self, point):
+        """The fields of the scan of point, in the order they are measured"""
+        fields = self.fieldsAtTemps[point.temp][point.freq]
+        return fields[::-1] if point.reverse else fields
+
+    def _advance(self, point):
+        fields = self.fields(point)
+        return (point.temp, point.freq, point.power, point.current, fields[-1])
+
+    def cost(self, points):
+        """(total seconds, {part: seconds}) of running the points in this order"""
+        parts, state = dict.fromkeys(CostParts, 0.0), self.start
+        for point in points:
+            for part, seconds in self.model.step(state, point, self.fieldsAtTemps[point.temp][point.freq]).items():
+                parts[part] += seconds
+            state = self._advance(point)
+        return sum(parts.values()), parts
+
+    def _direction(self, state, temp, freq, power, current):
+        """The point with the direction that starts closest to the magnet"""
+        fields = self.fieldsAtTemps[temp][freq]
+        field = state[4]
+        reverse = bool(field is not None and abs(fields[-1] - field) < abs(fields[0] - field))
+        return SweepPoint(temp, freq, power, current, reverse)
+
+    def _temperatures(self):
+        """Monotonic, starting from the end closest to the present temperature"""
+        temps = sorted(self.fieldsAtTemps)
+        if self.start[0] is not None and abs(temps[-1] - self.start[0]) < abs(temps[0] - self.start[0]): temps = temps[::-1]
+        return temps
+
+    def given(self, reverse=False):
+        points = []
+        for i, temp in enumerate(self.fieldsAtTemps):
+            if i % 2: reverse = not reverse #Every other temperature scans the fields the other way
+            freqs = sorted(self.fieldsAtTemps[temp], reverse=reverse)
+            points += [SweepPoint(temp, freq, power, current, reverse)
+                       for freq, power, current in itertools.product(freqs, self.powers, self.currents)]
+        return points
+
+    def serpentine(self):
+        """The cheapest snake over all nestings of frequency, power and modulation"""
+        best = None
+        for nesting in itertools.permutations(range(3)):
+            points, state = [], self.start
+            for temp in self._temperatures():
+                axes = [sorted(self.fieldsAtTemps[temp]), self.powers, self.currents]
+                order = [tuple(combination[nesting.index(k)] for k in range(3)) for combination in snake([axes[k] for k in nesting])]
+                #Continue from the end of the last temperature: run this one forwards or backwards
+                candidates = []
+                for sequence in (order, order[::-1]):
+                    s, run = state, []
+                    for freq, power, current in sequence:
+                        point = self._direction(s, temp, freq, power, current)
+                        run.append(point)
+                        s = self._advance(point)
+                    candidates.append((self._cost(state, run), run, s))
+                seconds, run, state = min(candidates, key=lambda c: c[0])
+                points += run
+            total = self.cost(points)[0]
+            if best is None or total < best[0]: best = (total, points)
+        return best[1]
+
+    def _cost(self, state, points):
+        seconds = 0.0
+        for point in points:
+            seconds += sum(self.model.step(state, point, self.fieldsAtTemps[point.temp][point.freq]).values())
+            state = self._advance(point)
+        return seconds
+
+    def nearest(self):
+        """Greedy: at every temperature the cheapest next scan from where the last one ended"""
+        points, state = [], self.start
+        for temp in self._temperatures():
+            todo = list(itertools.product(sorted(self.fieldsAtTemps[temp]), self.powers, self.currents))
+            while todo:
+                candidates = []
+                for combination in todo:
+                    point = self._direction(state, temp, *combination)
+                    step = self.model.step(state, point, self.fieldsAtTemps[temp][point.freq])
+                    candidates.append((sum(step.values()), combination, point))
+                seconds, combination, point = min(candidates, key=lambda c: c[0])
+                todo.remove(combination)
+                points.append(point)
+                state = self._advance(point)
+        return points
+
+    def order(self, strategy="best", reverse=False):
+        """The SweepPoints in the order of strategy (SweepOrders). reverse: first direction of "given" """
+        if strategy not in SweepOrders: raise ValueError("Unknown sweep order {}".format(strategy))
+        if strategy == "given": return self.given(reverse)
+        if strategy == "serpentine": return self.serpentine()
+        if strategy == "nearest": return self.nearest()
+        return min((self.serpentine(), self.nearest()), key=lambda points: self.cost(points)[0])
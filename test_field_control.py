@@ -0,0 +1,74 @@
+"""Checks of the VSM hex codec of field_control.py over the whole encodable range. python -m pytest"""
+import time
+import numpy as np
+import pytest
+from field_control import (encode_fields, decode_fields, num_to_hex, hex_to_num, MaxField, FieldRangeError,
+                           MalformedReplyError)
+
+N = 200000
+
+
+@pytest.fixture(scope="module")
+def codes():
+    """Every representable value: any sign, exponent digit 1..F, normalised 24 bit mantissa"""
+    rng = np.random.default_rng(0)
+    codes = (rng.integers(0, 2, N) << 31) | (rng.integers(1, 16, N) << 24) | rng.integers(1 << 23, 1 << 24, N)
+    return np.array(["{:08X}".format(c) for c in codes])
+
+
+@pytest.fixture(scope="module")
+def values():
+    """Values of every magnitude below MaxField"""
+    rng = np.random.default_rng(1)
+    return rng.uniform(-MaxField, MaxField, N) * 10.0 ** -rng.integers(0, 6, N)
+
+
+def test_round_trip_of_strings(codes):
+    assert (encode_fields(decode_fields(codes)) == codes).all()
+
+
+def test_lower_case_digits(codes):
+    assert (decode_fields(np.char.lower(codes)) == decode_fields(codes)).all()
+
+
+def test_truncation(values):
+    """Any value is truncated towards zero by less than one unit of the last mantissa bit"""
+    y = decode_fields(encode_fields(values))
+    ulp = np.ldexp(1.0, np.maximum(np.frexp(np.abs(values))[1] - 1, 0) - 23)
+    assert (np.abs(y) <= np.abs(values)).all()
+    assert (np.abs(values) - np.abs(y) < ulp).all()
+    assert (np.sign(y) * np.sign(values) >= 0).all()
+
+
+def test_integers():
+    fields = np.arange(-20000, 20000)
+    assert (decode_fields(encode_fields(fields)) == fields).all()
+
+
+def test_same_as_one_value_at_a_time(codes, values):
+    assert [num_to_hex(v) for v in values[:5000]] == encode_fields(values[:5000]).tolist()
+    assert [hex_to_num(s) for s in codes[:5000]] == decode_fields(codes[:5000]).tolist()
+    assert num_to_hex(0) == "00000000" and hex_to_num("00000000") == 0 and hex_to_num(num_to_hex(-2400.5)) == -2400.5
+
+
+@pytest.mark.parametrize("bad", [MaxField, -MaxField, np.nan, np.inf])
+def test_out_of_range(bad):
+    with pytest.raises(FieldRangeError): encode_fields([bad])
+    with pytest.raises(FieldRangeError): num_to_hex(bad)
+
+
+@pytest.mark.parametrize("bad", ["1E800000", "0E80000", "0E8000000", "0G800000", "0_800000", "0E80000é"])
+def test_malformed(bad):
+    with pytest.raises(MalformedReplyError): decode_fields([bad])
+    with pytest.raises(MalformedReplyError): hex_to_num(bad)
+
+
+def test_vectorized_is_faster(values):
+    start = time.perf_counter()
+    encode_fields(values)
+    vectorized = (time.perf_counter() - start) / len(values)
+    start = time.perf_counter()
+    for value in values[:10000]: num_to_hex(value)
+    oneAtATime = (time.perf_counter() - start) / 10000
+    print("encode: {:.2f} us per value, num_to_hex: {:.2f} us per value".format(1e6 * vectorized, 1e6 * oneAtATime))
+    assert vectorized < oneAtATime
@@ -0,0 +1,138 @@
+"""FieldController of field_control.py on a fake VSM and gaussmeter. python -m pytest"""
+import numpy as np
+import pytest
+import field_control
+from field_control import FieldController, decode_fields, hex_to_num
+
+
+class FakeVSM:
+    """The magnet lands offset[direction] G below the CONTO setpoint, direction 1 when the setpoint went up.
+    stuck: the field does not follow the setpoint at all"""
+    def __init__(self, rising=3.0, falling=-2.0, stuck=None):
+        self.offset = {1: rising, -1: falling}
+        self.field, self.setpoint, self.stuck = 0.0, None, stuck
+        self.commands = []
+
+    def write(self, command):
+        self.commands.append(command)
+        if command.startswith("CONTO "):
+            setpoint = hex_to_num(command[6:])
+            direction = 1 if self.setpoint is None or setpoint >= self.setpoint else -1
+            self.setpoint = setpoint
+            self.field = self.stuck if self.stuck is not None else setpoint - self.offset[direction]
+
+    def query(self, command):
+        self.commands.append(command)
+        if command == "CONST?": return "2"
+        raise ValueError(command)
+
+    def sent(self, head):
+        return [c for c in self.commands if c.split(" ")[0] == head]
+
+
+class FakeGauss:
+    def __init__(self, vsm):
+        self.vsm = vsm
+
+    def query(self, command):
+        assert command == "RDGFIELD?"
+        return "{:.2f}G\n".format(self.vsm.field) #read_field drops the last 2 characters
+
+
+@pytest.fixture(autouse=True)
+def noSleep(monkeypatch):
+    monkeypatch.setattr(field_control.time, "sleep", lambda seconds: None)
+
+
+def test_mode_sent_once():
+    vsm = FakeVSM()
+    control = FieldController(vsm, FakeGauss(vsm))
+    for field in (2400, 2410, 2300):
+        control.set_field(field)
+    assert [len(vsm.sent(head)) for head in ("RANGE", "CMODE", "CONTR")] == [1, 1, 1]
+    control.set_field(2400, rate=500) #Only the changed ramp rate goes out again
+    assert [len(vsm.sent(head)) for head in ("RANGE", "CMODE", "CONTR")] == [1, 1, 2]
+    control.invalidate()
+    control.set_field(2400, rate=500)
+    assert [len(vsm.sent(head)) for head in ("RANGE", "CMODE", "CONTR")] == [2, 2, 3]
+
+
+def test_small_step_skips_stability_polling():
+    vsm = FakeVSM(rising=0, falling=0)
+    control = FieldController(vsm, FakeGauss(vsm), small_step=10)
+    control.set_field(2400)
+    polls = len(vsm.sent("CONST?"))
+    assert polls >= 3
+    control.set_field(2405)
+    assert len(vsm.sent("CONST?")) == polls and control.last["waits"] == 0
+    control.set_field(2500)
+    assert len(vsm.sent("CONST?")) > polls and control.last["waits"] == 1
+
+
+def test_correction_converges_within_tolerance():
+    vsm = FakeVSM(rising=3.0)
+    control = FieldController(vsm, FakeGauss(vsm), tolerance=0.2)
+    measured = control.set_field(2400)
+    assert abs(measured - 2400) <= 0.2
+    assert control.last["corrections"] == 1
+    assert control.last["setpoint"] == pytest.approx(2403)
+
+
+def test_correction_stops_at_max_iterations():
+    vsm = FakeVSM(stuck=1000.0)
+    control = FieldController(vsm, FakeGauss(vsm), max_iterations=3)
+    assert control.set_field(2400) == 1000.0
+    assert control.last["corrections"] == 3
+    assert len(vsm.sent("CONTO")) == 4 #The first setpoint and 3 corrections
+    assert not control.offsets[1] and not control.offsets[-1] #Nothing is learned from a field that was not reached
+
+
+def test_learned_offset_lands_on_first_setpoint():
+    vsm = FakeVSM(rising=3.0, falling=-2.0)
+    control = FieldController(vsm, FakeGauss(vsm))
+    control.set_field(1000)
+    control.set_field(2400) #Rising: learns +3
+    control.set_field(2000) #Falling: the rising offset is all there is, then learns -2
+    assert control.last["corrections"] >= 1
+    sent = len(vsm.sent("CONTO"))
+    control.set_field(2400)
+    assert control.last["corrections"] == 0 and len(vsm.sent("CONTO")) == sent + 1
+    assert control.last["setpoint"] == pytest.approx(2403)
+    control.set_field(2000)
+    assert control.last["corrections"] == 0 and control.last["setpoint"] == pytest.approx(1998)
+
+
+def test_predict_per_direction_bins():
+    control = FieldController(FakeVSM())
+    assert control.predict(2400, True) == 2400 #Nothing learned
+    control.learn(2000, True, 2002)
+    control.learn(3010, True, 3014) #Binned to 3000
+    assert control.predict(2500, True) == pytest.approx(2503)
+    assert control.predict(2500, False) == pytest.approx(2503) #No falling offsets yet: the rising ones
+    control.learn(2500, False, 2499)
+    assert control.predict(2500, False) == pytest.approx(2499)
+    assert control.predict(2500, True) == pytest.approx(2503)
+    control.learn(2000, True, 2006) #Halfway to the new offset at learning_rate 0.5
+    assert control.offsets[1][2000] == pytest.approx(4)
+
+
+def test_sweep_table():
+    control = FieldController(FakeVSM())
+    control.learn(2400, True, 2403)
+    control.learn(2400, False, 2398)
+    table = control.sweep_table([2400, 2410, 2405, 2405])
+    assert all(command.startswith("CONTO ") for command in table)
+    assert decode_fields([command[6:] for command in table]).tolist() == [2403, 2413, 2403, 2403]
+
+
+def test_save_load_round_trip(tmp_path):
+    control = FieldController(FakeVSM())
+    control.learn(2400, True, 2403)
+    control.learn(3000, False, 2998.5)
+    path = str(tmp_path / "offsets.json")
+    control.save(path)
+    loaded = FieldController(FakeVSM())
+    loaded.load(path)
+    assert loaded.offsets == control.offsets
+    assert loaded.predict(2700, True) == control.predict(2700, True)
+    assert loaded.predict(2700, False) == control.predict(2700, False)